@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""An asyncio HTTP/1.1 front end for the library's WSGI application.
+
+Connections are handled by the event loop, so slow clients only cost a
+coroutine each; connections are kept alive between requests. The WSGI
+application runs on a thread pool, and its response is passed to the
+loop a batch (up to CHUNK_SIZE bytes) at a time and sent with chunked
+transfer encoding, so large listings stream out while they are being
+produced. Files handed to `wsgi.file_wrapper` (thumbnails) are sent with
+the loop's sendfile, which copies them straight from the page cache to
+the socket where the platform allows. A response waiting for something
+(a long-poll) can suspend itself through `environ['aioserver.suspend']`,
+giving its thread back until it is woken.
+
+Python 3 only. Run with `python aioserver.py [host] [port]`.
+"""
+import asyncio
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+CHUNK_SIZE = 64 * 1024
+KEEPALIVE_TIMEOUT = 15
+MAX_HEADER_LINES = 100
+MAX_BODY = 10 * 1024 * 1024
+
+REASONS = {400: 'Bad Request', 411: 'Length Required', 413: 'Payload Too Large'}
+
+# ----------------------------------------------------------------------
+
+class BadRequest(Exception):
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+def read_some(body, suspended=()):
+    """Pull chunks from the iterator `body` until CHUNK_SIZE bytes, an
+    empty chunk after some data (the application asking for what it has
+    produced to be sent, as an event stream does) or once `suspended`,
+    or the end. Returns (bytes, finished)."""
+    chunks = []
+    size = 0
+    for chunk in body:
+        if chunk:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= CHUNK_SIZE:
+                return b''.join(chunks), False
+        elif chunks or suspended:
+            return b''.join(chunks), False
+    return b''.join(chunks), True
+
+def content_length(headers):
+    for name, value in headers:
+        if name.lower() == 'content-length':
+            return int(value)
+    return None
+
+class FileWrapper(object):
+    """wsgi.file_wrapper: marks a response body as a file, for sendfile."""
+    def __init__(self, filelike, block_size=CHUNK_SIZE):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.block_size), b'')
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+class Server(object):
+    def __init__(self, app, host='127.0.0.1', port=8080, threads=16):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(threads)
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader), KEEPALIVE_TIMEOUT)
+                except BadRequest as e:
+                    writer.write(('HTTP/1.1 %d %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+                                  % (e.status, REASONS[e.status])).encode('latin-1'))
+                    break
+                if request is None:
+                    break
+                keep_alive = await self.respond(writer, *request)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            try:
+                writer.close()
+            except ConnectionError:
+                pass
+
+    async def read_request(self, reader):
+        """(method, target, version, headers, body), or None at EOF."""
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            raise BadRequest(400)
+        headers = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= MAX_HEADER_LINES or b':' not in line:
+                raise BadRequest(400)
+            name, value = line.decode('latin-1').split(':', 1)
+            headers.append((name.strip().lower(), value.strip()))
+        fields = dict(headers)
+        if 'chunked' in fields.get('transfer-encoding', '').lower():
+            raise BadRequest(411)
+        length = fields.get('content-length') or '0'
+        if not length or length.strip('0123456789'):
+            raise BadRequest(400) # not a number, or negative
+        length = int(length)
+        if length > MAX_BODY:
+            raise BadRequest(413)
+        body = await reader.readexactly(length) if length else b''
+        return method, target, version, headers, body
+
+    def environ(self, writer, method, target, version, headers, body):
+        path, _, query = target.partition('?')
+        peer = writer.get_extra_info('peername') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, 'latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': peer[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+            }
+        for name, value in headers:
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'content-length':
+                environ['CONTENT_LENGTH'] = value
+            else:
+                key = 'HTTP_' + name.upper().replace('-', '_')
+                environ[key] = environ[key] + ',' + value if key in environ else value
+        return environ
+
+    async def respond(self, writer, method, target, version, headers, body):
+        """Run the application and send its response; True to keep alive."""
+        loop = asyncio.get_event_loop()
+        environ = self.environ(writer, method, target, version, headers, body)
+        started = []
+        def start_response(status, response_headers, exc_info=None):
+            started[:] = [status, response_headers]
+
+        # The application, and the iteration over its response, run on a
+        # pool thread (Bottle keeps per-request state in thread locals),
+        # handing batches over through a short queue. An application waiting
+        # for something (a long-poll) calls environ['aioserver.suspend'] and
+        # yields an empty chunk: the thread is let go, and the iteration
+        # resumed on one once `watch` wakes it or `seconds` have passed.
+        batches = asyncio.Queue(2)
+        cancelled = threading.Event()
+        suspended = []  # (watch, seconds), while the application waits
+        running = {}    # the response, and its iterator, between batches
+        def suspend(watch, seconds):
+            suspended[:] = [(watch, seconds)]
+        environ['aioserver.suspend'] = suspend
+        def put(item):
+            if not cancelled.is_set():
+                asyncio.run_coroutine_threadsafe(batches.put(item), loop).result()
+        def produce():
+            result = running.pop('result', None)
+            try:
+                if result is None:
+                    result = self.app(environ, start_response)
+                    if (isinstance(result, FileWrapper) and hasattr(result.filelike, 'fileno')
+                            and content_length(started[1]) is not None):
+                        # Sent from the loop, which closes it.
+                        put((result, True, None, None))
+                        result = None
+                        return
+                    running['iterator'] = iter(result)
+                finished = False
+                while not finished and not cancelled.is_set():
+                    data, finished = read_some(running['iterator'], suspended)
+                    if suspended and not finished:
+                        running['result'], result = result, None
+                        put((data, False, None, suspended.pop()))
+                        return
+                    put((data, finished, None, None))
+            except Exception as e:
+                put((b'', True, e, None))
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        async def resume(watch, seconds):
+            woken = loop.create_future()
+            def wake():
+                loop.call_soon_threadsafe(lambda: woken.done() or woken.set_result(None))
+            cancel = watch(wake)
+            try:
+                await asyncio.wait([woken], timeout=seconds)
+            finally:
+                cancel()
+            loop.run_in_executor(self.executor, produce)
+        loop.run_in_executor(self.executor, produce)
+
+        try:
+            data, finished, error, parked = await batches.get()
+            if error is not None:
+                raise error
+            status, response_headers = started
+
+            connection = environ.get('HTTP_CONNECTION', '').lower()
+            if version == 'HTTP/1.1':
+                keep_alive = connection != 'close'
+            else:
+                keep_alive = connection == 'keep-alive'
+            names = set(name.lower() for name, value in response_headers)
+            no_body = method == 'HEAD' or status[:3] in ('204', '304') or status[0] == '1'
+            chunked = not no_body and 'content-length' not in names
+            if chunked and finished:
+                # It all arrived at once: send it with a length instead.
+                response_headers = response_headers + [('Content-Length', str(len(data)))]
+                chunked = False
+            elif chunked and version != 'HTTP/1.1':
+                keep_alive = False # the end of the body is the end of the connection
+            lines = ['%s %s' % (version if version == 'HTTP/1.0' else 'HTTP/1.1', status)]
+            lines.extend('%s: %s' % header for header in response_headers)
+            if chunked and version == 'HTTP/1.1':
+                lines.append('Transfer-Encoding: chunked')
+            lines.append('Connection: %s' % ('keep-alive' if keep_alive else 'close'))
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+            if isinstance(data, FileWrapper):
+                try:
+                    if not no_body:
+                        await writer.drain()
+                        await loop.sendfile(writer.transport, data.filelike, data.filelike.tell(),
+                                            content_length(response_headers))
+                finally:
+                    data.close()
+                return keep_alive
+
+            framed = chunked and version == 'HTTP/1.1'
+            while True:
+                if data and not no_body:
+                    writer.write(b'%x\r\n%s\r\n' % (len(data), data) if framed else data)
+                    await writer.drain()
+                if finished:
+                    break
+                if parked is not None:
+                    await resume(*parked)
+                data, finished, error, parked = await batches.get()
+                if error is not None:
+                    raise error
+            if framed:
+                writer.write(b'0\r\n\r\n')
+            await writer.drain()
+            return keep_alive
+        finally:
+            cancelled.set()
+            if hasattr(running.get('result'), 'close'):
+                running.pop('result').close()   # given up while suspended
+            while not batches.empty():
+                data = batches.get_nowait()[0]
+                if isinstance(data, FileWrapper):
+                    data.close()
+
+def serve(app, host='127.0.0.1', port=8080, threads=16):
+    server = Server(app, host, port, threads)
+    async def main():
+        await server.start()
+        print('Serving on http://%s:%d/' % (host, server.port))
+        async with server.server:
+            await server.server.serve_forever()
+    asyncio.run(main())
+
+# ----------------------------------------------------------------------
+
+if __name__ == '__main__':
+    from app import application
+    host = sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    serve(application, host, port)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+from nose.tools import assert_equals, assert_in
+from nose.plugins.skip import SkipTest
+import json
+import sys
+
+from app import app
+
+def setup():
+    global base_port
+    if sys.version_info < (3, 7):
+        raise SkipTest('aioserver needs Python 3.7+')
+    from loadtest import start_asyncio
+    base_port = int(start_asyncio(app).rsplit(':', 1)[1])
+
+def connect():
+    from http.client import HTTPConnection
+    return HTTPConnection('127.0.0.1', base_port, timeout=10)
+
+def test_keeps_connection_alive():
+    conn = connect()
+    conn.request('GET', '/library/api')
+    res = conn.getresponse()
+    assert_equals(res.status, 200)
+    assert_in('services', json.loads(res.read().decode('utf-8')))
+    sock = conn.sock
+
+    conn.request('GET', '/library/api/books/NOTAREALISBN')
+    res = conn.getresponse()
+    res.read()
+    assert_equals(res.status, 404)
+    assert conn.sock is sock
+    conn.close()
+
+def test_rejects_bad_content_length():
+    import socket
+    for length in (b'ten', b'-1'):
+        sock = socket.create_connection(('127.0.0.1', base_port), timeout=10)
+        sock.sendall(b'PUT /library/api/books/AIO-LENGTH HTTP/1.1\r\nHost: x\r\n'
+                     b'Content-Length: ' + length + b'\r\n\r\n')
+        response = b''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break # closed
+            response += data
+        sock.close()
+        assert response.startswith(b'HTTP/1.1 400 Bad Request\r\n')
+        assert_in(b'Connection: close', response)
+
+def test_put_then_get_book():
+    conn = connect()
+    body = json.dumps(dict(title='TITLE', description='DESCRIPTION', isbn='AIO-ISBN'))
+    conn.request('PUT', '/library/api/books/AIO-ISBN', body, {'Content-Type': 'application/json'})
+    res = conn.getresponse()
+    res.read()
+    assert_equals(res.status, 201)
+
+    conn.request('GET', '/library/api/books/AIO-ISBN')
+    res = conn.getresponse()
+    assert_equals(json.loads(res.read().decode('utf-8'))['title'], 'TITLE')
+    conn.close()
+
+def test_streams_large_listing_in_chunks():
+    from models import Book
+    for i in range(100):
+        Book.store(Book('TITLE %d' % i, 'DESCRIPTION ' * 200, 'AIO-STREAM-%03d' % i))
+    conn = connect()
+    conn.request('GET', '/library/api/books?limit=100')
+    res = conn.getresponse()
+    assert_equals(res.getheader('Transfer-Encoding'), 'chunked')
+    assert_equals(len(json.loads(res.read().decode('utf-8'))['books']), 100)
+    conn.close()
+
+def test_sends_thumbnails_from_their_files():
+    import shutil
+    import tempfile
+    from models import Book
+    from thumbnails import THUMBNAILS, ThumbnailStore
+    image = b'\x89PNG\r\n\x1a\n' + b'cover' * 30000
+    url = 'http://covers.example.com/AIO-THUMB'
+    Book.store(Book('TITLE', 'DESCRIPTION', 'AIO-THUMB', thumbnail=url))
+    directory = tempfile.mkdtemp()
+    THUMBNAILS.store = ThumbnailStore(directory)
+    THUMBNAILS.store.put(url, image)
+    try:
+        conn = connect()
+        conn.request('GET', '/library/api/books/AIO-THUMB/thumbnail')
+        res = conn.getresponse()
+        assert_equals(res.getheader('Content-Length'), str(len(image)))
+        assert_equals(res.read(), image)
+        sock = conn.sock
+
+        conn.request('GET', '/library/api/books/AIO-THUMB/thumbnail', headers={'Range': 'bytes=8-12'})
+        res = conn.getresponse()
+        assert_equals(res.status, 206)
+        assert_equals(res.read(), b'cover')
+        assert conn.sock is sock
+        conn.close()
+    finally:
+        THUMBNAILS.store = None
+        shutil.rmtree(directory)
+
+def test_streams_events_as_they_happen():
+    import threading
+    import time
+    from models import Book
+    from events import FEED
+    FEED.attach(Book.get_repository())
+    book = Book('TITLE', 'DESCRIPTION', 'AIO-EVENTS')
+    Book.store(book)
+    conn = connect()
+    conn.request('GET', '/library/api/events/stream?isbn=AIO-EVENTS&timeout=5',
+                 headers={'Accept-Encoding': 'gzip'})
+    res = conn.getresponse()
+    assert_equals(res.getheader('Content-Encoding'), None)
+    assert_equals(res.readline(), b'retry: 3000\n')
+    started = time.time()
+    threading.Timer(0.1, book.reserve, ['RESERVER']).start()
+    res.readline()
+    assert res.readline().startswith(b'id: ')
+    assert_in(b'"action":"reserve"', res.readline())
+    assert time.time() - started < 2
+    conn.close()
+
+def test_long_polls_wait_without_holding_threads():
+    import threading
+    import time
+    from models import Book
+    from events import FEED
+    FEED.attach(Book.get_repository())
+    since = FEED.last_id
+    answers = []
+    def poll():
+        conn = connect()
+        conn.request('GET', '/library/api/events?isbn=AIO-POLL&timeout=5&since=%d' % since)
+        answers.append(json.loads(conn.getresponse().read().decode('utf-8')))
+        conn.close()
+    pollers = [threading.Thread(target=poll) for _ in range(40)] # more than the pool's threads
+    for poller in pollers:
+        poller.start()
+    time.sleep(0.2)
+    started = time.time()
+    conn = connect()
+    conn.request('GET', '/library/api')
+    assert_equals(conn.getresponse().status, 200)
+    conn.close()
+    assert time.time() - started < 1
+    assert_equals([], answers)
+
+    Book.store(Book('TITLE', 'DESCRIPTION', 'AIO-POLL'))
+    for poller in pollers:
+        poller.join()
+    assert_equals(40 * [['store']], [[event['action'] for event in answer['events']]
+                                     for answer in answers])
+    assert time.time() - started < 2
@@ -1,10 +1,91 @@
+import os
+import threading
+import time
 import bottle
 import controllers
+from compression import Compressor
+from events import FEED
+from loader import load_library
+from metrics import METRICS, MetricsPlugin, SlowestProfiles, instrument
+from models import Book, Repository
+from persistence import Persistence
+from response_cache import ResponseCache
+from sqlite_repository import SQLiteRepository
+from thumbnails import THUMBNAILS, Origin, Prefetcher, ThumbnailStore
 
 app = bottle.app()
-application = app
+metrics_plugin = app.install(MetricsPlugin(METRICS))
+response_cache = app.install(ResponseCache(metrics=METRICS))
+METRICS.collect(Book.representations.render_metrics)
+for method in ('find_one', 'find', 'page', 'page_at', 'search', 'select'):
+    instrument(Repository, method, 'repository.' + method)
+    instrument(SQLiteRepository, method, 'repository.' + method)
+instrument(Book, 'to_json', 'book.to_json')
+application = Compressor(app)
 bottle.debug(True)
 
+def expire_reservations_forever(interval=60):
+    while True:
+        time.sleep(interval)
+        Book.get_repository().expire_reservations()
+
 if __name__=='__main__':
     bottle.debug(True)
-    bottle.run(app=app, host='0.0.0.0', reloader=True)
+    # In seconds; unset for no limit.
+    if os.environ.get('LIBRARY_HOLD_WINDOW'):
+        Book.hold_window = float(os.environ['LIBRARY_HOLD_WINDOW'])
+    if os.environ.get('LIBRARY_RESERVATION_EXPIRY'):
+        Book.reservation_expiry = float(os.environ['LIBRARY_RESERVATION_EXPIRY'])
+    if os.environ.get('LIBRARY_PROFILE_DIR'):
+        # Profile (a sample of) requests, keeping the slowest.
+        metrics_plugin.profiler = SlowestProfiles(
+            os.environ['LIBRARY_PROFILE_DIR'],
+            keep=int(os.environ.get('LIBRARY_PROFILE_SLOWEST', 10)),
+            sample=float(os.environ.get('LIBRARY_PROFILE_SAMPLE', 1.0)))
+    data = os.environ.get('LIBRARY_DATA', 'library.json')
+    state = os.environ.get('LIBRARY_STATE')
+    database = os.environ.get('LIBRARY_DB')
+    server = os.environ.get('LIBRARY_SERVER')
+    if server == 'workers':
+        # Maps the catalogue itself, to share it between the worker processes.
+        from workers import serve
+        serve(application, data=data, log=os.environ.get('LIBRARY_LOG', 'library.log'))
+    elif database:
+        Book.repository = SQLiteRepository(database)
+        if not len(Book.repository.find()) and os.path.exists(data):
+            print('Imported %s into %s: %r' % (data, database, load_library(data)))
+    elif state:
+        persistence = Persistence(state)
+        print('Recovered %s: %d journal records replayed' % (state, persistence.recover()))
+        if not os.path.exists(os.path.join(state, 'snapshot')) and os.path.exists(data):
+            print('Loaded %s: %r' % (data, load_library(data)))
+            persistence.snapshot()
+    elif data and os.path.exists(data):
+        print('Loaded %s: %r' % (data, load_library(data, lazy=True)))
+        # Answer straight away, but build the books meanwhile, so that
+        # stats and facets soon count all of them.
+        hydrator = threading.Thread(target=Book.get_repository().hydrate, name='hydrate')
+        hydrator.daemon = True
+        hydrator.start()
+    # After loading, so the feed starts with the changes made since.
+    FEED.attach(Book.get_repository())
+    if server != 'workers' and os.environ.get('LIBRARY_THUMBNAILS'):
+        # Serve thumbnails from a local copy, fetched in the background.
+        THUMBNAILS.store = ThumbnailStore(
+            os.environ['LIBRARY_THUMBNAILS'],
+            max_bytes=int(os.environ.get('LIBRARY_THUMBNAIL_BYTES', 256 * 1024 * 1024)))
+        THUMBNAILS.prefetcher = Prefetcher(THUMBNAILS.store,
+                                           Origin(os.environ.get('LIBRARY_THUMBNAIL_ORIGIN')))
+        Book.get_repository().subscribe(THUMBNAILS.prefetcher.book_changed)
+        THUMBNAILS.prefetcher.start(Book.get_repository())
+    if server != 'workers' and (Book.hold_window is not None or
+                               Book.reservation_expiry is not None):
+        # Workers only clear lapsed reservations as books are checked out.
+        sweeper = threading.Thread(target=expire_reservations_forever, name='expire-reservations')
+        sweeper.daemon = True
+        sweeper.start()
+    if server == 'asyncio':
+        from aioserver import serve
+        serve(application, host='0.0.0.0', port=8080)
+    elif server != 'workers':
+        bottle.run(app=application, host='0.0.0.0', reloader=True)
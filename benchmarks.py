@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+"""Benchmarks for the library models.
+
+Run with `python benchmarks.py`; each benchmark prints one line.
+"""
+import gc
+import os
+import sys
+from functools import partial
+from timeit import default_timer as timer
+
+from models import Book, Repository
+from loader import iter_lines, book_from_record
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+LIBRARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'library.json')
+
+# ----------------------------------------------------------------------
+
+class DictBook(object):
+    """The original, `__dict__`-based Book layout, kept for comparison."""
+    def __init__(self, title, description, isbn, borrower='', author='',
+                 publisher='', small_thumbnail='', thumbnail='',
+                 reservations=None, published_date=''):
+        self.title = title
+        self.description = description
+        self.isbn = isbn
+        self.borrower = borrower
+        self.author = author
+        self.publisher = publisher
+        self.small_thumbnail = small_thumbnail
+        self.thumbnail = thumbnail
+        self.reservations = reservations or []
+        self.published_date = published_date
+
+def library_records(path=LIBRARY):
+    import json
+    return [json.loads(line.decode('utf-8')) for line in iter_lines(path)]
+
+def measure_allocations(build):
+    """Bytes allocated, and still live, while running `build()`."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del kept
+    return after - before
+
+def build_books(cls, records, users=50):
+    """One `cls` per record; every tenth book is borrowed by one of `users`
+    users, spelt out afresh each time as it would be when decoded from a
+    request."""
+    books = []
+    for i, j in enumerate(records):
+        borrower = ''.join(['user', str(i % users)]) if i % 10 == 0 else ''
+        books.append(cls(j.get('title', ''), j.get('description', ''), j.get('ISBN', ''),
+                         borrower=borrower,
+                         author=j.get('author', ''),
+                         publisher=j.get('publisher', ''),
+                         small_thumbnail=j.get('smallThumbnail', ''),
+                         thumbnail=j.get('thumbnail', '')))
+    return books
+
+def bench_book_memory(path=LIBRARY):
+    """Memory per book, excluding the field strings shared by both layouts."""
+    if tracemalloc is None:
+        print('book memory: needs tracemalloc (Python 3)')
+        return
+    records = library_records(path)
+    for cls in (DictBook, Book):
+        used = measure_allocations(partial(build_books, cls, records))
+        print('book memory: %-8s %6.1f bytes/book (%d books)' % (
+            cls.__name__, used / float(len(records)), len(records)))
+
+def scaled_repository(size, path=LIBRARY, distinct=False):
+    """A Repository of `size` books, cycling through the records of `path`
+    with the copy number appended to each ISBN (and, if `distinct`, to
+    each author and publisher, so they grow with the catalogue too)."""
+    records = library_records(path)
+    repository = Repository()
+    for i in range(size):
+        book = book_from_record(records[i % len(records)])
+        copy = i // len(records)
+        book.isbn = '%s-%d' % (book.isbn, copy)
+        if distinct:
+            book.author = '%s %d' % (book.author, copy)
+            book.publisher = '%s %d' % (book.publisher, copy)
+        repository.store(book)
+    return repository
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+SEARCH_QUERIES = ['python', 'java script', 'prog', "o'reilly", 'design patterns',
+                  'linux kernel', 'data', 'web development', 'zzz', 'agile software']
+
+def bench_search(sizes=(1000, 10000, 100000)):
+    """Query latency on catalogues scaled up from library.json."""
+    for size in sizes:
+        started = timer()
+        repository = scaled_repository(size)
+        built = timer() - started
+        index = repository.search_index
+        index.generation += 1 # invalidate the results cached while warming up
+        for label in ('cold', 'warm'):
+            samples = []
+            for query in SEARCH_QUERIES:
+                started = timer()
+                index.search(query, limit=20)
+                samples.append(timer() - started)
+            print('search: %7d books (built in %.2fs), %s: median %.3fms, max %.3fms' % (
+                size, built, label, percentile(samples, 0.5) * 1000, max(samples) * 1000))
+
+def bench_concurrency(thread_counts=(1, 2, 4, 8), rounds=5000):
+    """Reserve/borrow/return throughput with several threads at once."""
+    import threading
+    repository = scaled_repository(1000)
+    books = list(repository.find())
+    def worker(user, offset):
+        for i in range(rounds):
+            bk = books[(offset + i) % len(books)]
+            bk.reserve(user)
+            try:
+                bk.check_out(user)
+            except Exception:
+                bk.un_reserve(user)
+                continue
+            bk.check_in(user)
+    for count in thread_counts:
+        threads = [threading.Thread(target=worker, args=('user%d' % i, i * 100))
+                   for i in range(count)]
+        started = timer()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = timer() - started
+        print('concurrency: %d threads, %8.0f transitions/s' % (count, 3 * rounds * count / elapsed))
+
+def bench_persistence(size=100000, mutations=20000, thread_counts=(1, 8)):
+    """Journal write throughput, and recovery time from snapshot + journal."""
+    import shutil
+    import tempfile
+    import threading
+    from persistence import Persistence
+    path = tempfile.mkdtemp()
+    try:
+        repository = scaled_repository(size)
+        persistence = Persistence(path, repository, snapshot_every=10 ** 9)
+        persistence.recover()
+        started = timer()
+        persistence.snapshot()
+        print('persistence: snapshot of %d books in %.2fs' % (size, timer() - started))
+
+        books = list(repository.find())
+        def worker(user, offset, count):
+            for i in range(count):
+                bk = books[(offset + i) % len(books)]
+                bk.check_out(user)
+                bk.check_in(user)
+        for threads in thread_counts:
+            syncs = persistence.journal.syncs
+            per_thread = mutations // (2 * threads)
+            workers = [threading.Thread(target=worker, args=('user%d' % i, i * 1000, per_thread))
+                       for i in range(threads)]
+            started = timer()
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+            persistence.sync()
+            elapsed = timer() - started
+            print('persistence: %d threads, %8.0f journaled mutations/s, %d fsyncs' % (
+                threads, 2 * per_thread * threads / elapsed, persistence.journal.syncs - syncs))
+        persistence.close()
+
+        started = timer()
+        recovered = Persistence(path, Repository())
+        replayed = recovered.recover()
+        print('persistence: recovered %d books + %d journal records in %.2fs' % (
+            size, replayed, timer() - started))
+        recovered.close()
+    finally:
+        shutil.rmtree(path)
+
+def original_links_json(book, for_user='', prefix=''):
+    """`_links` as Book.to_json rendered them before LinkTemplates."""
+    import json
+    options = book.get_options(for_user)
+    ret = [dict(rel='self', href=prefix + '/books/' + book.isbn)]
+    if options.get(Book.CAN_RESERVE, False):
+        ret.append(dict(rel=prefix + '/docs#reserve', href=prefix + '/books/' + book.isbn + '/reservations'))
+    if options.get(Book.CAN_BORROW, False):
+        ret.append(dict(rel=prefix + '/docs#borrow', href=prefix + '/books/' + book.isbn + '/borrower'))
+    if options.get(Book.CAN_RETURN, False):
+        ret.append(dict(rel=prefix + '/docs#return', href=prefix + '/books/' + book.isbn + '/return'))
+    if options.get(Book.CAN_CANCEL, False):
+        ret.append(dict(rel=prefix + '/docs#cancel', href=prefix + '/books/' + book.isbn + '/reservations/' + for_user + '/cancel'))
+    return json.dumps(ret, indent=2).replace('\n', '\n  ')
+
+def bench_links(rounds=20, prefix='http://localhost/library/api'):
+    """links()/get_options() and the `_links` JSON over library.json."""
+    from models import link_templates
+    books = list(build_books(Book, library_records()))
+    for i, bk in enumerate(books[1::7]):
+        bk.reserve('user%d' % (i % 50))
+    cases = [('get_options', lambda bk: bk.get_options('user1')),
+             ('option_flags', lambda bk: bk.option_flags('user1')),
+             ('links', lambda bk: bk.links('user1', prefix)),
+             ('_links json (before)', lambda bk: original_links_json(bk, 'user1', prefix)),
+             ('_links json', lambda bk: link_templates(prefix).json(
+                 bk.option_flags('user1'), bk.isbn, 'user1', pretty=True))]
+    for name, call in cases:
+        started = timer()
+        for i in range(rounds):
+            for bk in books:
+                call(bk)
+        elapsed = (timer() - started) / (rounds * len(books))
+        print('links: %-20s %6.2fus/book' % (name, elapsed * 1e6))
+
+def bench_formats(prefix='http://localhost/library/api'):
+    """Serialisation time and bytes on the wire for each listing format,
+    over the whole of library.json."""
+    import zlib
+    from models import RepresentationCache
+    from controllers import page_links, stream_page, stream_lines
+    repository = Repository()
+    for bk in build_books(Book, library_records()):
+        repository.store(bk)
+    books = list(repository.find())
+    links = page_links(prefix + '/books', 0, len(books), len(books))
+    formats = [('compact', lambda: stream_page(links, len(books), books, prefix)),
+               ('pretty', lambda: stream_page(links, len(books), books, prefix, pretty=True)),
+               ('ndjson', lambda: stream_lines(books, prefix))]
+    for name, render in formats:
+        timings = []
+        for label in ('cold', 'warm'):
+            if label == 'cold':
+                Book.representations = RepresentationCache()
+            started = timer()
+            body = ''.join(render()).encode('utf-8')
+            timings.append((timer() - started) * 1e6 / len(books))
+        sizes = [len(body), len(zlib.compress(body, 6))]
+        started = timer()
+        zlib.compress(body, 6)
+        deflate = (timer() - started) * 1e6 / len(books)
+        print('formats: %-7s %6.1fus/book cold, %5.1fus warm; %7d bytes, %6d deflated (+%.1fus/book)' % (
+            name, timings[0], timings[1], sizes[0], sizes[1], deflate))
+
+def waitlist(queue, users):
+    """Everyone in `users` joins `queue` (checking they aren't already
+    in it), every other user leaves, each time with one who stays looking
+    up their position, and the rest are served in turn, each looking up
+    their position first, as Book and Repository do."""
+    for user in users:
+        if user not in queue:
+            queue.append(user)
+    for user in users[1::2]:
+        queue.remove(user)
+        queue.index(users[-2])
+    while queue:
+        queue.index(queue[0])
+        queue.pop(0) if isinstance(queue, list) else queue.popleft()
+
+def bench_reservations(sizes=(1000, 10000, 50000)):
+    """A long waitlist held as the old list and as a ReservationQueue."""
+    from models import ReservationQueue
+    for size in sizes:
+        users = ['user%d' % i for i in range(size)]
+        for name, queue in (('list', []), ('queue', ReservationQueue())):
+            started = timer()
+            waitlist(queue, users)
+            print('reservations: %6d users, %-5s %8.3fs' % (size, name, timer() - started))
+
+def bench_stats(sizes=(1000, 10000, 100000)):
+    """Catalogue totals from the running counts and by a full scan, over
+    authors and publishers as many as there are books to their names."""
+    for size in sizes:
+        repository = scaled_repository(size, distinct=True)
+        books = list(repository.find())
+        for i, bk in enumerate(books[::10]):
+            bk.check_out('user%d' % (i % 50))
+        started = timer()
+        for i in range(100):
+            repository.summary()
+        summary = (timer() - started) / 100
+        started = timer()
+        borrowed = sum(1 for bk in repository.find() if bk.status() == Book.BORROWED)
+        scan = timer() - started
+        assert borrowed == repository.summary()['borrowed']
+        print('stats: %7d books, summary %.3fms, full scan %.3fms' % (size, summary * 1000, scan * 1000))
+
+def bench_facets(sizes=(1000, 10000, 100000)):
+    """A two-facet filter with its counts, from the facet index and by a
+    full scan."""
+    for size in sizes:
+        repository = scaled_repository(size)
+        books = list(repository.find())
+        for i, bk in enumerate(books[::10]):
+            bk.check_out('user%d' % (i % 50))
+        publisher = books[0].publisher
+        filters = (('status', Book.AVAILABLE), ('publisher', publisher))
+        repository.select(filters)
+        started = timer()
+        for i in range(10):
+            repository.facets.generation += 1 # defeat the counts cache
+            matches, counts = repository.select(filters)
+        indexed = (timer() - started) / 10
+        started = timer()
+        scanned = [bk for bk in repository.find()
+                   if bk.status() == Book.AVAILABLE and bk.publisher == publisher]
+        scan = timer() - started
+        assert len(scanned) == len(matches)
+        print('facets: %7d books, %6d matches: indexed %.3fms, full scan %.3fms'
+              % (size, len(matches), indexed * 1000, scan * 1000))
+
+def bench_sqlite(sizes=(10000, 100000), lookups=20000, mutations=5000):
+    """Import, lookup and mutation throughput of the in-memory and the
+    SQLite repository."""
+    import random
+    import shutil
+    import tempfile
+    from sqlite_repository import SQLiteRepository
+    directory = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            books = list(scaled_repository(size).find())
+            isbns = [bk.isbn for bk in books]
+            rng = random.Random(0)
+            sample = [rng.choice(isbns) for i in range(lookups)]
+            path = os.path.join(directory, '%d.db' % size)
+            def memory():
+                repository = Repository()
+                for bk in books:
+                    repository.store(bk.copy())
+                return repository
+            def sqlite():
+                repository = SQLiteRepository(path)
+                repository.store_many(bk.copy() for bk in books)
+                repository.close()
+                return SQLiteRepository(path)
+            for name, build in (('memory', memory), ('sqlite', sqlite)):
+                started = timer()
+                repository = build()
+                imported = timer() - started
+                rates = []
+                for label in ('cold', 'warm'):
+                    started = timer()
+                    for isbn in sample:
+                        repository.find_one(isbn)
+                    rates.append(lookups / (timer() - started))
+                started = timer()
+                for i in range(mutations):
+                    bk = repository.find_one(sample[i])
+                    if not bk.borrower:
+                        bk.check_out('user%d' % (i % 50))
+                        bk.check_in('user%d' % (i % 50))
+                changes = 2 * mutations / (timer() - started)
+                print('sqlite: %7d books, %-6s import %6.2fs, %8.0f lookups/s cold, '
+                      '%8.0f warm, %6.0f changes/s' % (size, name, imported, rates[0], rates[1], changes))
+                if name == 'sqlite':
+                    repository.close()
+    finally:
+        shutil.rmtree(directory)
+
+# ----------------------------------------------------------------------
+
+def bench_events(size=10000, transitions=20000, lags=(1, 100, 1000)):
+    """State changes with and without a change feed, and filtered reads
+    of the feed by clients `lags` events behind."""
+    from events import ChangeFeed
+    for attached in (False, True):
+        repository = scaled_repository(size)
+        books = list(repository.find())
+        feed = ChangeFeed()
+        if attached:
+            feed.attach(repository)
+        started = timer()
+        for i in range(transitions // 2):
+            bk = books[i % len(books)]
+            bk.check_out('user%d' % (i % 50))
+            bk.check_in('user%d' % (i % 50))
+        elapsed = timer() - started
+        print('events: feed %-8s %8d changes/s' % ('attached' if attached else 'off',
+                                                   transitions / elapsed))
+    for behind in lags:
+        since = feed.last_id - behind
+        isbns = set([books[0].isbn])
+        started = timer()
+        for i in range(1000):
+            feed.read(since, isbns, 'user0')
+        print('events: read %5d events behind, filtered: %.1fus' % (
+            behind, (timer() - started) / 1000 * 1e6))
+
+def bench_response_cache(requests=500):
+    """GETs of the docs, the API root and pages of books, served from the
+    response cache and rendered every time."""
+    from webtest import TestApp
+    from app import app, response_cache
+    saved = Book.repository
+    Book.repository = scaled_repository(10000)
+    try:
+        web = TestApp(app)
+        for path in ('/library/api/docs', '/library/api', '/library/api/books?limit=20',
+                     '/library/api/books?limit=100'):
+            timings = []
+            for cached in (True, False):
+                web.get(path)
+                started = timer()
+                for i in range(requests):
+                    if not cached:
+                        response_cache.clear()
+                    web.get(path)
+                timings.append((timer() - started) / requests * 1e6)
+            print('response cache: %-30s %8.1fus cached, %8.1fus rendered' % (path, timings[0], timings[1]))
+    finally:
+        Book.repository = saved
+
+BENCHMARKS = [bench_book_memory, bench_search, bench_concurrency, bench_persistence,
+              bench_links, bench_formats, bench_reservations,
+              bench_stats, bench_facets, bench_sqlite, bench_events, bench_response_cache]
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for bench in BENCHMARKS:
+        if not names or bench.__name__ in names:
+            bench()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""A reproducible benchmark suite over synthetic catalogues.
+
+    python benchsuite.py [--sizes 1000,10000,100000] [--seed 0]
+                         [--json results.json] [--compare baseline.json]
+    python benchsuite.py --write-catalogue PATH --sizes 100000
+
+Catalogues are generated from a seed, shaped like library.json: the same
+fields, with titles, authors, publishers and descriptions drawn from the
+bundled catalogue, unique ISBNs and thumbnails, and publication dates
+spread over twenty years. The same seed gives the same catalogue, and the
+same books are looked up, on every run.
+
+For each size the suite times `Repository.find_one`, `Book.to_json`
+(with the representation cache cold and warm), `get_options`, `links`,
+and, through WebTest, listing pages of `/library/api/books` and PUTting
+books. Results go to stdout, or `--json`, as one JSON document; with
+`--compare`, each timing is checked against an earlier document and the
+exit status is 1 if any median got more than `--threshold` times slower.
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+from timeit import default_timer as timer
+
+from models import Book, Repository, RepresentationCache
+from loader import book_from_record
+from benchmarks import LIBRARY, library_records, percentile
+
+PREFIX = 'http://localhost/library/api'
+FIRST_DATE = 631152000000   # 1990-01-01, in milliseconds
+DATE_SPAN = 20 * 365 * 86400 * 1000
+THUMBNAIL = ('http://bks%d.books.google.co.uk/books?id=%s&printsec=frontcover'
+             '&img=1&zoom=%d&edge=curl&source=gbs_api')
+
+# ----------------------------------------------------------------------
+
+def isbn13(number):
+    """An ISBN-13 starting 978 with a valid check digit."""
+    digits = '978%09d' % number
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits))
+    return digits + str(-total % 10)
+
+class Vocabulary(object):
+    """What synthetic records are made of, taken from a catalogue."""
+    def __init__(self, path=LIBRARY):
+        records = library_records(path)
+        self.words = sorted(set(word for r in records for word in r.get('title', '').split()))
+        self.descriptions = sorted(set(r.get('description', '') for r in records))
+        self.publishers = sorted(set(r.get('publisher', '') for r in records))
+        authors = sorted(set(r['author'] for r in records if r.get('author')))
+        self.first_names = sorted(set(a.split()[0] for a in authors))
+        self.surnames = sorted(set(a.split()[-1] for a in authors))
+
+def synthetic_records(size, seed=0, vocabulary=None):
+    """Yield `size` records shaped like the lines of library.json."""
+    if vocabulary is None:
+        vocabulary = Vocabulary()
+    rng = random.Random(seed)
+    authors = ['%s %s' % (rng.choice(vocabulary.first_names), rng.choice(vocabulary.surnames))
+               for i in range(max(10, size // 5))]
+    for i in range(size):
+        volume = '%012x' % rng.getrandbits(48)
+        record = {
+            'ISBN': isbn13(i),
+            '_id': {'$oid': '%024x' % (seed << 64 | i)},
+            'title': ' '.join(rng.sample(vocabulary.words, rng.randint(2, 6))),
+            'description': rng.choice(vocabulary.descriptions),
+            'author': authors[int(rng.paretovariate(1.2)) % len(authors)],
+            'publisher': rng.choice(vocabulary.publishers),
+            'publishedDate': {'$date': FIRST_DATE + rng.randrange(DATE_SPAN)},
+            'checkedOut': False,
+            'smallThumbnail': THUMBNAIL % (rng.randint(1, 9), volume, 5),
+            'thumbnail': THUMBNAIL % (rng.randint(1, 9), volume, 1),
+            }
+        yield record
+
+def synthetic_repository(size, seed=0, vocabulary=None):
+    repository = Repository()
+    for record in synthetic_records(size, seed, vocabulary):
+        repository.store(book_from_record(record))
+    return repository
+
+def write_catalogue(path, size, seed=0):
+    """Write a synthetic catalogue to `path`, one record per line, for
+    loading as LIBRARY_DATA."""
+    with open(path, 'w') as f:
+        for record in synthetic_records(size, seed):
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+# ----------------------------------------------------------------------
+
+def timings(name, size, call, arguments):
+    """Call `call` with each of `arguments`, timing each call."""
+    samples = []
+    for argument in arguments:
+        started = timer()
+        call(argument)
+        samples.append(timer() - started)
+    return dict(name=name, books=size, calls=len(samples),
+                mean_us=round(sum(samples) / len(samples) * 1e6, 2),
+                median_us=round(percentile(samples, 0.5) * 1e6, 2),
+                p95_us=round(percentile(samples, 0.95) * 1e6, 2),
+                min_us=round(min(samples) * 1e6, 2))
+
+def bench_size(size, seed=0, calls=1000, requests=200, vocabulary=None):
+    """Time every operation against a catalogue of `size` books."""
+    from webtest import TestApp
+    from app import app
+
+    started = timer()
+    repository = synthetic_repository(size, seed, vocabulary)
+    built = timer() - started
+    books = list(repository.find())
+    rng = random.Random(seed + 1)
+    sample = [rng.choice(books) for i in range(calls)]
+    isbns = [bk.isbn for bk in sample]
+    for i, bk in enumerate(books[::10]):
+        bk.check_out('user%d' % (i % 50))
+    for i, bk in enumerate(books[5::10]):
+        bk.reserve('user%d' % (i % 50))
+
+    results = [dict(name='build', books=size, calls=1, mean_us=round(built * 1e6, 2),
+                    median_us=round(built * 1e6, 2), p95_us=round(built * 1e6, 2),
+                    min_us=round(built * 1e6, 2))]
+    results.append(timings('find_one', size, repository.find_one, isbns))
+    Book.representations = RepresentationCache(max_entries=calls)
+    results.append(timings('to_json (cold)', size,
+                           lambda bk: bk.to_json('user1', PREFIX), sample))
+    results.append(timings('to_json (warm)', size,
+                           lambda bk: bk.to_json('user1', PREFIX), sample))
+    results.append(timings('get_options', size, lambda bk: bk.get_options('user1'), sample))
+    results.append(timings('links', size, lambda bk: bk.links('user1', PREFIX), sample))
+
+    saved = Book.repository
+    Book.repository = repository
+    try:
+        web = TestApp(app)
+        offsets = [rng.randrange(max(1, size - 100)) for i in range(requests)]
+        results.append(timings('GET books (limit=20)', size,
+                               lambda offset: web.get('/library/api/books',
+                                                      dict(offset=offset, limit=20)), offsets))
+        results.append(timings('GET books (limit=100)', size,
+                               lambda offset: web.get('/library/api/books',
+                                                      dict(offset=offset, limit=100)), offsets))
+        results.append(timings('GET books (cursor, limit=20)', size,
+                               lambda offset: web.get('/library/api/books',
+                                                      dict(cursor=offset, limit=20)), offsets))
+        def update(bk):
+            body = dict(title=bk.title + ' (2nd edition)', description=bk.description, isbn=bk.isbn)
+            web.put_json('/library/api/books/' + bk.isbn, body)
+        def create(number):
+            isbn = isbn13(size + number)
+            body = dict(title='New Book %d' % number, description='DESCRIPTION', isbn=isbn)
+            web.put_json('/library/api/books/' + isbn, body, status=201)
+        results.append(timings('PUT book (update)', size, update, sample[:requests]))
+        results.append(timings('PUT book (create)', size, create, range(requests)))
+    finally:
+        Book.repository = saved
+        Book.representations = RepresentationCache()
+    return results
+
+def revision():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         stderr=subprocess.STDOUT)
+        return output.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(sizes, seed=0, calls=1000, requests=200):
+    vocabulary = Vocabulary()
+    results = []
+    for size in sizes:
+        results.extend(bench_size(size, seed, calls, requests, vocabulary))
+        sys.stderr.write('benchsuite: %d books done\n' % size)
+    return dict(suite=1, seed=seed, revision=revision(),
+                date=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                python=platform.python_version(),
+                implementation=platform.python_implementation(),
+                machine=platform.machine(),
+                results=results)
+
+def compare(baseline, current, threshold=1.25):
+    """[(name, books, baseline median, current median, ratio)] for the
+    timings in both, and whether any got more than `threshold` times
+    slower."""
+    before = dict(((r['name'], r['books']), r) for r in baseline['results'])
+    rows = []
+    regressed = False
+    for r in current['results']:
+        old = before.get((r['name'], r['books']))
+        if old is None:
+            continue
+        ratio = r['median_us'] / old['median_us'] if old['median_us'] else float('inf')
+        regressed = regressed or ratio > threshold
+        rows.append((r['name'], r['books'], old['median_us'], r['median_us'], ratio))
+    return rows, regressed
+
+# ----------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the library on synthetic catalogues.')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='catalogue sizes, comma-separated (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--calls', type=int, default=1000,
+                        help='calls timed per model operation (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests timed per route (default: %(default)s)')
+    parser.add_argument('--json', help='write the results here instead of stdout')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown that counts as a regression (default: %(default)s)')
+    parser.add_argument('--write-catalogue', metavar='PATH',
+                        help='write a catalogue of the (first) size to PATH and stop')
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    if args.write_catalogue:
+        write_catalogue(args.write_catalogue, sizes[0], args.seed)
+        return 0
+    results = run(sizes, args.seed, args.calls, args.requests)
+    document = json.dumps(results, indent=2, sort_keys=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(document + '\n')
+    else:
+        print(document)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows, regressed = compare(baseline, results, args.threshold)
+        for name, books, old, new, ratio in rows:
+            sys.stderr.write('%-24s %8d books %10.1fus -> %10.1fus  x%.2f%s\n' % (
+                name, books, old, new, ratio, '  SLOWER' if ratio > args.threshold else ''))
+        return 1 if regressed else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
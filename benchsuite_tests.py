@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+from nose.tools import assert_equals, assert_in
+
+from models import Book
+import benchsuite
+
+# ----------------------------------------------------------------------
+
+def test_catalogues_are_reproducible():
+    first = list(benchsuite.synthetic_records(100, seed=3))
+    assert_equals(first, list(benchsuite.synthetic_records(100, seed=3)))
+    assert first != list(benchsuite.synthetic_records(100, seed=4))
+    assert_equals(100, len(set(record['ISBN'] for record in first)))
+
+def test_records_load_like_the_catalogue():
+    repository = benchsuite.synthetic_repository(50)
+    bk = repository.find_one(benchsuite.isbn13(7))
+    assert bk.title and bk.author and bk.thumbnail
+    assert '1990' <= bk.published_date[:4] <= '2010'
+    assert_equals('9780306406157', benchsuite.isbn13(30640615))
+
+def test_every_operation_is_timed():
+    saved = Book.repository
+    results = benchsuite.bench_size(50, calls=10, requests=3)
+    assert Book.repository is saved
+    names = [r['name'] for r in results]
+    for name in ('find_one', 'to_json (cold)', 'get_options', 'links',
+                 'GET books (limit=20)', 'PUT book (update)', 'PUT book (create)'):
+        assert_in(name, names)
+    assert all(r['books'] == 50 and r['median_us'] > 0 for r in results)
+
+def test_compare_flags_regressions():
+    baseline = dict(results=[dict(name='find_one', books=1000, median_us=1.0),
+                             dict(name='links', books=1000, median_us=2.0)])
+    current = dict(results=[dict(name='find_one', books=1000, median_us=1.1),
+                            dict(name='links', books=1000, median_us=3.0),
+                            dict(name='links', books=10000, median_us=3.0)])
+    rows, regressed = benchsuite.compare(baseline, current, threshold=1.25)
+    assert regressed
+    assert_equals([('find_one', 1000), ('links', 1000)], [row[:2] for row in rows])
+    assert not benchsuite.compare(baseline, baseline)[1]
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""gzip/deflate compression of responses, as WSGI middleware.
+
+A response is compressed when the client's Accept-Encoding allows it, it
+is a successful JSON, NDJSON or text response without an encoding of its
+own, and its body comes to at least `threshold` bytes. Event streams
+aren't, as buffering would hold events back. Streamed bodies
+are buffered only until the threshold is reached, then compressed as
+they are produced. An empty chunk asks for what there is to be sent (a
+long-poll about to wait, say): before the threshold, the response goes
+out uncompressed; after it, the compressor is flushed. A compressed response's ETag gets the encoding
+appended ('"12-gzip"'); `identity_etag` takes it off again.
+"""
+import zlib
+from itertools import chain
+
+ENCODINGS = (('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS))
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/')
+UNBUFFERED = ('text/event-stream',)
+
+# ----------------------------------------------------------------------
+
+def choose_encoding(accept_encoding):
+    """'gzip', 'deflate' or None, whichever `accept_encoding` prefers."""
+    qualities = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for name, wbits in ENCODINGS:
+        quality = qualities.get(name, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+def header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+def encoded_etag(etag, encoding):
+    """The ETag of the `encoding`-compressed form of the representation
+    tagged `etag`: each form needs its own, as their bytes differ."""
+    if etag.endswith('"'):
+        return etag[:-1] + '-' + encoding + '"'
+    return etag
+
+def identity_etag(etag):
+    """The ETag of the uncompressed representation `etag` tags (see
+    encoded_etag)."""
+    for name, wbits in ENCODINGS:
+        suffix = '-' + name + '"'
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+def compressible(status, headers):
+    content_type = header(headers, 'Content-Type') or ''
+    return (status[:3] in ('200', '201') and header(headers, 'Content-Encoding') is None
+            and content_type.startswith(COMPRESSIBLE) and not content_type.startswith(UNBUFFERED))
+
+# ----------------------------------------------------------------------
+
+class Compressor(object):
+    """Wraps the WSGI `app`, compressing its responses."""
+    def __init__(self, app, threshold=1024, level=6):
+        self.app = app
+        self.threshold = threshold
+        self.level = level
+
+    def __call__(self, environ, start_response):
+        started = []
+        def capture(status, headers, exc_info=None):
+            started[:] = [status, headers, exc_info]
+            return lambda data: None # write() isn't supported (Bottle never uses it)
+        result = self.app(environ, capture)
+        status, headers, exc_info = started
+
+        encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        length = header(headers, 'Content-Length')
+        if not compressible(status, headers) or environ['REQUEST_METHOD'] == 'HEAD':
+            start_response(status, headers, exc_info)
+            return result
+        headers = headers + [('Vary', 'Accept-Encoding')]
+        if encoding is None or (length is not None and int(length) < self.threshold):
+            start_response(status, headers, exc_info)
+            return result
+        return self.compress(result, encoding, status, headers, start_response)
+
+    def compress(self, result, encoding, status, headers, start_response):
+        try:
+            iterator = iter(result)
+            buffered = []
+            size = 0
+            for chunk in iterator:
+                if not chunk:
+                    # Wanted now, small as it is: send it as it is.
+                    start_response(status, headers)
+                    yield b''.join(buffered)
+                    for chunk in chain([chunk], iterator):
+                        yield chunk
+                    return
+                buffered.append(chunk)
+                size += len(chunk)
+                if size >= self.threshold:
+                    break
+            else:
+                # All of it, and still too small to be worth it.
+                start_response(status, headers)
+                yield b''.join(buffered)
+                return
+
+            headers = [(name, encoded_etag(value, encoding) if name.lower() == 'etag' else value)
+                       for name, value in headers if name.lower() != 'content-length']
+            headers.append(('Content-Encoding', encoding))
+            start_response(status, headers)
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, dict(ENCODINGS)[encoding])
+            for chunk in chain(buffered, iterator):
+                if not chunk:
+                    yield compressor.flush(zlib.Z_SYNC_FLUSH)
+                    yield chunk
+                    continue
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+from nose.tools import assert_equals, assert_not_in
+import zlib
+
+from compression import Compressor, choose_encoding, identity_etag
+
+# ----------------------------------------------------------------------
+
+def get(chunks, accept_encoding=None, content_type='application/json', status='200 OK',
+        etag='"12"'):
+    """Run a Compressor over an app answering `chunks`; returns the
+    response headers and body. (WebTest would decode the body itself.)"""
+    def app(environ, start_response):
+        start_response(status, [('Content-Type', content_type), ('ETag', etag)])
+        return iter(chunks)
+    environ = {'REQUEST_METHOD': 'GET'}
+    if accept_encoding is not None:
+        environ['HTTP_ACCEPT_ENCODING'] = accept_encoding
+    started = []
+    body = b''.join(Compressor(app, threshold=100)(environ, lambda *args: started.extend(args)))
+    return dict(started[1]), body
+
+def test_choose_encoding():
+    assert_equals('gzip', choose_encoding('gzip, deflate'))
+    assert_equals('deflate', choose_encoding('deflate'))
+    assert_equals('deflate', choose_encoding('gzip;q=0.5, deflate'))
+    assert_equals('gzip', choose_encoding('*'))
+    assert_equals(None, choose_encoding('gzip;q=0, identity'))
+    assert_equals(None, choose_encoding(''))
+
+def test_large_streamed_body_is_gzipped():
+    chunks = [b'{"n": %d}\n' % i for i in range(100)]
+    headers, body = get(chunks, 'gzip')
+    assert_equals('gzip', headers['Content-Encoding'])
+    assert_equals('Accept-Encoding', headers['Vary'])
+    assert_equals(b''.join(chunks), zlib.decompress(body, 16 + zlib.MAX_WBITS))
+
+def test_deflate():
+    chunks = [b'x' * 1000]
+    headers, body = get(chunks, 'deflate')
+    assert_equals('deflate', headers['Content-Encoding'])
+    assert_equals(b'x' * 1000, zlib.decompress(body))
+
+def test_compressed_forms_have_etags_of_their_own():
+    headers, body = get([b'x' * 1000], 'gzip')
+    assert_equals('"12-gzip"', headers['ETag'])
+    headers, body = get([b'x' * 1000], 'deflate', etag='W/"12"')
+    assert_equals('W/"12-deflate"', headers['ETag'])
+    assert_equals('"12"', get([b'{}'], 'gzip')[0]['ETag'])
+    assert_equals('"12"', identity_etag('"12-gzip"'))
+    assert_equals('W/"12"', identity_etag('W/"12-deflate"'))
+    assert_equals('"12"', identity_etag('"12"'))
+
+def test_small_body_is_sent_as_is():
+    headers, body = get([b'{}', b'[]'], 'gzip')
+    assert_not_in('Content-Encoding', headers)
+    assert_equals(b'{}[]', body)
+
+def test_empty_chunk_sends_what_there_is():
+    # Before the threshold: uncompressed, rather than held back.
+    headers, body = get([b'{', b'', b'x' * 1000, b'}'], 'gzip')
+    assert_not_in('Content-Encoding', headers)
+    assert_equals(b'{' + b'x' * 1000 + b'}', body)
+
+    # After it: everything so far can be decompressed.
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return iter([b'x' * 1000, b'', b'y' * 1000])
+    chunks = Compressor(app, threshold=100)({'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': 'gzip'},
+                                            lambda *args: None)
+    sent = b''
+    for chunk in chunks:
+        if not chunk:
+            break
+        sent += chunk
+    assert_equals(b'x' * 1000, zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(sent))
+
+def test_only_compressible_successes():
+    for content_type, status in (('image/png', '200 OK'),
+                                 ('application/json', '404 Not Found')):
+        headers, body = get([b'x' * 1000], 'gzip', content_type, status)
+        assert_not_in('Content-Encoding', headers)
+
+def test_not_without_accept_encoding():
+    headers, body = get([b'x' * 1000])
+    assert_not_in('Content-Encoding', headers)
+    assert_equals(b'x' * 1000, body)
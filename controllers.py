@@ -1,65 +1,510 @@
-from bottle import route, request, response, get, post, put, abort
+from bottle import (route, request, response, get, post, put, abort, redirect,
+                    static_file, HTTPError, HTTPResponse, http_date, parse_date)
 import json
-from models import Book
+import math
+import threading
+import time
+try:
+    from urllib.parse import urlencode, quote
+except ImportError: # Python 2
+    from urllib import urlencode, quote
+from models import Book, VersionConflictError, clock
+from facets import FACETS
+from metrics import METRICS
+from thumbnails import THUMBNAILS
+from events import FEED
+from compression import identity_etag
 from markdown import markdown
 
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+FORMATS = ('compact', 'pretty', 'ndjson')
+NDJSON = 'application/x-ndjson'
+THUMBNAIL_MAX_AGE = 30 * 86400
+RANKINGS = ('publishers', 'authors')  # counted by name in /stats, and paged under it
+LONG_POLL_SECONDS = 30
+MAX_LONG_POLL_SECONDS = 60
+STREAM_SECONDS = 300    # then the client reconnects, with Last-Event-ID
+HEARTBEAT_SECONDS = 15
+MAX_BLOCKED_WAITERS = 8 # request threads long-polls and streams may hold (see feed_waiter)
+
+MAX_PREFIXES = 256
+_prefixes = {}
+
 def get_prefix(request, path='/library/api'):
+    # Cached on the parts of the environ that request.urlparts reads.
+    environ = request.environ
+    key = (environ.get('HTTP_X_FORWARDED_PROTO'), environ.get('wsgi.url_scheme'),
+           environ.get('HTTP_X_FORWARDED_HOST'), environ.get('HTTP_HOST'),
+           environ.get('SERVER_NAME'), environ.get('SERVER_PORT'), path)
+    prefix = _prefixes.get(key)
+    if prefix is not None:
+        return prefix
+
     urlparts = request.urlparts
     protocol = urlparts[0]
     domain = urlparts[1]
     if domain.endswith(':80'):
         domain = domain[:-3]
 
-    return "%s://%s%s" % (protocol, domain, path)
+    if len(_prefixes) >= MAX_PREFIXES: # the Host header is the client's to choose
+        _prefixes.clear()
+    prefix = _prefixes[key] = "%s://%s%s" % (protocol, domain, path)
+    return prefix
+
+def etag_for(version, format='compact'):
+    """The ETag of the `format` representation of `version`: the formats'
+    bytes differ, so their tags must too."""
+    if format == 'compact':
+        return '"%d"' % version
+    return '"%d-%s"' % (version, format)
+
+def etag_matches(header, etag, weak=True):
+    """Weak comparison of `etag` against an If-None-Match list, or strong
+    comparison (for If-Match, weak=False), where weak tags never match.
+    Tags of compressed forms match the uncompressed one's."""
+    candidates = [identity_etag(tag.strip()) for tag in header.split(',')]
+    if not weak:
+        return '*' in candidates or etag in candidates
+    return '*' in candidates or etag in [tag[2:] if tag.startswith('W/') else tag
+                                         for tag in candidates]
+
+def not_modified_since(version, modified, format):
+    """Set the validators for the `format` representation of `version`,
+    answering 304 if the client's copy is still current."""
+    etag = etag_for(version, format)
+    headers = {'ETag': etag, 'Last-Modified': http_date(modified), 'Vary': 'Accept'}
+    for name, value in headers.items():
+        response.set_header(name, value)
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        current = etag_matches(if_none_match, etag)
+    else:
+        since = parse_date(request.headers.get('If-Modified-Since', ''))
+        current = since is not None and int(modified) <= since
+    if current:
+        raise HTTPResponse(status=304, headers=headers)
 
-@get('/library/api/')
-@get('/library/api')
+@get('/library/api/', cache='static')
+@get('/library/api', cache='static')
 def library_api_root():
     prefix = get_prefix(request)
     return dict(
         documentation=prefix + "/docs",
         services=dict(
             books=prefix + "/books",
-            users=prefix + "/users"
+            users=prefix + "/users",
+            events=prefix + "/events",
+            stats=prefix + "/stats"
             )
         )
 
-@get('/library/api/docs')
+@get('/library/api/docs', cache='static')
 def docs():
     from os.path import split, join
-    return markdown(open(join(split(__file__)[0], 'library_app.md'), 'r').read())
+    with open(join(split(__file__)[0], 'library_app.md'), 'r') as f:
+        return markdown(f.read())
+
+def get_format(request):
+    """The representation asked for, by `?format=` or else by Accept."""
+    format = request.query.get('format')
+    if format is None:
+        return 'ndjson' if NDJSON in request.headers.get('Accept', '') else 'compact'
+    if format not in FORMATS:
+        abort(400, "'format' must be one of %s." % ', '.join(FORMATS))
+    return format
+
+def set_content_type(format):
+    response.set_header('Content-Type', NDJSON if format == 'ndjson' else 'application/json')
+    response.set_header('Vary', 'Accept')
+
+def book_json(bk, prefix, format):
+    if format == 'ndjson':
+        return bk.to_json(prefix=prefix) + '\n'
+    return bk.to_json(prefix=prefix, pretty=format == 'pretty')
+
+def get_page(request):
+    try:
+        offset = int(request.query.get('offset', 0))
+        limit = int(request.query.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(400, "'offset' and 'limit' must be integers.")
+    if offset < 0 or limit < 1:
+        abort(400, "'offset' must be >= 0 and 'limit' must be >= 1.")
+    return offset, min(limit, MAX_PAGE_SIZE)
+
+def get_cursor(request):
+    """The listing position to page from (see Repository.page_at), or None."""
+    cursor = request.query.get('cursor')
+    if cursor is None:
+        return None
+    try:
+        cursor = int(cursor)
+    except ValueError:
+        cursor = -1
+    if cursor < 0:
+        abort(400, "'cursor' must be one given in a 'next' link, or 0.")
+    return cursor
+
+def page_links(href, offset, limit, total, query=''):
+    page_href = href + '?' + query.replace('%', '%%') + 'offset=%d&limit=%d'
+    ret = [dict(rel='self', href=page_href % (offset, limit))]
+    if offset + limit < total:
+        ret.append(dict(rel='next', href=page_href % (offset + limit, limit)))
+    if offset > 0:
+        ret.append(dict(rel='prev', href=page_href % (max(offset - limit, 0), limit)))
+    return ret
 
-@get('/library/api/books/')
-@get('/library/api/books')
+def cursor_links(href, cursor, limit, next_cursor):
+    page_href = href + '?cursor=%d&limit=%d'
+    ret = [dict(rel='self', href=page_href % (cursor, limit))]
+    if next_cursor is not None:
+        ret.append(dict(rel='next', href=page_href % (next_cursor, limit)))
+    return ret
+
+def get_filters(request):
+    """[(facet, value)] for each facet filter in the query string."""
+    filters = []
+    for facet in FACETS:
+        value = request.query.getunicode(facet)
+        if value is not None:
+            filters.append((facet, value))
+    return filters
+
+def stream_page(links, total, bks, prefix, pretty=False, facets=None):
+    """Yield a page of books as JSON, one book at a time."""
+    if pretty:
+        yield '{"_links": %s, "total": %d, ' % (json.dumps(links), total)
+        if facets is not None:
+            yield '"facets": %s, ' % json.dumps(facets, sort_keys=True)
+        yield '"books": ['
+    else:
+        yield '{"_links":%s,"total":%d,' % (json.dumps(links, separators=(',', ':')), total)
+        if facets is not None:
+            yield '"facets":%s,' % json.dumps(facets, separators=(',', ':'), sort_keys=True)
+        yield '"books":['
+
+    separator = ''
+    for bk in bks:
+        yield separator + bk.to_json(prefix=prefix, pretty=pretty)
+        separator = ',\n' if pretty else ','
+    yield ']}'
+
+def stream_lines(bks, prefix):
+    """Yield a page of books as newline-delimited JSON."""
+    for bk in bks:
+        yield bk.to_json(prefix=prefix) + '\n'
+
+@get('/library/api/books/', cache='catalogue')
+@get('/library/api/books', cache='catalogue')
 def books():
-    response.set_header('Content-Type', 'application/json')
+    format = get_format(request)
+    set_content_type(format)
     prefix = get_prefix(request)
-    bks = [bk.to_json(prefix=prefix) for bk in Book.find()]
-    return '[' + ',\n'.join(bks) + ']'
+    offset, limit = get_page(request)
+    cursor = get_cursor(request)
+    not_modified_since(clock.last, clock.last_modified, format)
+    q = request.query.getunicode('q', '')
+    filters = get_filters(request)
+    facets = None
+    if q or filters:
+        if cursor is not None:
+            abort(400, "'cursor' pages the whole catalogue; page searches and filters by 'offset'.")
+        matches, facets = Book.select(filters, q)
+        total = len(matches)
+        page = matches[offset:offset + limit]
+        params = [('q', q)] if q else []
+        params.extend(filters)
+        query = urlencode([(name, value.encode('utf-8')) for name, value in params]) + '&'
+        links = page_links(prefix + '/books', offset, limit, total, query)
+    elif cursor is not None:
+        total = len(Book.find())
+        page, next_cursor = Book.page_at(cursor, limit)
+        links = cursor_links(prefix + '/books', cursor, limit, next_cursor)
+    else:
+        total = len(Book.find())
+        page = Book.page(offset, limit)
+        links = page_links(prefix + '/books', offset, limit, total)
+    if format == 'ndjson':
+        # No envelope: the paging goes in the headers.
+        response.set_header('Link', ', '.join('<%s>; rel="%s"' % (link['href'], link['rel'])
+                                              for link in links))
+        response.set_header('X-Total-Count', str(total))
+        return stream_lines(page, prefix)
+    if facets is None and request.query.get('facets') in ('1', 'true'):
+        # Over the whole catalogue: only when asked, as it builds every book.
+        facets = Book.facet_counts()
+    return stream_page(links, total, page, prefix, format == 'pretty', facets)
 
 @get('/library/api/books/<book_id>')
 def book_show(book_id):
-    response.set_header('Content-Type', 'application/json')
+    format = get_format(request)
+    set_content_type(format)
     prefix = get_prefix(request)
     bk = Book.find_one(isbn=book_id)
     if bk:
-        return bk.to_json(prefix=prefix)
+        not_modified_since(bk.version, bk.modified, format)
+        return book_json(bk, prefix, format)
     else:
         response.set_header('Content-Type', 'text/html')
         abort(404, "Can't find a book with that ISBN ('%s')." % book_id)
 
+@get('/library/api/books/<book_id>/thumbnail')
+def book_thumbnail(book_id):
+    bk = Book.find_one(isbn=book_id)
+    if not bk:
+        abort(404, "Can't find a book with that ISBN ('%s')." % book_id)
+    size = request.query.get('size', 'large')
+    if size not in ('small', 'large'):
+        abort(400, "'size' must be small or large.")
+    url = bk.small_thumbnail if size == 'small' else bk.thumbnail
+    if not url:
+        abort(404, "This book has no thumbnail.")
+    name = THUMBNAILS.find(url)
+    if name is not None:
+        # static_file answers conditional and Range requests, and hands the
+        # open file to the server's wsgi.file_wrapper (sendfile, where the
+        # server has it).
+        digest = name.split('/')[-1].split('.')[0]
+        served = static_file(name, root=THUMBNAILS.store.objects, etag='"%s"' % digest,
+                             headers={'Cache-Control': 'public, max-age=%d' % THUMBNAIL_MAX_AGE})
+        if served.status_code != 404: # else evicted just now
+            return served
+    # Not stored (yet): send the client to the original for now.
+    response.set_header('Cache-Control', 'no-cache')
+    redirect(url, 307)
+
 @put('/library/api/books/<book_id>')
 def book_put(book_id):
-    response.set_header('Content-Type', 'application/json')
+    format = get_format(request)
+    set_content_type(format)
     prefix = get_prefix(request)
     bk_input = request.json
     book = Book.find_one(isbn=bk_input['isbn'])
+    if_match = request.headers.get('If-Match')
+    if if_match is not None and not book:
+        abort(412, "The book has changed since it was fetched.")
     if book:
-        book.title = bk_input['title']
-        book.description = bk_input['description']
+        # Compared under the book's lock, so of two writers sending the
+        # same ETag only one succeeds. Any format's tag of the current
+        # version will do.
+        matches = None
+        if if_match is not None:
+            matches = lambda version: any(etag_matches(if_match, etag_for(version, f), weak=False)
+                                          for f in FORMATS)
+        try:
+            book.update(if_version=matches, title=bk_input['title'],
+                        description=bk_input['description'])
+        except VersionConflictError:
+            abort(412, "The book has changed since it was fetched.")
     else:
         response.status = 201
         book = Book(bk_input['title'], bk_input['description'], bk_input['isbn'])
-    Book.store(book)
+        Book.store(book)
     response.set_header('Location', prefix + '/books/' + book.isbn)
-    return book.to_json(prefix)
+    response.set_header('ETag', etag_for(book.version, format))
+    response.set_header('Last-Modified', http_date(book.modified))
+    return book_json(book, prefix, format)
+
+@post('/library/api/batch')
+def batch():
+    body = request.json
+    if not isinstance(body, dict) or not isinstance(body.get('operations'), list):
+        abort(400, "Expected a JSON object with a list of 'operations'.")
+    operations = body['operations']
+    if not all(isinstance(op, dict) for op in operations):
+        abort(400, "Each operation must be a JSON object.")
+    applied, results = Book.apply_batch(operations, atomic=bool(body.get('atomic')))
+    if not applied:
+        response.status = 409
+    return dict(applied=applied, results=results)
+
+def book_summary(bk, prefix, **extra):
+    return dict(isbn=bk.isbn, title=bk.title,
+                _links=[dict(rel='self', href=prefix + '/books/' + bk.isbn)], **extra)
+
+def user_href(prefix, name):
+    return prefix + '/users/' + quote(name.encode('utf-8'), safe='')
+
+@get('/library/api/users/', cache='catalogue')
+@get('/library/api/users', cache='catalogue')
+def users():
+    prefix = get_prefix(request)
+    return dict(users=[dict(name=name, _links=[dict(rel='self', href=user_href(prefix, name))])
+                       for name in Book.users()])
+
+@get('/library/api/users/<name>', cache='catalogue')
+def user_show(name):
+    prefix = get_prefix(request)
+    return dict(
+        name=name,
+        borrowed=[book_summary(bk, prefix) for bk in Book.borrowed_by(name)],
+        reservations=[book_summary(bk, prefix, position=position)
+                      for bk, position in Book.reserved_by(name)],
+        _links=[dict(rel='self', href=user_href(prefix, name))]
+        )
+
+def get_feed_query(request, default_timeout, max_timeout):
+    """(since, isbns, user, timeout) from the query string; `since`
+    defaults to the Last-Event-ID header, then to now."""
+    try:
+        since = int(request.query.get('since') or request.headers.get('Last-Event-ID') or FEED.last_id)
+        timeout = float(request.query.get('timeout', default_timeout))
+    except ValueError:
+        abort(400, "'since' must be an integer and 'timeout' a number.")
+    if math.isnan(timeout) or math.isinf(timeout):
+        abort(400, "'timeout' must be a finite number.")
+    isbns = frozenset(request.query.getall('isbn')) or None
+    user = request.query.getunicode('user') or None
+    return since, isbns, user, min(max(timeout, 0), max_timeout)
+
+_blocked_waiters = threading.BoundedSemaphore(MAX_BLOCKED_WAITERS)
+
+class FeedWaiter(object):
+    """How one long-poll or event stream waits for FEED (see feed_waiter).
+    Iterate `wait(...)`, passing on what it yields; `close()` when done."""
+    def __init__(self, suspend=None, slot=None):
+        self.suspend = suspend
+        self.slot = slot
+        self.can_wait = suspend is not None or slot is not None
+
+    def wait(self, since, isbns, user, seconds):
+        """Return (or yield an empty chunk, to have the server suspend the
+        response) once there may be an event after `since`, or after
+        `seconds`."""
+        if self.suspend is not None:
+            self.suspend(lambda wake: FEED.watch(since, wake), seconds)
+            yield b''
+        elif self.slot is not None:
+            FEED.wait(since, isbns, user, seconds)
+
+    def close(self):
+        if self.slot is not None:
+            self.slot.release()
+            self.slot = None
+
+def feed_waiter(environ):
+    """A FeedWaiter for the request: suspending the response on a server
+    that can (aioserver), so that waiting holds no thread; else holding one
+    of at most MAX_BLOCKED_WAITERS request threads of a multithreaded
+    server (503 once they are all taken); and on a single-threaded server,
+    where one waiter would hold up everybody, not waiting at all."""
+    if environ.get('aioserver.suspend') is not None:
+        return FeedWaiter(suspend=environ['aioserver.suspend'])
+    if not environ.get('wsgi.multithread'):
+        return FeedWaiter()
+    if not _blocked_waiters.acquire(False):
+        raise HTTPError(503, 'Too many clients waiting for events; try again shortly.',
+                        Retry_After='1')
+    return FeedWaiter(slot=_blocked_waiters)
+
+@get('/library/api/events')
+def events():
+    """Long-polling: the events after `since`, waiting for one if there
+    are none yet."""
+    prefix = get_prefix(request)
+    since, isbns, user, timeout = get_feed_query(request, LONG_POLL_SECONDS, MAX_LONG_POLL_SECONDS)
+    response.set_header('Content-Type', 'application/json')
+    response.set_header('Cache-Control', 'no-store')
+    return poll_events(prefix, since, isbns, user, timeout, feed_waiter(request.environ))
+
+def poll_events(prefix, since, isbns, user, seconds, waiter):
+    """Yield the long-poll response, as bytes: it may be resumed on
+    another thread, where Bottle's thread locals aren't this request's."""
+    try:
+        deadline = time.time() + seconds
+        yield b'{'
+        while True:
+            found, last_id, reset = FEED.read(since, isbns, user)
+            remaining = deadline - time.time()
+            if found or reset or remaining <= 0 or not waiter.can_wait:
+                break
+            since = last_id # nothing there matched; don't look at it again
+            for chunk in waiter.wait(since, isbns, user, remaining):
+                yield chunk
+    finally:
+        waiter.close()
+    params = [('isbn', isbn) for isbn in sorted(isbns or ())]
+    if user:
+        params.append(('user', user.encode('utf-8')))
+    params.append(('since', last_id))
+    links = [dict(rel='next', href=prefix + '/events?' + urlencode(params))]
+    yield ('"_links":%s,"last_id":%d,"reset":%s,"events":[%s]}' % (
+        json.dumps(links, separators=(',', ':')), last_id, 'true' if reset else 'false',
+        ','.join(event.json for event in found))).encode('utf-8')
+
+@get('/library/api/events/stream')
+def events_stream():
+    """The events after `since` as Server-Sent Events, as they happen."""
+    since, isbns, user, timeout = get_feed_query(request, STREAM_SECONDS, STREAM_SECONDS)
+    response.set_header('Content-Type', 'text/event-stream; charset=utf-8')
+    response.set_header('Cache-Control', 'no-store')
+    return stream_events(since, isbns, user, timeout, feed_waiter(request.environ))
+
+def stream_events(since, isbns, user, seconds, waiter):
+    """Yield events in the text/event-stream format for `seconds` (or,
+    if `waiter` can't wait, those there are), as bytes, like poll_events.
+    Each batch is followed by an empty chunk, which has servers that
+    buffer (aioserver) send what they have."""
+    try:
+        deadline = time.time() + seconds
+        yield b'retry: 3000\n\n'
+        yield b''
+        sent = time.time()
+        while True:
+            found, since, reset = FEED.read(since, isbns, user)
+            if reset:
+                message = 'id: %d\nevent: reset\ndata: {"last_id":%d}\n\n' % (since, since)
+            elif found:
+                message = ''.join('id: %d\ndata: %s\n\n' % (event.id, event.json) for event in found)
+            elif time.time() - sent >= HEARTBEAT_SECONDS:
+                message = ': keep-alive\n\n'
+            else:
+                message = None
+            if message is not None:
+                sent = time.time()
+                yield message.encode('utf-8')
+                yield b''
+            remaining = deadline - time.time()
+            if remaining <= 0 or not waiter.can_wait:
+                return
+            for chunk in waiter.wait(since, isbns, user,
+                                     min(remaining, sent + HEARTBEAT_SECONDS - time.time())):
+                yield chunk
+    finally:
+        waiter.close()
+
+@get('/library/api/metrics')
+def metrics():
+    response.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    return METRICS.render()
+
+@get('/library/api/stats', cache='catalogue')
+def stats():
+    prefix = get_prefix(request)
+    try:
+        top = min(int(request.query.get('top', 10)), MAX_PAGE_SIZE)
+    except ValueError:
+        abort(400, "'top' must be an integer.")
+    summary = Book.summary(max(top, 0))
+    for field in RANKINGS:
+        summary[field] = [dict(name=name, books=count) for name, count in summary[field]]
+    summary['most_reserved'] = [book_summary(bk, prefix, reservations=count)
+                                for bk, count in summary['most_reserved']]
+    summary['_links'] = [dict(rel='self', href=prefix + '/stats')]
+    summary['_links'].extend(dict(rel=field, href=prefix + '/stats/' + field)
+                             for field in RANKINGS)
+    return summary
+
+@get('/library/api/stats/<field>', cache='catalogue')
+def ranking(field):
+    if field not in RANKINGS:
+        abort(404, "No such ranking.")
+    prefix = get_prefix(request)
+    offset, limit = get_page(request)
+    total, page = Book.ranking(field, offset, limit)
+    result = {field: [dict(name=name, books=count) for name, count in page]}
+    result['total'] = total
+    result['_links'] = page_links(prefix + '/stats/' + field, offset, limit, total)
+    return result
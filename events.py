@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""A feed of changes to the catalogue, for clients to wait on instead of
+polling books.
+
+`ChangeFeed.book_changed` is a Repository listener: each book stored,
+deleted, checked out, checked in, reserved or un-reserved (including
+reservations expiring) becomes an event, numbered, holding the book's
+state after the change. The feed keeps the last `capacity` events;
+clients read the events after the last one they saw, optionally only
+those about some books or involving a user, and can wait for more
+(controllers.events and events_stream serve them by long-polling and as
+Server-Sent Events), or be woken when there are (`watch`).
+
+Event ids keep increasing across restarts of a durable catalogue, being
+no lower than the catalogue's clock. A client whose last id has dropped
+out of the buffer (or is from some other run) is told to `reset`: to
+fetch the state it cares about afresh.
+"""
+import json
+import threading
+import time
+from collections import deque
+
+from models import clock
+
+DEFAULT_CAPACITY = 10000
+MAX_EVENTS = 100    # returned by one read
+
+# ----------------------------------------------------------------------
+
+class Event(object):
+    """One change, rendered to JSON when first read (and then once for
+    every client reading it)."""
+    __slots__ = ('id', 'isbn', 'user', '_data', '_json')
+
+    def __init__(self, id, action, isbn, book, user):
+        self.id = id
+        self.isbn = isbn
+        self.user = user or ''
+        if action == 'delete':
+            borrower, reservations, status = '', (), None
+        else:
+            borrower, reservations, status = book.borrower, tuple(book.reservations), book.status()
+        self._data = (action, status, borrower, reservations, time.time())
+        self._json = None
+
+    def involves(self, user):
+        """Whether `user` made the change, or is the borrower or a
+        reserver after it."""
+        action, status, borrower, reservations, when = self._data
+        return user == self.user or user == borrower or user in reservations
+
+    def matches(self, isbns, user):
+        return (not isbns or self.isbn in isbns) and (not user or self.involves(user))
+
+    @property
+    def json(self):
+        if self._json is None:
+            action, status, borrower, reservations, when = self._data
+            self._json = json.dumps(dict(id=self.id, action=action, isbn=self.isbn, user=self.user,
+                                         status=status, borrower=borrower,
+                                         reservations=list(reservations), time=when),
+                                    separators=(',', ':'), sort_keys=True)
+        return self._json
+
+class ChangeFeed(object):
+    """The last `capacity` changes to the books in the repositories it is
+    attached to. Thread-safe."""
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self._events = deque(maxlen=capacity)
+        self._condition = threading.Condition()
+        self._attached = []
+        self._watchers = []
+        self.last_id = 0
+        self.dropped = 0    # the id of the last event to fall out of the buffer
+
+    def attach(self, repository):
+        """Subscribe to `repository`'s changes, once."""
+        with self._condition:
+            if any(attached is repository for attached in self._attached):
+                return
+            self._attached.append(repository)
+        repository.subscribe(self.book_changed)
+
+    def book_changed(self, action, isbn, book, user=None):
+        with self._condition:
+            # Versions are ticked before the change is published, by several
+            # threads: take the clock as a floor, not as the id itself.
+            self.last_id = max(self.last_id + 1, clock.last)
+            if len(self._events) == self._events.maxlen:
+                self.dropped = self._events[0].id
+            self._events.append(Event(self.last_id, action, isbn, book, user))
+            self._condition.notify_all()
+            watchers, self._watchers = self._watchers, []
+        for wake in watchers:
+            wake()
+
+    def read(self, since, isbns=None, user=None, limit=MAX_EVENTS):
+        """(events, last id, reset): up to `limit` Events after `since`
+        about one of `isbns` (any book, if None) involving `user` (anyone,
+        if None), oldest first; the id to read on from; and whether events
+        since `since` have been lost."""
+        with self._condition:
+            if since < self.dropped or since > self.last_id:
+                return [], self.last_id, True
+            found = []
+            for event in reversed(self._events):
+                if event.id <= since:
+                    break
+                found.append(event)
+            found.reverse()
+            matching = []
+            for event in found:
+                if event.matches(isbns, user):
+                    if len(matching) == limit:
+                        return matching, previous, False
+                    matching.append(event)
+                    previous = event.id
+            return matching, self.last_id, False
+
+    def watch(self, since, wake):
+        """Call `wake()` once there is an event after `since`: at once if
+        there already is, else from the thread adding the next one. Returns
+        a function that cancels the watch. For servers that wait without
+        holding a thread (aioserver)."""
+        with self._condition:
+            if self.last_id <= since:
+                self._watchers.append(wake)
+                return lambda: self._cancel(wake)
+        wake()
+        return lambda: None
+
+    def _cancel(self, wake):
+        with self._condition:
+            if wake in self._watchers:
+                self._watchers.remove(wake)
+
+    def wait(self, since, isbns=None, user=None, timeout=30, limit=MAX_EVENTS):
+        """As read, but waiting up to `timeout` seconds for an event."""
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                events, last_id, reset = self.read(since, isbns, user, limit)
+                remaining = deadline - time.time()
+                if events or reset or remaining <= 0:
+                    return events, last_id, reset
+                since = last_id # nothing there matched; don't look at it again
+                self._condition.wait(remaining)
+
+FEED = ChangeFeed()
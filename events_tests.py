@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+from nose.tools import assert_equals, assert_true, assert_false
+import json
+import threading
+import time
+
+from models import Book, Repository
+from events import ChangeFeed
+
+def feed_of(repository, capacity=100):
+    feed = ChangeFeed(capacity)
+    feed.attach(repository)
+    feed.attach(repository)
+    return feed
+
+def decoded(events):
+    return [json.loads(event.json) for event in events]
+
+# ----------------------------------------------------------------------
+
+def test_events_follow_the_books():
+    r = Repository()
+    feed = feed_of(r)
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    r.store(book)
+    book.check_out('BORROWER')
+    book.reserve('RESERVER')
+    book.check_in('BORROWER')
+    r.delete('ISBN')
+
+    events, last_id, reset = feed.read(0)
+    assert_false(reset)
+    assert_equals(last_id, feed.last_id)
+    events = decoded(events)
+    assert_equals(['store', 'check_out', 'reserve', 'check_in', 'delete'],
+                  [event['action'] for event in events])
+    assert_equals(dict(action='check_in', isbn='ISBN', user='BORROWER', status='available',
+                       borrower='', reservations=['RESERVER']),
+                  dict((key, value) for key, value in events[3].items() if key not in ('id', 'time')))
+    ids = [event['id'] for event in events]
+    assert_equals(ids, sorted(set(ids)))
+
+def test_events_filtered_by_book_and_user():
+    r = Repository()
+    feed = feed_of(r)
+    one = Book('TITLE', 'DESCRIPTION', 'ISBN-1')
+    two = Book('TITLE', 'DESCRIPTION', 'ISBN-2')
+    r.store(one)
+    r.store(two)
+    one.check_out('BORROWER')
+    one.reserve('WAITER')
+    two.check_out('OTHER')
+    one.check_in('BORROWER') # WAITER is now first in the queue, and the book free
+
+    assert_equals(['store', 'check_out'],
+                  [event['action'] for event in decoded(feed.read(0, isbns=set(['ISBN-2']))[0])])
+    assert_equals(['reserve', 'check_in'],
+                  [event['action'] for event in decoded(feed.read(0, user='WAITER')[0])])
+    assert_equals(['check_out', 'reserve', 'check_in'], [event['action'] for event in
+                  decoded(feed.read(0, isbns=set(['ISBN-1']), user='BORROWER')[0])])
+
+def test_resuming_after_lost_events_resets():
+    r = Repository()
+    feed = feed_of(r, capacity=3)
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    r.store(book)
+    first = feed.last_id
+    for user in ('A', 'B', 'C'):
+        book.reserve(user)
+    events, last_id, reset = feed.read(first)
+    assert_equals((3, False), (len(events), reset))
+    book.reserve('D')
+    assert_true(feed.read(first)[2])
+    assert_equals(([], feed.last_id, True), feed.read(feed.last_id + 10))
+    assert_equals(['D'], [event['user'] for event in decoded(feed.read(last_id)[0])])
+
+def test_reads_are_limited():
+    r = Repository()
+    feed = feed_of(r)
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    r.store(book)
+    for i in range(5):
+        book.reserve('USER%d' % i)
+    events, next_id, reset = feed.read(0, limit=2)
+    assert_equals(2, len(events))
+    assert_equals(events[-1].id, next_id)
+    events, next_id, reset = feed.read(next_id, limit=10)
+    assert_equals(['USER1', 'USER2', 'USER3', 'USER4'], [event['user'] for event in decoded(events)])
+
+def test_waiting_for_an_event():
+    r = Repository()
+    feed = feed_of(r)
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    r.store(book)
+    since = feed.last_id
+    started = time.time()
+    assert_equals(([], feed.last_id, False), feed.wait(since, timeout=0.05))
+    assert time.time() - started >= 0.05
+
+    timer = threading.Timer(0.05, book.reserve, ['RESERVER'])
+    timer.start()
+    events, last_id, reset = feed.wait(since, isbns=set(['ISBN']), timeout=5)
+    timer.join()
+    assert_equals(['reserve'], [event['action'] for event in decoded(events)])
+
+def test_watching_for_an_event():
+    r = Repository()
+    feed = feed_of(r)
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    r.store(book)
+    woken = []
+    feed.watch(feed.last_id - 1, lambda: woken.append('already'))
+    assert_equals(['already'], woken)
+
+    feed.watch(feed.last_id, lambda: woken.append('next'))
+    cancel = feed.watch(feed.last_id, lambda: woken.append('cancelled'))
+    cancel()
+    book.reserve('RESERVER')
+    book.un_reserve('RESERVER')
+    assert_equals(['already', 'next'], woken)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""Facet indexes: which books have each status, publisher, author and
+year of publication, for filtering listings and counting what's in them."""
+import heapq
+from collections import OrderedDict
+
+FACETS = ('status', 'publisher', 'author', 'year')
+
+# At most this many values of each facet are counted for a listing, most
+# common first.
+FACET_LIMIT = 20
+
+# Counts for this many recent filters are kept until the index changes.
+MAX_CACHED_FILTERS = 64
+
+def facet_values(book):
+    """The book's value for each of FACETS."""
+    return (book.status(), book.publisher, book.author, book.published_date[:4])
+
+def tally(rows):
+    """Facet counts, as FacetIndex.counts gives them, of `rows` of facet
+    values (see facet_values)."""
+    totals = dict((facet, {}) for facet in FACETS)
+    columns = [totals[facet] for facet in FACETS]
+    for values in rows:
+        for column, value in zip(columns, values):
+            column[value] = column.get(value, 0) + 1
+    return most_common(totals)
+
+def most_common(totals):
+    """{facet: {value: count}} cut down to the FACET_LIMIT most common
+    values of each facet (ties going to the first in order), leaving out
+    the empty value."""
+    counts = {}
+    for facet, values in totals.items():
+        values.pop('', None) # no value, e.g. no publication date
+        counts[facet] = dict(heapq.nlargest(FACET_LIMIT, sorted(values.items()),
+                                            key=lambda item: item[1]))
+    return counts
+
+# ----------------------------------------------------------------------
+
+class FacetIndex(object):
+    """For each facet, the set of books having each value.
+
+    Books are numbered in the order the repository lists them (`place`
+    is called as an ISBN first enters the repository, `forget` as it
+    leaves), so a combined filter is a set intersection, smallest set
+    first, and sorting what's left puts it in listing order.
+    """
+    def __init__(self):
+        self._ordinals = {}     # isbn -> ordinal
+        self._isbns = {}        # ordinal -> isbn
+        self._next = 0
+        self._postings = dict((facet, {}) for facet in FACETS)  # facet -> value -> ordinals
+        self._values = {}       # ordinal -> facet values indexed for it
+        self._counts = OrderedDict()  # key -> (generation, counts)
+        self.generation = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def place(self, isbn):
+        if isbn not in self._ordinals:
+            self._ordinals[isbn] = self._next
+            self._isbns[self._next] = isbn
+            self._next += 1
+
+    def forget(self, isbn):
+        self.remove(isbn)
+        ordinal = self._ordinals.pop(isbn, None)
+        if ordinal is not None:
+            del self._isbns[ordinal]
+
+    def add(self, book):
+        self.remove(book.isbn)
+        self.place(book.isbn)
+        ordinal = self._ordinals[book.isbn]
+        values = facet_values(book)
+        for facet, value in zip(FACETS, values):
+            postings = self._postings[facet]
+            ordinals = postings.get(value)
+            if ordinals is None:
+                ordinals = postings[value] = set()
+            ordinals.add(ordinal)
+        self._values[ordinal] = values
+        self.generation += 1
+
+    def remove(self, isbn):
+        ordinal = self._ordinals.get(isbn)
+        values = self._values.pop(ordinal, None)
+        if values is None:
+            return
+        for facet, value in zip(FACETS, values):
+            postings = self._postings[facet]
+            postings[value].discard(ordinal)
+            if not postings[value]:
+                del postings[value]
+        self.generation += 1
+
+    changed = add
+
+    def isbns(self, ordinals):
+        return [self._isbns[ordinal] for ordinal in ordinals]
+
+    def ordinal(self, isbn):
+        return self._ordinals[isbn]
+
+    def following(self, ordinal, limit):
+        """[(ordinal, isbn)] for up to `limit` books numbered `ordinal` or
+        later, in listing order. Skips the numbers of books since removed."""
+        isbns = self._isbns
+        found = []
+        while ordinal < self._next and len(found) < limit:
+            isbn = isbns.get(ordinal)
+            if isbn is not None:
+                found.append((ordinal, isbn))
+            ordinal += 1
+        return found
+
+    def matching(self, filters):
+        """The ordinals of the books matching every (facet, value) in
+        `filters` (every book, if there are none), in listing order."""
+        if not filters:
+            return sorted(self._values)
+        sets = sorted((self._postings[facet].get(value, ()) for facet, value in filters), key=len)
+        if not sets[0]:
+            return []
+        ordinals = set(sets[0])
+        for other in sets[1:]:
+            ordinals.intersection_update(other)
+        return sorted(ordinals)
+
+    def counts(self, ordinals=None, key=()):
+        """{facet: {value: number of books}} over `ordinals` (by default
+        every book), keeping the FACET_LIMIT most common values of each
+        facet. Cached under `key`, which must identify `ordinals`."""
+        cached = self._counts.pop(key, None)
+        if cached is not None and cached[0] == self.generation:
+            self._counts[key] = cached
+            return cached[1]
+        if ordinals is None:
+            counts = most_common(dict((facet, dict((value, len(books)) for value, books in postings.items()))
+                                      for facet, postings in self._postings.items()))
+        else:
+            counts = tally(self._values[ordinal] for ordinal in ordinals)
+        self._counts[key] = (self.generation, counts)
+        while len(self._counts) > MAX_CACHED_FILTERS:
+            self._counts.popitem(last=False)
+        return counts
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+from nose.tools import assert_equals
+
+from models import Repository, Book
+from facets import FacetIndex
+
+# ----------------------------------------------------------------------
+
+def make_repository():
+    r = Repository()
+    r.store(Book('Learning Python', 'DESCRIPTION', 'ISBN1', author='Mark Lutz',
+                 publisher="O'Reilly Media, Inc.", published_date='2013-06-12'))
+    r.store(Book('Programming Perl', 'DESCRIPTION', 'ISBN2', author='Larry Wall',
+                 publisher="O'Reilly Media, Inc.", published_date='2012-02-17'))
+    r.store(Book('Python Cookbook', 'DESCRIPTION', 'ISBN3', author='David Beazley',
+                 publisher="O'Reilly Media, Inc.", published_date='2013-05-10'))
+    r.store(Book('Fluent Python', 'DESCRIPTION', 'ISBN4', author='Luciano Ramalho',
+                 published_date='2015'))
+    return r
+
+def isbns(books):
+    return [bk.isbn for bk in books]
+
+def test_filters_are_combined():
+    r = make_repository()
+    books, counts = r.select([('publisher', "O'Reilly Media, Inc."), ('year', '2013')])
+    assert_equals(['ISBN1', 'ISBN3'], isbns(books))
+    assert_equals({'2013': 2}, counts['year'])
+    assert_equals({'Mark Lutz': 1, 'David Beazley': 1}, counts['author'])
+    assert_equals([], r.select([('year', '2013'), ('author', 'Larry Wall')])[0])
+    assert_equals([], r.select([('author', 'Nobody')])[0])
+
+def test_counts_over_everything_skip_missing_values():
+    counts = make_repository().facet_counts()
+    assert_equals({"O'Reilly Media, Inc.": 3}, counts['publisher'])
+    assert_equals({'2012': 1, '2013': 2, '2015': 1}, counts['year'])
+    assert_equals({'available': 4}, counts['status'])
+
+def test_status_follows_borrowing():
+    r = make_repository()
+    r.find_one('ISBN2').check_out('BORROWER')
+    books, counts = r.select([('status', Book.BORROWED)])
+    assert_equals(['ISBN2'], isbns(books))
+    assert_equals({'available': 3, 'borrowed': 1}, r.facet_counts()['status'])
+    r.find_one('ISBN2').check_in('BORROWER')
+    assert_equals([], r.select([('status', Book.BORROWED)])[0])
+
+def test_filters_keep_listing_order_through_changes():
+    r = make_repository()
+    r.store(Book('Learning Python', 'DESCRIPTION', 'ISBN1', author='Mark Lutz', published_date='2013'))
+    r.delete('ISBN3')
+    r.store(Book('Python Cookbook', 'DESCRIPTION', 'ISBN3', published_date='2013'))
+    assert_equals(['ISBN1', 'ISBN3'], isbns(r.select([('year', '2013')])[0]))
+    assert_equals(isbns(r.find()), isbns(r.select([])[0]))
+
+def test_filters_narrow_a_search():
+    r = make_repository()
+    books, counts = r.select([('publisher', "O'Reilly Media, Inc.")], 'python')
+    assert_equals(['ISBN1', 'ISBN3'], sorted(isbns(books)))
+    assert_equals({'2013': 2}, counts['year'])
+
+def test_books_deleted_during_a_search_are_left_out():
+    r = make_repository()
+    search = r.search
+    def search_then_delete(query):
+        found = search(query)
+        r.delete('ISBN3') # by another thread, before select takes the lock
+        return found
+    r.search = search_then_delete
+    books, counts = r.select([('publisher', "O'Reilly Media, Inc.")], 'python')
+    assert_equals(['ISBN1'], isbns(books))
+    assert_equals({'2013': 1}, counts['year'])
+    r.search = search
+    assert_equals(['ISBN1', 'ISBN4'], sorted(isbns(r.select([], 'python')[0])))
+
+def test_lazily_stored_books_are_indexed_when_filtered():
+    r = Repository()
+    r.store_lazy('ISBN1', lambda: Book('TITLE', 'DESCRIPTION', 'ISBN1', published_date='1999'))
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN2', published_date='1999'))
+    assert_equals(['ISBN1', 'ISBN2'], isbns(r.select([('year', '1999')])[0]))
+
+def test_counts_are_cached_until_the_index_changes():
+    index = FacetIndex()
+    index.add(Book('TITLE', 'DESCRIPTION', 'ISBN1', author='AUTHOR'))
+    first = index.counts()
+    assert first is index.counts()
+    index.add(Book('TITLE', 'DESCRIPTION', 'ISBN2', author='AUTHOR'))
+    assert_equals({'AUTHOR': 2}, index.counts()['author'])
+    index.forget('ISBN1')
+    assert_equals({'AUTHOR': 1}, index.counts()['author'])
+    assert_equals(1, len(index))
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""Streaming importer for the Mongo-export catalogue (`library.json`).
+
+The export holds one JSON document per line, using Mongo's field names
+(`ISBN`, `smallThumbnail`, `publishedDate.$date`, ...). Lines are read
+through a memory map so the file is never held in memory as a whole.
+
+With `lazy=True` only the ISBN is pulled out of each line (with a regular
+expression, not a JSON parse); the Book itself is built the first time the
+repository hands it out. This lets the service start answering requests
+long before a large export has been fully parsed.
+"""
+import datetime
+import json
+import mmap
+import os
+import re
+import sys
+import time
+from functools import partial
+
+from models import Book
+
+ISBN_PATTERN = re.compile(br'"ISBN"\s*:\s*"([^"]*)"')
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# ----------------------------------------------------------------------
+
+class LoadStats(object):
+    def __init__(self, records, seconds):
+        self.records = records
+        self.seconds = seconds
+
+    @property
+    def rate(self):
+        """Records loaded per second."""
+        if not self.seconds:
+            return float(self.records)
+        return self.records / self.seconds
+
+    def __repr__(self):
+        return '<LoadStats %d records in %.3fs (%.0f records/s)>' % (
+            self.records, self.seconds, self.rate)
+
+# ----------------------------------------------------------------------
+
+def published_date(record):
+    """The `publishedDate.$date` milliseconds as a `YYYY-MM-DD` string."""
+    value = record.get('publishedDate')
+    if isinstance(value, dict):
+        value = value.get('$date')
+    if value is None:
+        return ''
+    return (EPOCH + datetime.timedelta(milliseconds=value)).strftime('%Y-%m-%d')
+
+def book_from_record(record):
+    return Book(record.get('title', ''), record.get('description', ''), record.get('ISBN', ''),
+                author=record.get('author', ''),
+                publisher=record.get('publisher', ''),
+                small_thumbnail=record.get('smallThumbnail', ''),
+                thumbnail=record.get('thumbnail', ''),
+                published_date=published_date(record))
+
+def book_from_line(line):
+    return book_from_record(json.loads(line.decode('utf-8')))
+
+def iter_lines(path):
+    """Yield the non-blank lines of `path` as bytes, via a memory map."""
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for line in iter(mm.readline, b''):
+                line = line.strip()
+                if line:
+                    yield line
+        finally:
+            mm.close()
+
+def iter_books(path):
+    for line in iter_lines(path):
+        yield book_from_line(line)
+
+class MappedCatalogue(object):
+    """`path` mapped read-only, with books built from the mapped pages.
+
+    `load_into` stores every record lazily, remembering only where its
+    line starts and ends, so the catalogue text itself stays in the
+    operating system's page cache. Processes forked afterwards share
+    those pages instead of each holding a copy (see workers.py).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.map = b''  # an empty file can't be mapped
+        if os.path.getsize(path):
+            with open(path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def book_at(self, start, end):
+        return book_from_line(self.map[start:end].strip())
+
+    def load_into(self, repository=None):
+        if repository is None:
+            repository = Book.get_repository()
+        mm = self.map
+        size = len(mm)
+        records = 0
+        started = time.time()
+        start = 0
+        while start < size:
+            end = mm.find(b'\n', start)
+            if end == -1:
+                end = size
+            match = ISBN_PATTERN.search(mm, start, end)
+            if match:
+                repository.store_lazy(match.group(1).decode('utf-8'),
+                                      partial(self.book_at, start, end))
+                records += 1
+            elif mm[start:end].strip():
+                repository.store(self.book_at(start, end))
+                records += 1
+            start = end + 1
+        return LoadStats(records, time.time() - started)
+
+    def close(self):
+        if self.map:
+            self.map.close()
+
+# ----------------------------------------------------------------------
+
+def load_library(path='library.json', repository=None, lazy=False):
+    """Stream `path` into `repository` (default: Book's repository).
+
+    Returns a LoadStats. Records sharing an ISBN collapse into one book,
+    the last one in the file winning. A repository with `store_many`
+    (an SQLiteRepository) is given the books in batches, and `lazy` is
+    ignored.
+    """
+    if repository is None:
+        repository = Book.get_repository()
+    records = 0
+    started = time.time()
+    if hasattr(repository, 'store_many'):
+        # An SQLiteRepository: batched inserts, and nothing to build lazily.
+        records = repository.store_many(iter_books(path))
+    elif lazy:
+        for line in iter_lines(path):
+            match = ISBN_PATTERN.search(line)
+            if match:
+                repository.store_lazy(match.group(1).decode('utf-8'), partial(book_from_line, line))
+            else:
+                repository.store(book_from_line(line))
+            records += 1
+    else:
+        for book in iter_books(path):
+            repository.store(book)
+            records += 1
+    return LoadStats(records, time.time() - started)
+
+# ----------------------------------------------------------------------
+
+if __name__ == '__main__':
+    from models import Repository
+    path = sys.argv[1] if len(sys.argv) > 1 else 'library.json'
+    print('eager: %r' % load_library(path, Repository()))
+    print('lazy:  %r' % load_library(path, Repository(), lazy=True))
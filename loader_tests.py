@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+from nose.tools import assert_equals
+import os
+import tempfile
+
+from models import Repository, Book
+from loader import load_library, book_from_record, iter_books, MappedCatalogue
+
+RECORDS = [
+    '{ "ISBN" : "9780596006365", "_id" : { "$oid" : "4f705e2aa018795ee3000000" }, "author" : "Adam Trachtenberg", '
+    '"checkedOut" : false, "description" : "PHP 5.", "publishedDate" : { "$date" : 1090969200000 }, '
+    '"publisher" : "O\'Reilly Media, Inc.", "smallThumbnail" : "http://example.com/small", '
+    '"thumbnail" : "http://example.com/large", "title" : "Upgrading to PHP 5" }',
+    '',
+    '{ "_id" : { "$oid" : "4f705e34a018795ee3000001" }, "title" : "Second", "ISBN" : "9780973862157", '
+    '"author" : "Cal Evans", "publishedDate" : { "$date" : 1199145600000 } }',
+    ]
+
+def write_library(lines):
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+# ----------------------------------------------------------------------
+
+def test_book_from_record_maps_mongo_fields():
+    import json
+    book = book_from_record(json.loads(RECORDS[0]))
+    assert_equals(book.isbn, '9780596006365')
+    assert_equals(book.title, 'Upgrading to PHP 5')
+    assert_equals(book.small_thumbnail, 'http://example.com/small')
+    assert_equals(book.thumbnail, 'http://example.com/large')
+    assert_equals(book.publisher, "O'Reilly Media, Inc.")
+    assert_equals(book.published_date, '2004-07-27')
+    assert_equals(book.status(), Book.AVAILABLE)
+
+def test_iter_books_skips_blank_lines():
+    path = write_library(RECORDS)
+    try:
+        assert_equals(['9780596006365', '9780973862157'], [bk.isbn for bk in iter_books(path)])
+    finally:
+        os.remove(path)
+
+def test_load_library_eager():
+    path = write_library(RECORDS)
+    try:
+        r = Repository()
+        stats = load_library(path, r)
+        assert_equals(stats.records, 2)
+        assert_equals(len(r.find()), 2)
+        assert_equals(r.find_one('9780973862157').author, 'Cal Evans')
+    finally:
+        os.remove(path)
+
+def test_load_library_lazy_hydrates_on_lookup():
+    path = write_library(RECORDS)
+    try:
+        r = Repository()
+        load_library(path, r, lazy=True)
+        assert_equals(len(r.find()), 2)
+        assert_equals(r.find_one('9780596006365').title, 'Upgrading to PHP 5')
+        assert_equals(['Upgrading to PHP 5', 'Second'], [bk.title for bk in r.find()])
+    finally:
+        os.remove(path)
+
+def test_load_library_duplicate_isbns_collapse():
+    path = write_library([RECORDS[0], RECORDS[0].replace('Upgrading to PHP 5', 'Copy')])
+    try:
+        r = Repository()
+        stats = load_library(path, r, lazy=True)
+        assert_equals(stats.records, 2)
+        assert_equals(len(r.find()), 1)
+        assert_equals(r.find_one('9780596006365').title, 'Copy')
+    finally:
+        os.remove(path)
+
+def test_mapped_catalogue_builds_books_from_the_map():
+    path = write_library(RECORDS)
+    catalogue = MappedCatalogue(path)
+    try:
+        r = Repository()
+        stats = catalogue.load_into(r)
+        assert_equals(stats.records, 2)
+        assert_equals(r._pending, 2)
+        assert_equals(r.find_one('9780973862157').author, 'Cal Evans')
+        assert_equals(['Upgrading to PHP 5', 'Second'], [bk.title for bk in r.find()])
+    finally:
+        catalogue.close()
+        os.remove(path)
+
+def test_bundled_library_loads():
+    r = Repository()
+    stats = load_library(os.path.join(os.path.dirname(__file__) or '.', 'library.json'), r)
+    assert stats.records > 0
+    assert stats.rate > 0
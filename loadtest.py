@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Load-test harness: requests/second and latency percentiles.
+
+    python loadtest.py                 compare the WSGIRef and asyncio servers
+    python loadtest.py URL [clients] [requests]
+
+In comparison mode both servers are started in this process on free
+ports, with library.json loaded, and hit with the same mix of requests.
+Each client keeps its connection alive where the server allows it.
+
+Python 3 only.
+"""
+import asyncio
+import json
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+PATHS = ['/library/api', '/library/api/books', '/library/api/books?limit=100',
+         '/library/api/books/9780596006365', '/library/api/books?q=java']
+
+# ----------------------------------------------------------------------
+
+async def read_response(reader):
+    """Read one response; returns (status, keep_alive)."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    version, status = status_line.split()[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    else:
+        await reader.read()
+        return int(status), False
+    keep_alive = headers.get('connection', '').lower() != 'close' and version == b'HTTP/1.1'
+    return int(status), keep_alive
+
+async def client(host, port, paths, count, latencies, errors):
+    reader = writer = None
+    for i in range(count):
+        path = paths[i % len(paths)]
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(('GET %s HTTP/1.1\r\nHost: %s:%d\r\n\r\n' % (path, host, port)).encode('latin-1'))
+            status, keep_alive = await read_response(reader)
+            if status >= 400:
+                errors.append(status)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            errors.append(e)
+            keep_alive = False
+        latencies.append(time.perf_counter() - started)
+        if not keep_alive and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def run_load(url, clients=20, requests=100, paths=PATHS):
+    parts = urlsplit(url)
+    latencies = []
+    errors = []
+    started = time.perf_counter()
+    await asyncio.gather(*[client(parts.hostname, parts.port or 80, paths, requests, latencies, errors)
+                           for i in range(clients)])
+    elapsed = time.perf_counter() - started
+    return dict(url=url, clients=clients, requests=len(latencies), errors=len(errors),
+                requests_per_second=len(latencies) / elapsed,
+                p50_ms=percentile(latencies, 0.50) * 1000,
+                p99_ms=percentile(latencies, 0.99) * 1000)
+
+# ----------------------------------------------------------------------
+
+def start_wsgiref(app):
+    from wsgiref.simple_server import make_server, WSGIRequestHandler
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+    server = make_server('127.0.0.1', 0, app, handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d' % server.server_port
+
+def start_asyncio(app):
+    from aioserver import Server
+    server = Server(app, port=0)
+    ready = threading.Event()
+    def run():
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(server.start())
+        ready.set()
+        loop.run_forever()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    ready.wait()
+    return 'http://127.0.0.1:%d' % server.port
+
+def compare(clients=20, requests=100):
+    from app import application
+    from loader import load_library
+    load_library('library.json')
+    for name, start in (('wsgiref', start_wsgiref), ('asyncio', start_asyncio)):
+        result = asyncio.run(run_load(start(application), clients, requests))
+        result['server'] = name
+        print(json.dumps(result, sort_keys=True))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        args = [int(arg) for arg in sys.argv[2:]]
+        print(json.dumps(asyncio.run(run_load(sys.argv[1], *args)), sort_keys=True))
+    else:
+        compare()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""Request metrics and profiling.
+
+`MetricsPlugin`, installed in a Bottle app, counts each route's
+requests by status and records how long they take and how many bytes
+they send. `instrument` times chosen methods (repository lookups,
+`Book.to_json`) as named spans. `Metrics.render` gives the lot in the
+Prometheus text format.
+
+A streamed response is measured until its last chunk has been handed to
+the server. Sizes of text bodies are in characters, which for the
+(ASCII) JSON the API sends are bytes. Each process keeps its own
+figures.
+
+With a `SlowestProfiles` attached, the plugin runs cProfile over a sample
+of requests and keeps the stats of the slowest few as .prof files, for
+`python -m pstats`.
+"""
+import cProfile
+import functools
+import heapq
+import os
+import random
+import re
+import threading
+from bisect import bisect_left
+from timeit import default_timer as timer
+
+from bottle import HTTPResponse, request, response
+
+try:
+    text_type = unicode
+except NameError: # Python 3
+    text_type = str
+
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SPAN_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01, 0.1, 1)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# ----------------------------------------------------------------------
+
+class Histogram(object):
+    """Counts of observations at or below each of `bounds`, and their sum."""
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last for above every bound
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def cumulative(self):
+        """[(le, observations <= le)], ending with ('+Inf', count)."""
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+def labels(pairs):
+    return ','.join('%s="%s"' % (name, text_type(value).replace('\\', r'\\')
+                                 .replace('"', r'\"').replace('\n', r'\n'))
+                    for name, value in pairs)
+
+def number(value):
+    if isinstance(value, float):
+        return repr(round(value, 9))
+    return str(value)
+
+class Metrics(object):
+    """Request counts, durations and sizes, per route, and span
+    durations, per span. Thread-safe."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}    # (method, route, status) -> count
+        self.durations = {}   # (method, route) -> Histogram
+        self.sizes = {}       # (method, route) -> Histogram
+        self.spans = {}       # span -> Histogram
+        self.collectors = []  # callables returning more lines to render
+
+    def observe_request(self, method, route, status, seconds, size):
+        key = (method, route)
+        with self._lock:
+            counted = (method, route, status)
+            self.requests[counted] = self.requests.get(counted, 0) + 1
+            durations = self.durations.get(key)
+            if durations is None:
+                durations = self.durations[key] = Histogram(DURATION_BUCKETS)
+                self.sizes[key] = Histogram(SIZE_BUCKETS)
+            durations.observe(seconds)
+            self.sizes[key].observe(size)
+
+    def observe_span(self, span, seconds):
+        with self._lock:
+            histogram = self.spans.get(span)
+            if histogram is None:
+                histogram = self.spans[span] = Histogram(SPAN_BUCKETS)
+            histogram.observe(seconds)
+
+    def collect(self, collector):
+        """Render the lines `collector()` returns (Prometheus text,
+        HELP and TYPE included) with the rest."""
+        with self._lock:
+            self.collectors.append(collector)
+
+    def render(self):
+        """Everything, in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            lines.append('# HELP library_http_requests_total Requests handled, by route and status.')
+            lines.append('# TYPE library_http_requests_total counter')
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append('library_http_requests_total{%s} %d' % (
+                    labels([('method', method), ('route', route), ('status', status)]), count))
+            histograms = [
+                ('library_http_request_duration_seconds', 'Time to handle a request, by route.',
+                 self.durations, ('method', 'route')),
+                ('library_http_response_size_bytes', 'Response body sizes, by route.',
+                 self.sizes, ('method', 'route')),
+                ('library_span_duration_seconds', 'Time spent in instrumented calls, by span.',
+                 dict(((span,), histogram) for span, histogram in self.spans.items()), ('span',)),
+                ]
+            for name, help, histograms, names in histograms:
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s histogram' % name)
+                for key, histogram in sorted(histograms.items()):
+                    pairs = list(zip(names, key))
+                    for bound, count in histogram.cumulative():
+                        lines.append('%s_bucket{%s} %d' % (name, labels(pairs + [('le', bound)]), count))
+                    lines.append('%s_sum{%s} %s' % (name, labels(pairs), number(histogram.sum)))
+                    lines.append('%s_count{%s} %d' % (name, labels(pairs), histogram.count))
+            collectors = list(self.collectors)
+        for collector in collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+
+def instrument(cls, method, span, metrics=METRICS):
+    """Time every call of `cls.method` as `span`."""
+    original = cls.__dict__[method]
+    if getattr(original, 'instrumented', None) is metrics:
+        return
+    @functools.wraps(original)
+    def timed(*args, **kwargs):
+        started = timer()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            metrics.observe_span(span, timer() - started)
+    timed.instrumented = metrics
+    setattr(cls, method, timed)
+
+# ----------------------------------------------------------------------
+
+class SlowestProfiles(object):
+    """Profiles a `sample` of requests, keeping the stats of the `keep`
+    slowest in `directory` (one .prof file each, named by duration and
+    request)."""
+    def __init__(self, directory, keep=10, sample=1.0):
+        self.directory = directory
+        self.keep = keep
+        self.sample = sample
+        self._lock = threading.Lock()
+        self._heap = []         # (seconds, sequence, path), fastest first
+        self._sequence = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def start(self):
+        """A running profiler for this request, or None if it isn't sampled."""
+        if self.sample < 1 and random.random() >= self.sample:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return None # another request is being profiled (one at a time, from Python 3.12)
+        return profile
+
+    def finish(self, profile, seconds, request_line):
+        profile.disable()
+        with self._lock:
+            if len(self._heap) >= self.keep and seconds <= self._heap[0][0]:
+                return
+            self._sequence += 1
+            name = '%09.3fms-%s-%d.prof' % (seconds * 1000, re.sub(r'[^A-Za-z0-9]+', '_', request_line)[:80],
+                                            self._sequence)
+            path = os.path.join(self.directory, name)
+            profile.dump_stats(path)
+            heapq.heappush(self._heap, (seconds, self._sequence, path))
+            if len(self._heap) > self.keep:
+                evicted = heapq.heappop(self._heap)[2]
+                try:
+                    os.remove(evicted)
+                except OSError:
+                    pass
+
+    def slowest(self):
+        """[(seconds, path)], slowest first."""
+        with self._lock:
+            return [(seconds, path) for seconds, sequence, path in sorted(self._heap, reverse=True)]
+
+# ----------------------------------------------------------------------
+
+class MetricsPlugin(object):
+    """Measures every request to the routes it is applied to."""
+    name = 'metrics'
+    api = 2
+
+    def __init__(self, metrics=METRICS, profiler=None):
+        self.metrics = metrics
+        self.profiler = profiler
+        self.json_dumps = None
+
+    def setup(self, app):
+        # This plugin sits inside Bottle's JSON plugin, so it turns dicts
+        # into JSON itself to see how big they are.
+        for other in app.plugins:
+            if getattr(other, 'name', None) == 'json':
+                self.json_dumps = other.json_dumps
+
+    def apply(self, callback, route):
+        method, rule = route.method, route.rule
+        plugin = self
+
+        @functools.wraps(callback)
+        def measured(*args, **kwargs):
+            profiler = plugin.profiler
+            profile = profiler.start() if profiler is not None else None
+            if profile is not None:
+                request_line = '%s %s' % (request.method, request.path)
+            started = timer()
+            def finish(status, size):
+                seconds = timer() - started
+                plugin.metrics.observe_request(method, rule, status, seconds, size)
+                if profile is not None:
+                    profiler.finish(profile, seconds, request_line)
+            try:
+                body = callback(*args, **kwargs)
+            except HTTPResponse as e:
+                finish(e.status_code, response_size(e))
+                raise
+            except Exception:
+                finish(500, 0)
+                raise
+            if isinstance(body, HTTPResponse):
+                finish(body.status_code, response_size(body))
+                return body
+            if isinstance(body, dict) and plugin.json_dumps:
+                response.content_type = 'application/json'
+                body = plugin.json_dumps(body)
+            size = body_size(body)
+            if size is not None or hasattr(body, 'read'):
+                finish(response.status_code, size or 0)
+                return body
+            return counted(body, response.status_code, finish)
+        return measured
+
+def body_size(body):
+    """The size of `body`, if it can be told without consuming it."""
+    if isinstance(body, (bytes, text_type)):
+        return len(body)
+    if body is None:
+        return 0
+    return None
+
+def response_size(response):
+    """The size of an HTTPResponse's body: from its Content-Length if
+    it is a file."""
+    size = body_size(response.body)
+    if size is None:
+        size = int(response.headers.get('Content-Length') or 0)
+    return size
+
+def counted(body, status, finish):
+    """Yield `body`, then report its size and the time taken."""
+    size = 0
+    try:
+        for chunk in body:
+            size += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+        finish(status, size)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+
+import bottle
+from nose.tools import assert_equals, assert_in
+from webtest import TestApp
+
+from metrics import Histogram, Metrics, MetricsPlugin, SlowestProfiles, instrument
+
+# ----------------------------------------------------------------------
+
+def make_app(metrics, profiler=None):
+    app = bottle.Bottle()
+    app.install(MetricsPlugin(metrics, profiler))
+    @app.get('/text')
+    def text():
+        return 'x' * 300
+    @app.get('/dict')
+    def as_dict():
+        return dict(answer=42)
+    @app.get('/stream/<count:int>')
+    def stream(count):
+        for i in range(count):
+            yield 'abc'
+    @app.get('/missing')
+    def missing():
+        bottle.abort(404, 'Not here.')
+    return app
+
+def test_requests_are_counted_and_sized():
+    metrics = Metrics()
+    web = TestApp(make_app(metrics))
+    web.get('/text')
+    web.get('/text')
+    assert_equals({'answer': 42}, web.get('/dict').json)
+    assert_equals(b'abc' * 5, web.get('/stream/5').body)
+    web.get('/missing', status=404)
+
+    assert_equals(2, metrics.requests[('GET', '/text', 200)])
+    assert_equals(1, metrics.requests[('GET', '/missing', 404)])
+    assert_equals(600, metrics.sizes[('GET', '/text')].sum)
+    assert_equals(15, metrics.sizes[('GET', '/stream/<count:int>')].sum)
+    assert_equals(len('{"answer": 42}'), metrics.sizes[('GET', '/dict')].sum)
+    assert_equals(2, metrics.durations[('GET', '/text')].count)
+
+def test_histograms_are_cumulative():
+    histogram = Histogram((1, 10))
+    for value in (0.5, 1, 5, 50):
+        histogram.observe(value)
+    assert_equals([(1, 2), (10, 3), ('+Inf', 4)], histogram.cumulative())
+    assert_equals(56.5, histogram.sum)
+
+def test_render_escapes_labels():
+    metrics = Metrics()
+    metrics.observe_request('GET', '/say/"hi"\\', 200, 0.002, 10)
+    metrics.observe_span('book.to_json', 0.00002)
+    text = metrics.render()
+    assert_in('library_http_requests_total{method="GET",route="/say/\\"hi\\"\\\\",status="200"} 1', text)
+    assert_in('library_http_request_duration_seconds_bucket{method="GET",route="/say/\\"hi\\"\\\\",le="0.001"} 0', text)
+    assert_in('library_span_duration_seconds_bucket{span="book.to_json",le="2.5e-05"} 1', text)
+    assert_in('library_span_duration_seconds_count{span="book.to_json"} 1', text)
+
+def test_instrumented_methods_record_spans():
+    class Thing(object):
+        def work(self, n):
+            """Does some."""
+            return n * 2
+    metrics = Metrics()
+    instrument(Thing, 'work', 'thing.work', metrics)
+    instrument(Thing, 'work', 'thing.work', metrics) # only once
+    assert_equals(4, Thing().work(2))
+    assert_equals('Does some.', Thing.work.__doc__)
+    assert_equals(1, metrics.spans['thing.work'].count)
+
+def test_only_the_slowest_profiles_are_kept():
+    directory = tempfile.mkdtemp()
+    try:
+        profiler = SlowestProfiles(directory, keep=2)
+        for seconds in (0.3, 0.1, 0.5, 0.2):
+            profiler.finish(profiler.start(), seconds, 'GET /library/api/books')
+        assert_equals([0.5, 0.3], [seconds for seconds, path in profiler.slowest()])
+        assert_equals(sorted(os.path.basename(path) for seconds, path in profiler.slowest()),
+                      sorted(os.listdir(directory)))
+
+        web = TestApp(make_app(Metrics(), SlowestProfiles(directory, keep=1)))
+        web.get('/stream/3')
+        assert_equals(3, len(os.listdir(directory)))
+    finally:
+        shutil.rmtree(directory)
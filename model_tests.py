@@ -4,9 +4,45 @@ from nose.tools import raises, assert_equals, assert_in, assert_not_in, assert_i
 from nose.plugins.skip import SkipTest
 import pyDoubles.framework as mock
 import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 
 from models import (Repository, Book, AlreadyOnLoanError, BorrowingWhileReservedError,
-                  NotReservedError, NotCheckedOutError, NotTheBorrowerError)
+                  NotReservedError, NotCheckedOutError, NotTheBorrowerError,
+                  NoMatchingBookError, LazyField, NO_RESERVATIONS,
+                  RepresentationCache, link_templates,
+                  ReservationQueue, VersionConflictError)
+from sqlite_repository import SQLiteRepository
+
+# The repository tests run against each kind of repository, the SQLite
+# ones in a temporary directory.
+
+DATABASES = []
+
+def setup():
+    DATABASES.append(tempfile.mkdtemp())
+
+def teardown():
+    shutil.rmtree(DATABASES.pop())
+
+def sqlite_repository():
+    fd, path = tempfile.mkstemp('.db', dir=DATABASES[-1])
+    os.close(fd)
+    return SQLiteRepository(path)
+
+REPOSITORIES = (Repository, sqlite_repository)
+
+def each_repository(test):
+    """Make `test(repository)` a test generator over REPOSITORIES."""
+    def each():
+        for make_repository in REPOSITORIES:
+            yield test, make_repository()
+    each.__name__ = test.__name__
+    return each
 
 # ----------------------------------------------------------------------
 
@@ -33,6 +69,30 @@ def test_book_class_with_reservers():
     book = Book('TITLE', 'DESCRIPTION', 'ISBN', 'BORROWER', reservations=['RESERVER1', 'RESERVER2'])
     assert_equals(len(book.reservations), 2)
 
+def test_book_without_reservers_shares_empty_reservations():
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    assert book.reservations is NO_RESERVATIONS
+    book.reserve('RESERVER')
+    book.un_reserve('RESERVER')
+    assert book.reservations is NO_RESERVATIONS
+    # Compares like any other queue, emptied or never used.
+    assert_equals([], book.reservations)
+
+def test_book_interns_borrower():
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    book.check_out(''.join(['BORR', 'OWER']))
+    assert book.borrower is Book('TITLE', 'DESCRIPTION', 'ISBN2', 'BORROWER').borrower
+
+def test_book_lazy_field_loads_once():
+    calls = []
+    def load():
+        calls.append(1)
+        return 'DESCRIPTION'
+    book = Book('TITLE', LazyField(load), 'ISBN')
+    assert_equals(book.description, 'DESCRIPTION')
+    assert_equals(book.description, 'DESCRIPTION')
+    assert_equals(len(calls), 1)
+
 # ----------------------------------------------------------------------
 
 def test_book_can_reserve_new_book():
@@ -148,6 +208,97 @@ def test_book_cannot_return_book_if_not_checked_out():
 
 # ----------------------------------------------------------------------
 
+def test_reservation_queue():
+    queue = ReservationQueue(['A', 'B', 'C', 'D'])
+    assert_equals(['A', 'B', 'C', 'D'], queue)
+    assert_equals(2, queue.index('C'))
+    queue.popleft()
+    assert_equals(1, queue.index('C'))
+    queue.remove('B')
+    assert_equals(0, queue.index('C'))
+    queue.append('E')
+    queue.append('C')
+    assert_equals(['C', 'D', 'E'], queue)
+    assert_equals(('C', 2, True, False), (queue[0], queue.index('E'), 'D' in queue, 'A' in queue))
+
+def test_reservation_queue_index_follows_removals_anywhere():
+    import random
+    rng = random.Random(7)
+    queue, users = ReservationQueue(), []
+    for step in range(2000):
+        choice = rng.random()
+        if choice < 0.5 or not users:
+            user = 'U%d' % rng.randrange(300)
+            queue.append(user)
+            if user not in users:
+                users.append(user)
+        elif choice < 0.7:
+            assert_equals(users.pop(0), queue.popleft())
+        else:
+            user = rng.choice(users)
+            users.remove(user)
+            queue.remove(user)
+        if users:
+            user = rng.choice(users)
+            assert_equals(users.index(user), queue.index(user))
+    assert_equals(users, list(queue))
+
+@raises(ValueError)
+def test_reservation_queue_remove_missing():
+    ReservationQueue(['A']).remove('B')
+
+def test_book_reservations_serialise_as_a_list():
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    book.reserve('RESERVER')
+    book.reserve('ANOTHER RESERVER')
+    assert_equals(['RESERVER', 'ANOTHER RESERVER'], json.loads(book.to_json())['reservations'])
+
+def test_unclaimed_hold_lapses():
+    Book.hold_window = 60
+    try:
+        book = Book('TITLE', 'DESCRIPTION', 'ISBN', 'BORROWER')
+        book.reserve('FIRST')
+        book.reserve('SECOND')
+        assert_equals([], book.expire_reservations(time.time() + 3600)) # no hold while on loan
+        book.check_in('BORROWER')
+        assert_equals([], book.expire_reservations(time.time() + 30))
+        assert_equals(['FIRST'], book.expire_reservations(time.time() + 90))
+        assert_equals(['SECOND'], book.reservations)
+        assert_equals(['SECOND'], book.expire_reservations(time.time() + 180))
+        assert book.reservations is NO_RESERVATIONS
+    finally:
+        Book.hold_window = None
+
+@each_repository
+def test_check_out_clears_lapsed_reservations_first(r):
+    Book.reservation_expiry = 0
+    try:
+        r.store(Book('TITLE', 'DESCRIPTION', 'ISBN', 'BORROWER'))
+        r.find_one('ISBN').reserve('STALE')
+        Book.reservation_expiry = None
+        r.find_one('ISBN').reserve('CURRENT')
+        r.find_one('ISBN').check_in('BORROWER')
+        r.find_one('ISBN').check_out('CURRENT')
+        assert_equals('CURRENT', r.find_one('ISBN').borrower)
+        assert_equals([], r.reserved_by('STALE'))
+    finally:
+        Book.reservation_expiry = None
+
+@each_repository
+def test_repository_expires_reservations(r):
+    Book.reservation_expiry = 60
+    try:
+        for isbn in ('ISBN1', 'ISBN2'):
+            r.store(Book('TITLE', 'DESCRIPTION', isbn, 'BORROWER'))
+            r.find_one(isbn).reserve('RESERVER')
+        assert_equals(0, r.expire_reservations())
+        assert_equals(2, r.expire_reservations(time.time() + 90))
+        assert_equals([], r.reserved_by('RESERVER'))
+    finally:
+        Book.reservation_expiry = None
+
+# ----------------------------------------------------------------------
+
 def test_options_no_borrower():
     book = Book('TITLE', 'DESCRIPTION', 'ISBN')
 
@@ -215,44 +366,73 @@ def test_options_with_borrower_with_many_reservers_by_reserver():
 
 def test_links_reserve():
     book = Book('TITLE', 'DESCRIPTION', 'ISBN')
-    book.get_options = mock.method_returning({ Book.CAN_RESERVE: True })
+    book.option_flags = mock.method_returning(Book.RESERVE)
 
     assert_equals(dict(rel='self', href='/books/ISBN'), book.links('RESERVER')[0])
     assert_equals(dict(rel='/docs#reserve', href='/books/ISBN/reservations'), book.links('RESERVER')[1])
 
 def test_links_borrow():
     book = Book('TITLE', 'DESCRIPTION', 'ISBN')
-    book.get_options = mock.method_returning({ Book.CAN_BORROW: True })
+    book.option_flags = mock.method_returning(Book.BORROW)
 
     assert_equals(dict(rel='self', href='/books/ISBN'), book.links('SOMEONE')[0])
     assert_equals(dict(rel='/docs#borrow', href='/books/ISBN/borrower'), book.links('SOMEONE')[1])
 
 def test_links_return():
     book = Book('TITLE', 'DESCRIPTION', 'ISBN')
-    book.get_options = mock.method_returning({ Book.CAN_RETURN: True })
+    book.option_flags = mock.method_returning(Book.RETURN)
 
     assert_equals(dict(rel='self', href='/books/ISBN'), book.links('BORROWER')[0])
     assert_equals(dict(rel='/docs#return', href='/books/ISBN/return'), book.links('BORROWER')[1])
 
 def test_links_cancel():
     book = Book('TITLE', 'DESCRIPTION', 'ISBN')
-    book.get_options = mock.method_returning({ Book.CAN_CANCEL: True })
+    book.option_flags = mock.method_returning(Book.CANCEL)
 
     assert_equals(dict(rel='self', href='/books/ISBN'), book.links('RESERVER')[0])
     assert_equals(dict(rel='/docs#cancel', href='/books/ISBN/reservations/RESERVER/cancel'), book.links('RESERVER')[1])
 
+def test_options_as_flags():
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    book.check_out('BORROWER')
+    book.reserve('RESERVER')
+
+    assert_equals(Book.RETURN, book.option_flags('BORROWER'))
+    assert_equals(Book.CANCEL, book.option_flags('RESERVER'))
+    assert_equals(Book.RESERVE, book.option_flags('OTHER'))
+
+def test_links_thumbnail_when_there_is_one():
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN', thumbnail='http://covers/ISBN')
+    assert_equals(dict(rel='/docs#thumbnail', href='/books/ISBN/thumbnail'), book.links('SOMEONE')[-1])
+    assert_equals(Book.RESERVE | Book.BORROW | Book.THUMBNAIL, book.link_flags(''))
+    rels = [link['rel'] for link in json.loads(book.to_json())['_links']]
+    assert_in('/docs#thumbnail', rels)
+    rels = [link['rel'] for link in Book('TITLE', 'DESCRIPTION', 'ISBN2').links('SOMEONE')]
+    assert_not_in('/docs#thumbnail', rels)
+
+def test_links_json_matches_links():
+    book = Book('TITLE', 'DESCRIPTION', 'IS"BN')
+    book.reserve(u'R\xe9servist %s')
+    for user in ('', u'R\xe9servist %s'):
+        links = book.links(user, 'http://host/%a')
+        assert_equals(json.dumps(links, separators=(',', ':')), link_templates('http://host/%a').json(
+            book.option_flags(user), book.isbn, user))
+        assert_equals(json.dumps(links, indent=2).replace('\n', '\n  '), link_templates('http://host/%a').json(
+            book.option_flags(user), book.isbn, user, pretty=True))
+
 # ----------------------------------------------------------------------
 
-def test_repository_find():
-    r = Repository()
+@each_repository
+def test_repository_find(r):
+    r.find()
 
-def test_repository_find_one_fails():
-    r = Repository()
+@each_repository
+def test_repository_find_one_fails(r):
     maybe_bk = r.find_one('NOTAREALISBN')
     assert_is_none(maybe_bk)
 
-def test_repository_find_empty():
-    r = Repository()
+@each_repository
+def test_repository_find_empty(r):
     bk = Book('TITLE', 'DESCRIPTION', 'ISBN')
     r.store(bk)
     bk = Book('TITLE2', 'DESCRIPTION2', 'ISBN2')
@@ -263,13 +443,13 @@ def test_repository_find_empty():
     books = r.find()
     assert_equals(len(books), 3)
 
-def test_repository_find_nonempty():
-    r = Repository()
+@each_repository
+def test_repository_find_nonempty(r):
     books = r.find()
     assert_equals(len(books), 0)
 
-def test_repository_save_new_one_works():
-    r = Repository()
+@each_repository
+def test_repository_save_new_one_works(r):
     bk = Book('NEWTITLE', 'NEWDESCRIPTION', 'NEWISBN')
     r.store(bk)
     maybe_bk = r.find_one('NEWISBN')
@@ -277,8 +457,8 @@ def test_repository_save_new_one_works():
     assert_equals(maybe_bk.isbn, 'NEWISBN')
     assert_equals(maybe_bk.title, 'NEWTITLE')
 
-def test_repository_update_works():
-    r = Repository()
+@each_repository
+def test_repository_update_works(r):
     bk = Book('TITLE', 'DESCRIPTION', 'ISBN')
     r.store(bk)
     bk = r.find_one('ISBN')
@@ -294,4 +474,349 @@ def test_repository_update_works():
     assert_equals(maybe_bk.isbn, 'NEWISBN')
     assert_equals(maybe_bk.title, 'NEWTITLE')
 
+@each_repository
+def test_repository_sees_book_updates(r):
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN', publisher='OLD'))
+    seen = []
+    r.subscribe(lambda action, isbn, book, user: seen.append((action, isbn)))
+    r.search('title')
+    bk = r.find_one('ISBN')
+    bk.update(title='PYTHON', publisher='NEW')
+    assert_equals([('update', 'ISBN')], seen)
+    assert_equals(['ISBN'], [b.isbn for b in r.search('python')])
+    assert_equals([], r.search('title'))
+    assert_equals(['ISBN'], [b.isbn for b in r.select([('publisher', 'NEW')])[0]])
+    assert_equals([], r.select([('publisher', 'OLD')])[0])
+    r.delete('ISBN')
+    assert_equals([], r.search('python'))
+
+def test_clock_tells_when_versions_were_handed_out():
+    from models import Clock
+    clock = Clock()
+    first = clock.tick()
+    started = int(clock.last_modified)
+    assert_equals(started, clock.modified(first))
+    clock._note(first + 1, started + 10)   # ten seconds on
+    second = clock.tick()
+    assert_equals(started + 10, clock.modified(second))
+    assert_equals(started, clock.modified(first))
+    # Versions from elsewhere date from when the clock heard of them.
+    clock.advance(second + 100)
+    assert clock.modified(second + 50) >= clock.modified(second)
+
+def test_book_modified_follows_its_version():
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    book.touch()
+    assert abs(time.time() - book.modified) <= 1
+
+def test_update_if_version_compares_and_changes_under_the_lock():
+    bk = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    fetched = bk.version
+    def unchanged(version):
+        time.sleep(0.01) # let the other writers catch up
+        return version == fetched
+    conflicts = []
+    def update(title):
+        try:
+            bk.update(if_version=unchanged, title=title)
+        except VersionConflictError:
+            conflicts.append(title)
+    threads = [threading.Thread(target=update, args=('TITLE %d' % i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equals(3, len(conflicts))
+    assert_not_in(bk.title, conflicts)
+
+@raises(TypeError)
+def test_update_only_changes_editable_fields():
+    Book('TITLE', 'DESCRIPTION', 'ISBN').update(borrower='SOMEONE')
+
+# ----------------------------------------------------------------------
+
+@each_repository
+def test_repository_store_twice_does_not_duplicate(r):
+    bk = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    r.store(bk)
+    r.store(bk)
+    assert_equals(len(r.find()), 1)
+
+@each_repository
+def test_repository_store_replaces_book_with_same_isbn(r):
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN'))
+    r.store(Book('TITLE2', 'DESCRIPTION2', 'ISBN2'))
+    r.store(Book('NEWTITLE', 'NEWDESCRIPTION', 'ISBN'))
+
+    assert_equals(len(r.find()), 2)
+    assert_equals(r.find_one('ISBN').title, 'NEWTITLE')
+    assert_equals(['ISBN', 'ISBN2'], [bk.isbn for bk in r.find()])
+
+@each_repository
+def test_repository_find_is_a_live_view(r):
+    books = r.find()
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN'))
+    assert_equals(len(books), 1)
+
+@each_repository
+def test_repository_delete(r):
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN'))
+    r.delete('ISBN')
+    assert_is_none(r.find_one('ISBN'))
+    assert_equals(len(r.find()), 0)
+
+@each_repository
+@raises(NoMatchingBookError)
+def test_repository_delete_missing_book(r):
+    r.delete('NOTAREALISBN')
+
+@each_repository
+def test_repository_pages_by_offset_and_by_cursor(r):
+    for i in range(7):
+        r.store(Book('TITLE', 'DESCRIPTION', 'ISBN%d' % i))
+    assert_equals(['ISBN2', 'ISBN3', 'ISBN4'], [bk.isbn for bk in r.page(2, 3)])
+    r.delete('ISBN3')
+    assert_equals(['ISBN2', 'ISBN4', 'ISBN5'], [bk.isbn for bk in r.page(2, 3)])
+
+    pages = []
+    cursor = 0
+    while cursor is not None:
+        books, cursor = r.page_at(cursor, 2)
+        pages.append([bk.isbn for bk in books])
+        if len(pages) == 1:
+            r.delete('ISBN0')          # behind the cursor: nothing moves
+            r.store(Book('TITLE', 'DESCRIPTION', 'ISBN7'))
+    assert_equals([['ISBN0', 'ISBN1'], ['ISBN2', 'ISBN4'], ['ISBN5', 'ISBN6'], ['ISBN7']], pages)
+
+# ----------------------------------------------------------------------
+
+def test_to_json_is_cached_until_book_changes():
+    Book.representations = RepresentationCache()
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    book.to_json(prefix='/api')
+    book.to_json('SOMEONE', prefix='/api')
+    assert_equals(Book.representations.stats(), dict(hits=1, misses=1, entries=1))
+
+    book.reserve('RESERVER')
+    assert_equals(json.loads(book.to_json(prefix='/api'))['reservations'], ['RESERVER'])
+    book.check_out('RESERVER')
+    assert_equals(json.loads(book.to_json(prefix='/api'))['borrower'], 'RESERVER')
+    book.update(title='NEWTITLE')
+    assert_equals(json.loads(book.to_json(prefix='/api'))['title'], 'NEWTITLE')
+    assert_equals(Book.representations.stats(), dict(hits=1, misses=4, entries=1))
+
+def test_to_json_links_are_per_user():
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    book.check_out('BORROWER')
+    rels = [link['rel'] for link in json.loads(book.to_json('BORROWER'))['_links']]
+    assert_in('/docs#return', rels)
+    rels = [link['rel'] for link in json.loads(book.to_json('OTHER'))['_links']]
+    assert_not_in('/docs#return', rels)
+
+def test_to_json_compact_and_pretty():
+    Book.representations = RepresentationCache()
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    book.reserve('RESERVER')
+    compact = book.to_json('RESERVER', prefix='/api')
+    pretty = book.to_json('RESERVER', prefix='/api', pretty=True)
+    assert_not_in('\n', compact)
+    assert_in('\n  "_links": [', pretty)
+    assert_equals(json.loads(compact), json.loads(pretty))
+    assert_equals(Book.representations.stats()['entries'], 2)
+
+def test_representation_cache_is_bounded():
+    cache = RepresentationCache(max_entries=2)
+    for isbn in ('ISBN1', 'ISBN2', 'ISBN3'):
+        cache.get(Book('TITLE', 'DESCRIPTION', isbn), '', lambda: isbn)
+    assert_equals(cache.stats()['entries'], 2)
+
+# ----------------------------------------------------------------------
+
+@each_repository
+def test_repository_tracks_borrowers_and_reservers(r):
+    bk1 = Book('TITLE', 'DESCRIPTION', 'ISBN1', reservations=['RESERVER'])
+    bk2 = Book('TITLE2', 'DESCRIPTION2', 'ISBN2')
+    r.store(bk1)
+    r.store(bk2)
+
+    bk2.check_out('BORROWER')
+    bk2.reserve('RESERVER')
+    bk1.reserve('OTHER')
+    assert_equals([bk2], r.borrowed_by('BORROWER'))
+    assert_equals([(bk1, 0), (bk2, 0)], r.reserved_by('RESERVER'))
+    assert_equals([(bk1, 1)], r.reserved_by('OTHER'))
+    assert_equals(['BORROWER', 'OTHER', 'RESERVER'], r.users())
+
+    bk2.check_in('BORROWER')
+    bk2.check_out('RESERVER')
+    bk1.un_reserve('RESERVER')
+    assert_equals([], r.borrowed_by('BORROWER'))
+    assert_equals([bk2], r.borrowed_by('RESERVER'))
+    assert_equals([], r.reserved_by('RESERVER'))
+    assert_equals([(bk1, 0)], r.reserved_by('OTHER'))
+
+@each_repository
+def test_repository_forgets_users_of_removed_books(r):
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN', 'BORROWER'))
+    r.store(Book('NEWTITLE', 'DESCRIPTION', 'ISBN'))
+    assert_equals([], r.borrowed_by('BORROWER'))
+
+    bk = Book('TITLE', 'DESCRIPTION', 'ISBN2', 'BORROWER')
+    r.store(bk)
+    r.delete('ISBN2')
+    bk.check_in('BORROWER')
+    assert_equals([], r.users())
+
+# ----------------------------------------------------------------------
+
+def hammer(books, users, rounds, on_borrowed=None):
+    """Have each user reserve, borrow and return `books` from its own thread.
+
+    Returns the unexpected exceptions raised in the threads."""
+    errors = []
+    def worker(user):
+        try:
+            for i in range(rounds):
+                bk = books[i % len(books)]
+                bk.reserve(user)
+                try:
+                    bk.check_out(user)
+                except (AlreadyOnLoanError, BorrowingWhileReservedError):
+                    bk.un_reserve(user)
+                    continue
+                if on_borrowed:
+                    on_borrowed(bk, user)
+                bk.check_in(user)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker, args=(user,)) for user in users]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+@each_repository
+def test_concurrent_transitions_keep_invariants(r):
+    books = [Book('TITLE', 'DESCRIPTION', 'ISBN%d' % i) for i in range(3)]
+    for bk in books:
+        r.store(bk)
+    holders = dict((bk.isbn, []) for bk in books)
+    overlaps = []
+    def on_borrowed(bk, user):
+        holders[bk.isbn].append(user)
+        if holders[bk.isbn] != [user]:
+            overlaps.append((bk.isbn, list(holders[bk.isbn])))
+        holders[bk.isbn].remove(user)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        errors = hammer(books, ['USER%d' % i for i in range(8)], 500, on_borrowed)
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert_equals([], errors)
+    assert_equals([], overlaps)
+    for bk in books:
+        assert_equals(bk.status(), Book.AVAILABLE)
+        assert_equals(len(bk.reservations), 0)
+    assert_equals([], r.users())
+
+# ----------------------------------------------------------------------
+
+@each_repository
+def test_books_without_a_publisher_are_not_ranked(r):
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN1', publisher='P'))
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN2'))
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN3'))
+    assert_equals([('P', 1)], r.summary()['publishers'])
+    assert_equals((1, [('P', 1)]), r.ranking('publishers', 0, 10))
+
+@each_repository
+def test_apply_batch_reports_each_operation(r):
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN1'))
+    r.store(Book('TITLE2', 'DESCRIPTION2', 'ISBN2'))
+    applied, results = r.apply_batch([
+        dict(op='check_out', isbn='ISBN1', user='BORROWER'),
+        dict(op='check_out', isbn='ISBN1', user='OTHER'),
+        dict(op='reserve', isbn='ISBN2', user='OTHER'),
+        dict(op='check_in', isbn='NOTAREALISBN', user='OTHER'),
+        dict(op='burn', isbn='ISBN2', user='OTHER'),
+        ])
+    assert applied
+    assert_equals([True, False, True, False, False], [result['ok'] for result in results])
+    assert_equals(['AlreadyOnLoanError', 'NoMatchingBookError', 'InvalidOperationError'],
+                  [result['error'] for result in results if not result['ok']])
+    assert_equals('BORROWER', r.find_one('ISBN1').borrower)
+    assert_equals(['OTHER'], list(r.find_one('ISBN2').reservations))
+
+@each_repository
+def test_apply_batch_atomic_all_or_nothing(r):
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN1'))
+    r.store(Book('TITLE2', 'DESCRIPTION2', 'ISBN2'))
+    operations = [
+        dict(op='check_out', isbn='ISBN1', user='BORROWER'),
+        dict(op='check_in', isbn='ISBN1', user='BORROWER'),
+        dict(op='check_out', isbn='ISBN2', user='BORROWER'),
+        dict(op='check_in', isbn='ISBN2', user='OTHER'),
+        ]
+    applied, results = r.apply_batch(operations, atomic=True)
+    assert not applied
+    assert_equals([True, True, True, False], [result['ok'] for result in results])
+    assert_equals('NotTheBorrowerError', results[3]['error'])
+    assert_equals(Book.AVAILABLE, r.find_one('ISBN1').status())
+    assert_equals(Book.AVAILABLE, r.find_one('ISBN2').status())
+    assert_equals([], r.users())
+
+    applied, results = r.apply_batch(operations[:3], atomic=True)
+    assert applied
+    assert_equals('BORROWER', r.find_one('ISBN2').borrower)
+    assert_equals([r.find_one('ISBN2')], r.borrowed_by('BORROWER'))
+
+@each_repository
+def test_apply_batch_rejects_fields_of_the_wrong_type(r):
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN1'))
+    applied, results = r.apply_batch([
+        dict(op='reserve', isbn=['ISBN1'], user='READER'),
+        dict(op='reserve', isbn='ISBN1', user=42),
+        dict(op='reserve', isbn='ISBN1', user='READER'),
+        ])
+    assert applied
+    assert_equals([False, False, True], [result['ok'] for result in results])
+    assert_equals(['InvalidOperationError'] * 2, [result['error'] for result in results[:2]])
+
+@each_repository
+def test_apply_batch_rejected_leaves_the_clock_alone(r):
+    from models import clock
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN1'))
+    last = clock.last
+    applied, results = r.apply_batch([
+        dict(op='reserve', isbn='ISBN1', user='READER'),
+        dict(op='check_out', isbn='ISBN1', user='OTHER'),
+        ], atomic=True)
+    assert not applied
+    assert_equals(last, clock.last)
+
+def test_apply_batch_atomic_rehearses_with_reservation_deadlines():
+    Book.hold_window = 60
+    try:
+        r = Repository()
+        r.store(Book('TITLE', 'DESCRIPTION', 'ISBN1'))
+        book = r.find_one('ISBN1')
+        book.reserve('FIRST')
+        book.reserve('SECOND')
+        book.reservations.set_deadline('FIRST', time.time() - 1) # hold not taken up
+        operations = [dict(op='check_out', isbn='ISBN1', user='FIRST')]
+        applied, results = r.apply_batch(operations, atomic=True)
+        assert not applied
+        assert_equals('BorrowingWhileReservedError', results[0]['error'])
+        assert_equals('', book.borrower)
+
+        copy = book.copy()
+        assert_equals('FIRST', copy.reservations.held)
+        assert_equals(book.reservations.deadline('SECOND'), copy.reservations.deadline('SECOND'))
+    finally:
+        Book.hold_window = None
+
 # ----------------------------------------------------------------------
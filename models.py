@@ -1,5 +1,18 @@
 #!/usr/bin/env python
 import json
+from json.encoder import encode_basestring_ascii
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from search import SearchIndex
+from stats import CatalogueStats
+from facets import FacetIndex
+try:
+    from sys import intern
+except ImportError:
+    pass # Python 2: intern is a builtin.
 
 # ----------------------------------------------------------------------
 
@@ -9,41 +22,814 @@ class NotReservedError(Exception): pass
 class NotCheckedOutError(Exception): pass
 class NotTheBorrowerError(Exception): pass
 class NoMatchingBookError(Exception): pass
+class InvalidOperationError(Exception): pass
+class VersionConflictError(Exception): pass
+
+try:
+    string_types = basestring
+except NameError: # Python 3
+    string_types = str
 
 # ----------------------------------------------------------------------
 
 def equivalent_lists(first, second):
     assert_equals(sorted(first), sorted(second))
 
+def intern_name(name):
+    """Intern a user name so every book borrowed or reserved by the same
+    user shares one string object."""
+    try:
+        return intern(name)
+    except TypeError: # Python 2 can't intern unicode.
+        return name
+
+CLOCK_SECONDS = 100000  # seconds the clock remembers the versions of (see Clock.modified)
+
+class Clock(object):
+    """Hands out monotonically increasing version numbers.
+
+    `last` and `last_modified` describe the most recent change anywhere,
+    which is what validates whole-catalogue responses. `modified` tells
+    when any other version was handed out, so books needn't keep the
+    time as well as their version.
+    """
+    def __init__(self):
+        self._counter = 0
+        self._lock = threading.Lock()
+        self.last = 0
+        self.last_modified = time.time()
+        # The first version handed out in each second it handed any out:
+        # versions from _versions[i] on date from _seconds[i] or later.
+        self._versions = array('d')
+        self._seconds = array('d')
+        self._note(1, self.last_modified)
+
+    def tick(self):
+        with self._lock:
+            self._counter += 1
+            version = self.last = self._counter
+            self.last_modified = time.time()
+            self._note(version, self.last_modified)
+            return version
+
+    def stamp(self):
+        """A fresh version number that doesn't count as a change by itself."""
+        with self._lock:
+            self._counter += 1
+            self._note(self._counter, time.time())
+            return self._counter
+
+    def advance(self, version):
+        """Record a change stamped `version` by someone else (a shared log,
+        see workers.py). Versions handed out later are still fresh."""
+        with self._lock:
+            self.last_modified = time.time()
+            # Whatever was handed out up to `version`, it was by now.
+            self._note(self._counter + 1, self.last_modified)
+            self._counter = max(self._counter, version)
+            self.last = version
+
+    def _note(self, version, now):
+        second = int(now)
+        if not self._seconds or self._seconds[-1] < second:
+            if len(self._seconds) >= CLOCK_SECONDS:
+                # Forget the older half: their versions then date from
+                # the oldest second remembered, later than they did.
+                del self._versions[:CLOCK_SECONDS // 2]
+                del self._seconds[:CLOCK_SECONDS // 2]
+            self._versions.append(version)
+            self._seconds.append(second)
+
+    def modified(self, version):
+        """When `version` was handed out, to the second, or (for versions
+        from before the clock remembers, e.g. from before a restart) a
+        later time."""
+        with self._lock:
+            i = bisect_right(self._versions, version) - 1
+            return float(self._seconds[max(i, 0)])
+
+# Every change to any book, or to what the repository holds, ticks this.
+clock = Clock()
+
+# Book state transitions are serialised per book by striping ISBNs over
+# these locks. Reentrant so a caller can hold a book's lock across several
+# transitions.
+BOOK_LOCKS = [threading.RLock() for i in range(64)]
+
+def lock_for(isbn):
+    return BOOK_LOCKS[hash(isbn) % len(BOOK_LOCKS)]
+
+# The owner of the copies apply_batch tries a batch out on.
+REHEARSAL = object()
+
+class ReservationQueue(object):
+    """The users waiting for a book, first come first served.
+
+    Behaves like the list it replaces (len, iteration, `in`, indexing,
+    equality with lists) but membership, appending, removal and popping
+    the front are O(1), and `index` is O(log n): the first call builds a
+    Fenwick tree over the users' arrival numbers, which the other
+    operations then keep up to date in O(log n) too. Each entry may
+    carry a deadline, after which it lapses (see Book.hold_window).
+    """
+    __slots__ = ('_deadlines', '_numbers', '_tree', '_next', 'held')
+
+    def __init__(self, users=()):
+        self._deadlines = OrderedDict()
+        self._numbers = None    # user -> arrival number, once `index` is used
+        self._tree = None       # Fenwick tree: how many users hold each number
+        self._next = 0          # the next arrival number
+        self.held = None        # the user whose hold is running, if any
+        for user in users:
+            self.append(user)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __iter__(self):
+        return iter(self._deadlines)
+
+    def __contains__(self, user):
+        return user in self._deadlines
+
+    def __getitem__(self, index):
+        if index == 0 and self._deadlines:
+            return next(iter(self._deadlines))
+        return list(self._deadlines)[index]
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'ReservationQueue(%r)' % list(self)
+
+    def append(self, user, deadline=None):
+        if user not in self._deadlines:
+            self._deadlines[user] = deadline
+            if self._numbers is not None:
+                if self._next == len(self._tree) - 1:
+                    self._renumber() # out of numbers; numbers user too
+                else:
+                    self._numbers[user] = self._next
+                    self._count(self._next, 1)
+                    self._next += 1
+
+    def remove(self, user):
+        if user not in self._deadlines:
+            raise ValueError('%r is not in the queue' % (user,))
+        del self._deadlines[user]
+        self._forget(user)
+        if user == self.held:
+            self.held = None
+
+    def popleft(self):
+        user, deadline = self._deadlines.popitem(last=False)
+        self._forget(user)
+        if user == self.held:
+            self.held = None
+        return user
+
+    def index(self, user):
+        if user not in self._deadlines:
+            raise ValueError('%r is not in the queue' % (user,))
+        if self._numbers is None:
+            self._renumber()
+        # How many of those still waiting arrived before `user`.
+        tree = self._tree
+        i = self._numbers[user]
+        position = 0
+        while i > 0:
+            position += tree[i]
+            i -= i & -i
+        return position
+
+    def _forget(self, user):
+        if self._numbers is not None:
+            self._count(self._numbers.pop(user), -1)
+
+    def _count(self, number, delta):
+        tree = self._tree
+        i = number + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _renumber(self):
+        """Number the users 0 up, in queue order, with room for as many
+        again to arrive, and build the tree for those numbers."""
+        size = len(self._deadlines)
+        self._numbers = dict((user, i) for i, user in enumerate(self._deadlines))
+        self._next = size
+        tree = self._tree = [0] * (2 * size + 9)
+        for i in range(1, len(tree)):
+            if i <= size:
+                tree[i] += 1
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+
+    def copy(self):
+        """A copy of the queue, deadlines and hold included."""
+        queue = ReservationQueue()
+        queue._deadlines = self._deadlines.copy()
+        queue.held = self.held
+        return queue
+
+    def deadline(self, user):
+        return self._deadlines[user]
+
+    def set_deadline(self, user, deadline):
+        if user in self._deadlines:
+            self._deadlines[user] = deadline
+
+    def lapsed(self, now):
+        """The users whose deadline has passed, in queue order."""
+        return [user for user, deadline in self._deadlines.items()
+                if deadline is not None and deadline <= now]
+
+# Shared by every book without reservations, until its first reservation
+# (which replaces it with a queue of the book's own): never changed.
+NO_RESERVATIONS = ReservationQueue()
+
+class LazyField(object):
+    """Wraps a zero-argument callable that produces a field's value.
+
+    Passing one as e.g. Book's `description` defers loading the value
+    until it is first read.
+    """
+    __slots__ = ('load',)
+    def __init__(self, load):
+        self.load = load
+
+class _lazy_field(object):
+    """Descriptor that resolves a LazyField held in slot `name` on first read."""
+    def __init__(self, name):
+        self.name = name
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = getattr(obj, self.name)
+        if type(value) is LazyField:
+            value = value.load()
+            setattr(obj, self.name, value)
+        return value
+    def __set__(self, obj, value):
+        setattr(obj, self.name, value)
+
+# ----------------------------------------------------------------------
+class BookView(object):
+    """Read-only, live view of the books held by a Repository.
+
+    Iterates in insertion order without copying the underlying index,
+    hydrating lazily loaded books as it reaches them.
+    """
+    def __init__(self, repository):
+        self._repository = repository
+    def __len__(self):
+        return len(self._repository._index)
+    def __iter__(self):
+        repository = self._repository
+        for isbn, bk in repository._index.items():
+            if type(bk) is _Unhydrated:
+                bk = repository._hydrate(isbn, bk)
+            yield bk
+    def __contains__(self, book):
+        return self._repository._index.get(book.isbn) is book
+
+class _Unhydrated(object):
+    """Placeholder for a book that has not been built yet."""
+    __slots__ = ('factory', 'version')
+    def __init__(self, factory, version):
+        self.factory = factory
+        self.version = version  # building the book doesn't change it
+
+class BatchOperations(object):
+    """`apply_batch`, for repositories with a `find_one`."""
+    BATCH_ACTIONS = ('check_out', 'check_in', 'reserve', 'un_reserve')
+    BATCH_ERRORS = (AlreadyOnLoanError, BorrowingWhileReservedError, NotReservedError,
+                    NotCheckedOutError, NotTheBorrowerError, NoMatchingBookError,
+                    InvalidOperationError)
+
+    def apply_batch(self, operations, atomic=False):
+        """Apply many `{'op': ..., 'isbn': ..., 'user': ...}` operations.
+
+        `op` is one of BATCH_ACTIONS. Returns `(applied, results)`: one
+        result per operation, `{'ok': True}` or `{'ok': False, 'error':
+        <exception name>, 'message': ...}`. Without `atomic` each operation
+        stands alone; with it, either every operation succeeds or none is
+        applied (`applied` is False and the results say what would fail).
+        """
+        books = {}
+        for isbn in set(op.get('isbn') for op in operations
+                        if isinstance(op.get('isbn'), string_types)):
+            if isbn:
+                books[isbn] = self.find_one(isbn)
+        if not atomic:
+            return True, [self._apply(books, op) for op in operations]
+
+        # Lock every book involved, in a fixed order, then rehearse the
+        # batch on copies before touching the real books.
+        locks = sorted(set(lock_for(isbn) for isbn in books), key=BOOK_LOCKS.index)
+        for lock in locks:
+            lock.acquire()
+        try:
+            # One time for both runs, so reservations lapse alike in each.
+            now = time.time()
+            rehearsal = dict((isbn, bk.copy(rehearsal=True)) for isbn, bk in books.items() if bk)
+            results = [self._apply(rehearsal, op, now) for op in operations]
+            if not all(result['ok'] for result in results):
+                return False, results
+            return True, [self._apply(books, op, now) for op in operations]
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _apply(self, books, op, now=None):
+        try:
+            action = op.get('op')
+            if action not in self.BATCH_ACTIONS:
+                raise InvalidOperationError("Unknown operation '%s'" % action)
+            user = op.get('user')
+            if not isinstance(user, string_types) or not user.strip():
+                raise InvalidOperationError('No user given')
+            isbn = op.get('isbn')
+            if isbn is not None and not isinstance(isbn, string_types):
+                raise InvalidOperationError("'isbn' must be a string")
+            book = books.get(isbn)
+            if book is None:
+                raise NoMatchingBookError("No book with ISBN '%s'" % op.get('isbn'))
+            getattr(book, action)(user, now=now)
+            return dict(ok=True)
+        except self.BATCH_ERRORS as e:
+            return dict(ok=False, error=type(e).__name__, message=str(e))
+
 # ----------------------------------------------------------------------
-class Repository(object):
+
+class Repository(BatchOperations):
+    """Books indexed by ISBN, kept in insertion order.
+
+    `store` is an upsert: storing a book whose ISBN is already known
+    replaces the existing entry in place, and storing a book whose ISBN
+    has changed since it was last stored moves it to the new key.
+
+    `store_lazy` registers a factory instead of a book; the book is only
+    built the first time it is looked up or iterated over.
+
+    Stored books are kept in a full-text SearchIndex. Indexing is deferred
+    until the next `search`, so bulk stores (imports, recovery) stay cheap;
+    `search` also hydrates any lazily stored books first.
+
+    All methods are safe to call from several threads. Iterating over
+    `find()` is not, while other threads store or delete books; use
+    `page` or `page_at`.
+
+    Listeners registered with `subscribe` are called, under the
+    repository's lock, as `listener(action, isbn, book, user)` after every
+    'store' and 'delete' and every 'update', 'check_out', 'check_in',
+    'reserve' and 'un_reserve' of a stored book (`user` is None for store,
+    update and delete).
+    Storing a book under a new ISBN is reported as a delete of the old one
+    followed by a store.
+    """
     def __init__(self):
-        self.books = []
+        self._lock = threading.RLock()
+        self._index = OrderedDict()
+        self._order = None  # the ISBNs in listing order, for `page`, until books come or go
+        self._keys = {}  # id(book) -> ISBN it is currently stored under
+        self._pending = 0  # lazily stored books not hydrated yet
+        self._borrowed = {}  # user -> ISBNs of the books they have borrowed
+        self._reserved = {}  # user -> ISBNs of the books they have reserved
+        self._listeners = []
+        self.search_index = SearchIndex()
+        self._unindexed = {}  # ISBN -> stored book not yet in search_index
+        self.stats = CatalogueStats()
+        self.facets = FacetIndex()
+    def subscribe(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def _publish(self, action, isbn, book, user=None):
+        for listener in self._listeners:
+            listener(action, isbn, book, user)
+
     def find(self):
-        return self.books[:]
-#         if not cls._all_books:
-#             json_books = [json.loads(x) for x in open('library.json', 'r').read().splitlines()]
-#             books = [
-#                 Book(j.get('title', ''), j.get('description', ''), j.get('ISBN', ''),
-#                      author=j.get('author', ''),
-#                      publisher=j.get('publisher', ''),
-#                      small_thumbnail=j.get('small_thumbnail', ''),
-#                      thumbnail=j.get('thumbnail', '')
-#                      )
-#                 for j in json_books
-#                 ]
-#             cls._all_books = books
-#        return cls._all_books
+        return BookView(self)
 
     def find_one(self, isbn):
-        ret = None
-        for bk in self.find():
-            if (not isbn) or (bk.isbn == isbn):
-                ret = bk
-                break
-        return ret
+        if not isbn:
+            with self._lock:
+                for bk in self.find():
+                    return bk
+            return None
+        bk = self._index.get(isbn)
+        if type(bk) is _Unhydrated:
+            bk = self._hydrate(isbn, bk)
+        return bk
+
+    def page(self, offset, limit):
+        """Up to `limit` books, starting at the `offset`th."""
+        with self._lock:
+            if self._order is None:
+                self._order = list(self._index)
+            found = [(isbn, self._index[isbn]) for isbn in self._order[offset:offset + limit]]
+        return self._built(found)
+
+    def page_at(self, cursor, limit):
+        """(up to `limit` books from the listing position `cursor` on,
+        the cursor of the next page or None). Costs the same however far
+        into the listing `cursor` is."""
+        with self._lock:
+            following = self.facets.following(cursor, limit + 1)
+            found = [(isbn, self._index[isbn]) for ordinal, isbn in following[:limit]]
+        return self._built(found), following[limit][0] if len(following) > limit else None
+
+    def _built(self, found):
+        """The books for `found` (isbn, book or placeholder) pairs, built
+        without holding the lock throughout."""
+        books = []
+        for isbn, bk in found:
+            if type(bk) is _Unhydrated:
+                bk = self._hydrate(isbn, bk)
+            if bk is not None:
+                books.append(bk)
+        return books
+
     def store(self, book):
-        self.books.append(book)
+        with self._lock:
+            old_isbn = self._keys.get(id(book))
+            if old_isbn is not None:
+                self._removed(book, old_isbn)
+                if old_isbn != book.isbn:
+                    del self._index[old_isbn]
+                    self._order = None
+                    self.facets.forget(old_isbn)
+                    self._publish('delete', old_isbn, book)
+            self._forget(book.isbn, book)
+            if book.isbn not in self._index:
+                self._order = None
+            self._index[book.isbn] = book
+            self._added(book)
+            clock.tick()
+            self._publish('store', book.isbn, book)
+
+    def store_lazy(self, isbn, factory):
+        with self._lock:
+            self._forget(isbn, None)
+            if isbn not in self._index:
+                self._order = None
+            self._index[isbn] = _Unhydrated(factory, clock.tick())
+            self.facets.place(isbn)
+            self._pending += 1
+
+    def _forget(self, isbn, replacement):
+        """Drop the bookkeeping for whatever `replacement` is replacing."""
+        current = self._index.get(isbn)
+        if current is None or current is replacement:
+            return
+        if type(current) is _Unhydrated:
+            self._pending -= 1
+        else:
+            self._removed(current, isbn)
+
+    def _hydrate(self, isbn, placeholder):
+        with self._lock:
+            if self._index.get(isbn) is not placeholder:
+                # Another thread got there first (or the book went away).
+                return self.find_one(isbn)
+            book = placeholder.factory()
+            book.version = placeholder.version
+            self._index[isbn] = book
+            self._pending -= 1
+            self._added(book)
+            # The book is the same, but the stats and facets now count it.
+            clock.tick()
+            return book
+
+    def _added(self, book):
+        isbn = book.isbn
+        self._keys[id(book)] = isbn
+        self._unindexed[isbn] = book
+        if book.borrower:
+            self._link(self._borrowed, book.borrower, isbn)
+        for user in book.reservations:
+            self._link(self._reserved, user, isbn)
+        self.stats.add(book)
+        self.facets.add(book)
+        book._owner = self
+
+    def _removed(self, book, isbn):
+        del self._keys[id(book)]
+        if self._unindexed.pop(isbn, None) is None:
+            self.search_index.remove(isbn)
+        if book.borrower:
+            self._unlink(self._borrowed, book.borrower, isbn)
+        for user in book.reservations:
+            self._unlink(self._reserved, user, isbn)
+        self.stats.remove(isbn)
+        self.facets.remove(isbn)
+        book._owner = None
+
+    def _link(self, users, user, isbn):
+        isbns = users.get(user)
+        if isbns is None:
+            isbns = users[user] = set()
+        isbns.add(isbn)
+
+    def _unlink(self, users, user, isbn):
+        isbns = users.get(user)
+        if isbns is not None:
+            isbns.discard(isbn)
+            if not isbns:
+                del users[user]
+
+    def book_changed(self, book, action, user):
+        """Called by a stored book after `user` performed `action` on it."""
+        isbn = book.isbn
+        with self._lock:
+            if action == 'check_out':
+                self._unlink(self._reserved, user, isbn)
+                self._link(self._borrowed, user, isbn)
+            elif action == 'check_in':
+                self._unlink(self._borrowed, user, isbn)
+            elif action == 'reserve':
+                self._link(self._reserved, user, isbn)
+            elif action == 'un_reserve':
+                self._unlink(self._reserved, user, isbn)
+            elif action == 'update':
+                self.search_index.remove(isbn)
+                self._unindexed[isbn] = book
+                self.stats.add(book)
+            self.stats.changed(book)
+            self.facets.changed(book)
+            self._publish(action, isbn, book, user)
+
+    def hydrate(self):
+        """Build every lazily stored book now: one at a time, so other
+        threads only wait for the lock as long as one book takes."""
+        if self._pending:
+            with self._lock:
+                pending = [(isbn, bk) for isbn, bk in self._index.items()
+                           if type(bk) is _Unhydrated]
+            for isbn, placeholder in pending:
+                self._hydrate(isbn, placeholder)
+
+    def search(self, query):
+        """The books matching `query`, best match first."""
+        self.hydrate()
+        with self._lock:
+            for book in self._unindexed.values():
+                self.search_index.add(book)
+            self._unindexed.clear()
+            return [self._index[isbn] for isbn in self.search_index.search(query)]
+
+    def select(self, filters, query=''):
+        """(books, facet counts) for the books matching every (facet,
+        value) in `filters` and the search `query`, if any: best match
+        first with a query, otherwise in listing order."""
+        filters = tuple(filters)
+        if query:
+            books = self.search(query)
+        else:
+            self.hydrate()
+        with self._lock:
+            facets = self.facets
+            if query:
+                # Leaving out the books deleted since the search.
+                books = [bk for bk in books if self._index.get(bk.isbn) is bk]
+                ordinals = [facets.ordinal(bk.isbn) for bk in books]
+                if filters:
+                    allowed = set(facets.matching(filters))
+                    books = [bk for bk, ordinal in zip(books, ordinals) if ordinal in allowed]
+                    ordinals = [ordinal for ordinal in ordinals if ordinal in allowed]
+            else:
+                ordinals = facets.matching(filters)
+                found = [(isbn, self._index[isbn]) for isbn in facets.isbns(ordinals)]
+            counts = facets.counts(ordinals, (filters, query))
+        if not query:
+            books = self._built(found) # including any stored lazily since hydrate()
+        return books, counts
+
+    def facet_counts(self):
+        """Facet counts (see FacetIndex.counts) over the whole catalogue."""
+        self.hydrate()
+        with self._lock:
+            return self.facets.counts()
+
+    def users(self):
+        """Everyone currently borrowing or reserving a book."""
+        self.hydrate()
+        with self._lock:
+            return sorted(set(self._borrowed) | set(self._reserved))
+
+    def borrowed_by(self, user):
+        self.hydrate()
+        with self._lock:
+            return [self._index[isbn] for isbn in sorted(self._borrowed.get(user, ()))]
+
+    def summary(self, top=10):
+        """The catalogue's running totals (see CatalogueStats): the `top`
+        publishers and authors by number of books, as (name, books) pairs,
+        and the `top` most reserved books, as (book, reservations) pairs.
+        Lazily stored books not built yet are counted as available but
+        only as `pending`, not by publisher or author."""
+        with self._lock:
+            stats = self.stats
+            pending = self._pending
+            return dict(books=stats.books + pending,
+                        available=stats.books + pending - stats.borrowed,
+                        borrowed=stats.borrowed,
+                        reserved=stats.reserved,
+                        reservations=stats.reservations,
+                        pending=pending,
+                        publishers=stats.publishers.top(top),
+                        authors=stats.authors.top(top),
+                        most_reserved=[(self._index[isbn], count)
+                                       for isbn, count in stats.most_reserved(top)])
+
+    def ranking(self, field, offset, limit):
+        """(how many, [(name, books)]): the `field` ('publishers' or
+        'authors') with the most books first, from the `offset`th on, at
+        most `limit` of them."""
+        with self._lock:
+            ranking = getattr(self.stats, field)
+            return len(ranking), ranking.page(offset, limit)
+
+    def expire_reservations(self, now=None):
+        """Drop the lapsed reservations of every book (see
+        Book.expire_reservations). Returns how many were dropped."""
+        with self._lock:
+            isbns = set()
+            for reserved in self._reserved.values():
+                isbns.update(reserved)
+        dropped = 0
+        for isbn in isbns:
+            book = self.find_one(isbn)
+            if book is not None:
+                dropped += len(book.expire_reservations(now))
+        return dropped
+
+    def reserved_by(self, user):
+        """(book, position in its reservation queue) pairs; 0 is next in line."""
+        self.hydrate()
+        ret = []
+        with self._lock:
+            for isbn in sorted(self._reserved.get(user, ())):
+                book = self._index[isbn]
+                try:
+                    ret.append((book, book.reservations.index(user)))
+                except ValueError: # un_reserved, and about to tell us so
+                    pass
+        return ret
+
+    def delete(self, isbn):
+        with self._lock:
+            book = self._index.pop(isbn, None)
+            if book is None:
+                raise NoMatchingBookError("No book with ISBN '%s'" % isbn)
+            self._order = None
+            if type(book) is _Unhydrated:
+                self._pending -= 1
+                book = book.factory()
+            else:
+                self._removed(book, isbn)
+            self.facets.forget(isbn)
+            clock.tick()
+            self._publish('delete', isbn, book)
+            return book
+
+# ----------------------------------------------------------------------
+
+class RepresentationCache(object):
+    """Caches the user-independent JSON of each book, per URL prefix.
+
+    Entries are keyed by (isbn, prefix, pretty) and stamped with the book's
+    version, so a book that has changed since it was rendered misses and
+    replaces its stale entry. The least recently used entries are dropped
+    once there are more than `max_entries`.
+
+    Callers hold the book's lock, so its version matches what `render`
+    sees.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, book, prefix, render, pretty=False):
+        key = (book.isbn, prefix, pretty)
+        version = book.version
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                self._entries[key] = entry
+                return entry[1]
+            self.misses += 1
+        entry = (version, render())
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, entries=len(self._entries))
+
+    def render_metrics(self):
+        """Prometheus lines for the stats (see metrics.Metrics.collect)."""
+        stats = self.stats()
+        return [
+            '# HELP library_representation_cache_requests_total Book renderings asked for, by result.',
+            '# TYPE library_representation_cache_requests_total counter',
+            'library_representation_cache_requests_total{result="hit"} %d' % stats['hits'],
+            'library_representation_cache_requests_total{result="miss"} %d' % stats['misses'],
+            '# HELP library_representation_cache_entries Book renderings held.',
+            '# TYPE library_representation_cache_entries gauge',
+            'library_representation_cache_entries %d' % stats['entries'],
+            ]
+
+# ----------------------------------------------------------------------
+
+class LinkTemplates(object):
+    """The `_links` of books under one URL prefix, precompiled.
+
+    `links` builds the list of link dicts; `json` fills the ISBN and user
+    into the links' JSON (as embedded by Book.to_json), rendered once per
+    combination of options and layout.
+    """
+    ISBN = '\x01isbn\x01'
+    USER = '\x01user\x01'
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.books = prefix + '/books/'
+        self.actions = ((Book.RESERVE, prefix + '/docs#reserve', '/reservations', ''),
+                        (Book.BORROW, prefix + '/docs#borrow', '/borrower', ''),
+                        (Book.RETURN, prefix + '/docs#return', '/return', ''),
+                        (Book.CANCEL, prefix + '/docs#cancel', '/reservations/', '/cancel'),
+                        (Book.THUMBNAIL, prefix + '/docs#thumbnail', '/thumbnail', ''))
+        self._json = ([None] * 32, [None] * 32) # compact, pretty
+
+    def links(self, flags, isbn, for_user=''):
+        href = self.books + isbn
+        ret = [dict(rel='self', href=href)]
+        for flag, rel, tail, user_tail in self.actions:
+            if flags & flag:
+                if user_tail:
+                    ret.append(dict(rel=rel, href=href + tail + for_user + user_tail))
+                else:
+                    ret.append(dict(rel=rel, href=href + tail))
+        return ret
+
+    def json(self, flags, isbn, for_user='', pretty=False):
+        templates = self._json[pretty]
+        template = templates[flags]
+        if template is None:
+            links = self.links(flags, self.ISBN, self.USER)
+            if pretty:
+                text = json.dumps(links, indent=2).replace('\n', '\n  ')
+            else:
+                text = json.dumps(links, separators=(',', ':'))
+            text = text.replace('%', '%%')
+            for marker, name in ((self.ISBN, 'isbn'), (self.USER, 'user')):
+                text = text.replace(json.dumps(marker)[1:-1], '%%(%s)s' % name)
+            template = templates[flags] = text
+        values = {'isbn': encode_basestring_ascii(isbn)[1:-1]}
+        if flags & Book.CANCEL:
+            values['user'] = encode_basestring_ascii(for_user)[1:-1]
+        return template % values
+
+MAX_LINK_TEMPLATES = 64
+_link_templates = {}
+
+def link_templates(prefix):
+    """The LinkTemplates for `prefix`, kept for the few prefixes (hosts)
+    the service is reached by."""
+    templates = _link_templates.get(prefix)
+    if templates is None:
+        if len(_link_templates) >= MAX_LINK_TEMPLATES:
+            _link_templates.clear()
+        templates = _link_templates[prefix] = LinkTemplates(prefix)
+    return templates
 
 # ----------------------------------------------------------------------
 
@@ -56,11 +842,45 @@ class Book(object):
     CAN_RETURN  = 'can_return'
     CAN_CANCEL  = 'can_cancel'
 
+    # get_options as bits (see option_flags).
+    RESERVE = 1
+    BORROW  = 2
+    RETURN  = 4
+    CANCEL  = 8
+    OPTIONS = ((RESERVE, CAN_RESERVE), (BORROW, CAN_BORROW),
+               (RETURN, CAN_RETURN), (CANCEL, CAN_CANCEL))
+    # Not an option: the book has a thumbnail to link to (see link_flags).
+    THUMBNAIL = 16
+
+    # Seconds the first reserver has to borrow the book once it is free for
+    # them, and seconds any reservation lasts; None for no limit. See
+    # expire_reservations.
+    hold_window = None
+    reservation_expiry = None
+
+    # The catalogue fields `update` may change; the rest change by the
+    # state transitions.
+    EDITABLE = ('title', 'description', 'author', 'publisher', 'small_thumbnail',
+                'thumbnail', 'published_date')
+
     repository = None
+    _repository_lock = threading.Lock()
+    representations = RepresentationCache()
+
+    # '__dict__' keeps per-instance overrides (e.g. test doubles) possible;
+    # the dict itself is only allocated when something is assigned to it.
+    # '__weakref__' lets an SQLiteRepository forget the books no one uses.
+    __slots__ = ('title', '_description', 'isbn', '_borrower', 'author',
+                 'publisher', '_small_thumbnail', '_thumbnail', 'reservations',
+                 'published_date', 'version', '_owner', '__dict__', '__weakref__')
+
+    description = _lazy_field('_description')
+    small_thumbnail = _lazy_field('_small_thumbnail')
+    thumbnail = _lazy_field('_thumbnail')
 
     def __init__(self, title, description, isbn, borrower='', author='',
                  publisher='', small_thumbnail='', thumbnail='',
-                 reservations=None):
+                 reservations=None, published_date=''):
         self.title = title
         self.description = description
         self.isbn = isbn
@@ -69,41 +889,155 @@ class Book(object):
         self.publisher = publisher
         self.small_thumbnail = small_thumbnail
         self.thumbnail = thumbnail
-        self.reservations = reservations or []
-        
-    def reserve(self, reserver):
+        if reservations:
+            self.reservations = ReservationQueue(intern_name(r) for r in reservations)
+        else:
+            self.reservations = NO_RESERVATIONS
+        self.published_date = published_date
+        self._owner = None  # the Repository holding this book, if any
+        # Not a change until it is stored.
+        self.version = clock.stamp()
+
+    @property
+    def modified(self):
+        """When the book last changed (see Clock.modified)."""
+        return clock.modified(self.version)
+
+    def touch(self):
+        """Record that the book has changed, invalidating cached renderings."""
+        self.version = clock.tick()
+
+    def _changed(self, action, user):
+        if self._owner is REHEARSAL:
+            return # not a change to anything (see copy)
+        self.touch()
+        if self._owner is not None:
+            self._owner.book_changed(self, action, user)
+
+    def copy(self, rehearsal=False):
+        """A detached copy of the book's state, reservation deadlines and
+        hold included. Changes to a `rehearsal` copy, which only try out
+        transitions (see apply_batch), don't even tick the clock."""
+        with self.lock():
+            book = Book(self.title, self._description, self.isbn, self.borrower,
+                        author=self.author, publisher=self.publisher,
+                        small_thumbnail=self._small_thumbnail, thumbnail=self._thumbnail,
+                        published_date=self.published_date)
+            if self.reservations:
+                book.reservations = self.reservations.copy()
+            if rehearsal:
+                book._owner = REHEARSAL
+            return book
+
+    def update(self, if_version=None, **fields):
+        """Change any of the EDITABLE fields; only if `if_version(version)`
+        holds for the book's current version, when given, else raising
+        VersionConflictError."""
+        for name in fields:
+            if name not in self.EDITABLE:
+                raise TypeError("'%s' is not an editable field" % name)
+        with self.lock():
+            if if_version is not None and not if_version(self.version):
+                raise VersionConflictError('The book has changed')
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self._changed('update', None)
+
+    @property
+    def borrower(self):
+        return self._borrower
+
+    @borrower.setter
+    def borrower(self, borrower):
+        self._borrower = intern_name(borrower)
+
+    def lock(self):
+        """The lock serialising this book's state transitions."""
+        return lock_for(self.isbn)
+
+    # The state transitions take the current time as `now`, if given,
+    # rather than reading the clock (see apply_batch).
+
+    def reserve(self, reserver, now=None):
         assert reserver and reserver.strip() != ''
-        if not reserver in self.reservations:
-            self.reservations.append(reserver)
+        with self.lock():
+            if not reserver in self.reservations:
+                if self.reservations is NO_RESERVATIONS:
+                    self.reservations = ReservationQueue()
+                expiry = Book.reservation_expiry
+                self.reservations.append(intern_name(reserver),
+                                         None if expiry is None else (now or time.time()) + expiry)
+                self._hold_for_first(now)
+                self._changed('reserve', reserver)
 
-    def un_reserve(self, reserver):
+    def un_reserve(self, reserver, now=None):
         assert reserver and reserver.strip() != ''
-        if not reserver in self.reservations:
-            raise NotReservedError('Not reserved by this user')
-        self.reservations.remove(reserver)
+        self._un_reserve(reserver, now)
 
-    def check_out(self, borrower):
+    def _un_reserve(self, reserver, now=None):
+        with self.lock():
+            if not reserver in self.reservations:
+                raise NotReservedError('Not reserved by this user')
+            self.reservations.remove(reserver)
+            if not self.reservations:
+                self.reservations = NO_RESERVATIONS
+            self._hold_for_first(now)
+            self._changed('un_reserve', reserver)
+
+    def _hold_for_first(self, now=None):
+        """Start the first reserver's hold, if the book is free for them."""
+        reservations = self.reservations
+        if Book.hold_window is None or not reservations or self.borrower:
+            return
+        first = reservations[0]
+        if reservations.held != first:
+            reservations.held = first
+            reservations.set_deadline(first, (now or time.time()) + Book.hold_window)
+
+    def expire_reservations(self, now=None):
+        """Drop, as un_reserve would, the reservations whose deadline has
+        passed: holds not taken up in time, and reservations older than
+        Book.reservation_expiry. Returns the users dropped."""
+        if now is None:
+            now = time.time()
+        with self.lock():
+            if not self.reservations:
+                return []
+            lapsed = self.reservations.lapsed(now)
+            for user in lapsed:
+                self._un_reserve(user, now)
+            return lapsed
+
+    def check_out(self, borrower, now=None):
         assert borrower and borrower.strip() != ''
 
-        if self.status() == Book.BORROWED:
-            raise AlreadyOnLoanError('Already on loan')
+        with self.lock():
+            if self.status() == Book.BORROWED:
+                raise AlreadyOnLoanError('Already on loan')
 
-        if self.reservations:
-            if self.reservations[0] == borrower:
-                self.reservations.pop(0)
-            else:
-                raise BorrowingWhileReservedError('Book is reserved')
+            self.expire_reservations(now)
+            if self.reservations:
+                if self.reservations[0] == borrower:
+                    self.reservations.popleft()
+                    if not self.reservations:
+                        self.reservations = NO_RESERVATIONS
+                else:
+                    raise BorrowingWhileReservedError('Book is reserved')
 
-        self.borrower = borrower
+            self.borrower = borrower
+            self._changed('check_out', borrower)
 
-    def check_in(self, borrower):
+    def check_in(self, borrower, now=None):
         assert borrower and borrower.strip() != ''
-        if self.status() != Book.BORROWED:
-            raise NotCheckedOutError('Book is not checked out')
-        if self.borrower != borrower:
-            raise NotTheBorrowerError('User did not check out this book')
+        with self.lock():
+            if self.status() != Book.BORROWED:
+                raise NotCheckedOutError('Book is not checked out')
+            if self.borrower != borrower:
+                raise NotTheBorrowerError('User did not check out this book')
 
-        self.borrower = ''
+            self.borrower = ''
+            self._hold_for_first(now)
+            self._changed('check_in', borrower)
 
     def status(self):
         if self.borrower:
@@ -111,71 +1045,136 @@ class Book(object):
         else:
             return Book.AVAILABLE
 
-    def get_options(self, for_user):
-        options = {}
-        is_borrower       = self.borrower != '' and for_user == self.borrower
-        is_reserver       = for_user in self.reservations
-        is_first_reserver = is_reserver and self.reservations[0] == for_user
+    def option_flags(self, for_user):
+        """What `for_user` may do with the book, as a bitmask of RESERVE,
+        BORROW, RETURN and CANCEL."""
+        with self.lock():
+            borrower = self.borrower
+            reservations = self.reservations
+            is_borrower = borrower != '' and for_user == borrower
+            is_reserver = for_user in reservations
+            is_first_reserver = is_reserver and reservations[0] == for_user
 
-        options[Book.CAN_RESERVE] = not(is_borrower or is_reserver)
-        options[Book.CAN_BORROW] = (is_first_reserver or not self.reservations) and not self.borrower
-        options[Book.CAN_RETURN] = is_borrower
-        options[Book.CAN_CANCEL] = is_reserver
+        flags = 0
+        if not (is_borrower or is_reserver):
+            flags |= Book.RESERVE
+        if (is_first_reserver or not reservations) and not borrower:
+            flags |= Book.BORROW
+        if is_borrower:
+            flags |= Book.RETURN
+        if is_reserver:
+            flags |= Book.CANCEL
+        return flags
 
-        # Only return true values (makes using things easier).
-        for key in options.keys():
-            if not options[key]: options.pop(key) 
-        return options
+    def get_options(self, for_user):
+        # Only the true values (makes using things easier).
+        flags = self.option_flags(for_user)
+        return dict((name, True) for flag, name in Book.OPTIONS if flags & flag)
 
-    def links(self, for_user='', prefix=''):
-        ret = []
-        options = self.get_options(for_user)
+    def link_flags(self, for_user):
+        """option_flags, with THUMBNAIL set if the book has a thumbnail."""
+        flags = self.option_flags(for_user)
+        if self.thumbnail:
+            flags |= Book.THUMBNAIL
+        return flags
 
-        ret.append(dict(rel='self', href=prefix + '/books/' + self.isbn))
+    def links(self, for_user='', prefix=''):
+        return link_templates(prefix).links(self.link_flags(for_user), self.isbn, for_user)
 
-        if options.get(Book.CAN_RESERVE, False):
-            ret.append(dict(rel=prefix + '/docs#reserve', href=prefix + '/books/' + self.isbn + '/reservations'))
+    def to_json(self, for_user='', prefix='', pretty=False):
+        """The book as compact JSON, or indented if `pretty`."""
+        # Only the _links depend on the user; the rest comes from the cache.
+        with self.lock():
+            render = self._pretty_data_json if pretty else self._data_json
+            body = Book.representations.get(self, prefix, render, pretty)
+            links = link_templates(prefix).json(self.link_flags(for_user), self.isbn,
+                                                for_user, pretty)
+        if pretty:
+            return body + ',\n  "_links": ' + links + '\n}'
+        return body + ',"_links":' + links + '}'
 
-        if options.get(Book.CAN_BORROW, False):
-            ret.append(dict(rel=prefix + '/docs#borrow', href=prefix + '/books/' + self.isbn + '/borrower'))
+    def _data(self):
+        return dict(title=self.title,
+                    description=self.description,
+                    isbn=self.isbn,
+                    borrower=self.borrower,
+                    reservations=list(self.reservations),
+                    author=self.author,
+                    publisher=self.publisher,
+                    small_thumbnail=self.small_thumbnail,
+                    thumbnail=self.thumbnail,
+                    published_date=self.published_date)
 
-        if options.get(Book.CAN_RETURN, False):
-            ret.append(dict(rel=prefix + '/docs#return', href=prefix + '/books/' + self.isbn + '/return'))
+    # Both leave the object open (no closing "}") for the _links.
 
-        if options.get(Book.CAN_CANCEL, False):
-            ret.append(dict(rel=prefix + '/docs#cancel', href=prefix + '/books/' + self.isbn + '/reservations/' + for_user + '/cancel'))
+    def _data_json(self):
+        return json.dumps(self._data(), separators=(',', ':'))[:-1]
 
-        return ret
+    def _pretty_data_json(self):
+        return json.dumps(self._data(), indent=2)[:-2]
 
-    def to_json(self, for_user='', prefix=''):
-        js = dict(title=self.title,
-                  description=self.description,
-                  isbn=self.isbn,
-                  borrower=self.borrower,
-                  reservations=self.reservations,
-                  author=self.author,
-                  publisher=self.publisher,
-                  small_thumbnail=self.small_thumbnail,
-                  thumbnail=self.thumbnail,
-                  _links=self.links(for_user, prefix))
-        return json.dumps(js, indent=2)
+    @classmethod
+    def get_repository(cls):
+        if cls.repository is None:
+            with cls._repository_lock:
+                if cls.repository is None:
+                    cls.repository = Repository()
+        return cls.repository
 
     @classmethod
     def find(cls):
-        if not cls.repository:
-            cls.repository = Repository()
-        return cls.repository.find()
+        return cls.get_repository().find()
 
     @classmethod
     def find_one(cls, isbn=None):
-        if not cls.repository:
-            cls.repository = Repository()
-        return cls.repository.find_one(isbn)
+        return cls.get_repository().find_one(isbn)
 
     @classmethod
     def store(cls, book):
-        if not cls.repository:
-            cls.repository = Repository()
-        cls.repository.store(book)
+        cls.get_repository().store(book)
+
+    @classmethod
+    def page(cls, offset, limit):
+        return cls.get_repository().page(offset, limit)
+
+    @classmethod
+    def page_at(cls, cursor, limit):
+        return cls.get_repository().page_at(cursor, limit)
+
+    @classmethod
+    def search(cls, query):
+        return cls.get_repository().search(query)
+
+    @classmethod
+    def apply_batch(cls, operations, atomic=False):
+        return cls.get_repository().apply_batch(operations, atomic)
+
+    @classmethod
+    def users(cls):
+        return cls.get_repository().users()
+
+    @classmethod
+    def borrowed_by(cls, user):
+        return cls.get_repository().borrowed_by(user)
+
+    @classmethod
+    def select(cls, filters, query=''):
+        return cls.get_repository().select(filters, query)
+
+    @classmethod
+    def facet_counts(cls):
+        return cls.get_repository().facet_counts()
+
+    @classmethod
+    def summary(cls, top=10):
+        return cls.get_repository().summary(top)
+
+    @classmethod
+    def ranking(cls, field, offset, limit):
+        return cls.get_repository().ranking(field, offset, limit)
+
+    @classmethod
+    def reserved_by(cls, user):
+        return cls.get_repository().reserved_by(user)
 
 # ----------------------------------------------------------------------
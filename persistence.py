@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""Durable storage for a Repository: a write-ahead journal plus snapshots.
+
+Every mutation the repository reports to its listeners is appended to the
+journal as one compact JSON line, `[sequence, action, isbn, payload]`.
+Appends only write to the file buffer; a background thread fsyncs
+whatever has accumulated every `sync_interval` seconds (or as soon as
+`sync_batch` records are waiting), so many mutations share one fsync.
+`Journal.sync()` blocks until everything appended so far is durable.
+
+A snapshot is the whole catalogue as JSON lines: `[format, sequence]`,
+the sequence number of the last journal record it includes, then one book
+state per line. Recovery loads the latest snapshot and replays the journal
+records that follow it. (Format 1 snapshots, `marshal`led, are still read,
+but only by the Python version that wrote them can be relied on to.)
+
+Files, in the state directory:
+
+    snapshot       the latest snapshot
+    journal        records since the latest snapshot
+    journal.old    records from before it, until that snapshot is written
+"""
+import json
+import marshal
+import os
+import threading
+
+from models import (Book, BOOK_LOCKS, AlreadyOnLoanError, BorrowingWhileReservedError,
+                    NotReservedError, NotCheckedOutError, NotTheBorrowerError,
+                    NoMatchingBookError)
+
+SNAPSHOT_FORMAT = 2
+
+replace = getattr(os, 'replace', os.rename) # Python 2 has no os.replace.
+
+# ----------------------------------------------------------------------
+
+def book_state(book):
+    return (book.title, book.description, book.isbn, book.borrower, book.author,
+            book.publisher, book.small_thumbnail, book.thumbnail,
+            list(book.reservations), book.published_date)
+
+def book_from_state(state):
+    (title, description, isbn, borrower, author, publisher, small_thumbnail,
+     thumbnail, reservations, published_date) = state
+    return Book(title, description, isbn, borrower, author=author, publisher=publisher,
+                small_thumbnail=small_thumbnail, thumbnail=thumbnail,
+                reservations=reservations, published_date=published_date)
+
+def replay(repository, action, isbn, payload):
+    """Apply one journal record to `repository`."""
+    if action == 'store':
+        repository.store(book_from_state(payload))
+    else:
+        try:
+            if action == 'delete':
+                repository.delete(isbn)
+                return
+            book = repository.find_one(isbn)
+            if book is None:
+                return # deleted later on, e.g. before the snapshot
+            getattr(book, action)(payload)
+        except (AlreadyOnLoanError, BorrowingWhileReservedError, NotReservedError,
+                NotCheckedOutError, NotTheBorrowerError, NoMatchingBookError):
+            # Already reflected, e.g. in the snapshot.
+            pass
+
+def fsync_directory(path):
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+# ----------------------------------------------------------------------
+
+class Journal(object):
+    """An append-only file of records with group-committed fsyncs."""
+    def __init__(self, path, sequence=0, sync_interval=0.01, sync_batch=256):
+        self.path = path
+        self.sequence = sequence    # last sequence number appended
+        self.durable = sequence     # last sequence number fsynced
+        self.sync_interval = sync_interval
+        self.sync_batch = sync_batch
+        self.syncs = 0
+        self._file = open(path, 'ab')
+        self._lock = threading.Condition(threading.Lock())
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_forever, name='journal-sync')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def append(self, action, isbn, payload):
+        with self._lock:
+            self.sequence += 1
+            line = json.dumps([self.sequence, action, isbn, payload], separators=(',', ':'))
+            self._file.write(line.encode('utf-8') + b'\n')
+            if self.sequence - self.durable >= self.sync_batch:
+                self._lock.notify_all()
+            return self.sequence
+
+    def sync(self):
+        """Block until every record appended so far is on disk."""
+        with self._lock:
+            target = self.sequence
+            while self.durable < target and not self._closed:
+                self._lock.notify_all()
+                self._lock.wait(self.sync_interval)
+
+    def _flush(self):
+        if self.durable < self.sequence:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.durable = self.sequence
+            self.syncs += 1
+            self._lock.notify_all()
+
+    def _flush_forever(self):
+        while True:
+            with self._lock:
+                self._lock.wait(self.sync_interval)
+                if self._closed:
+                    return
+                if self.durable >= self.sequence:
+                    continue
+                self._file.flush()
+                target, f = self.sequence, self._file
+            # fsync without the lock, so appends carry on meanwhile and
+            # join the next group.
+            try:
+                os.fsync(f.fileno())
+            except (ValueError, OSError): # rotated (and fsynced) meanwhile
+                pass
+            with self._lock:
+                self.durable = max(self.durable, target)
+                self.syncs += 1
+                self._lock.notify_all()
+
+    def rotate(self, old_path):
+        """Move everything written so far to `old_path`; carry on in a new file."""
+        with self._lock:
+            self._flush()
+            self._file.close()
+            replace(self.path, old_path)
+            self._file = open(self.path, 'ab')
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._flush()
+            self._closed = True
+            self._file.close()
+            self._lock.notify_all()
+        self._flusher.join()
+
+def read_journal(path, offset=0):
+    """Yield (record, offset just past it) for the records in `path` from
+    byte `offset` on, stopping at a torn final line."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+            offset += len(line)
+            yield record, offset
+
+# ----------------------------------------------------------------------
+
+class Persistence(object):
+    """Keeps `repository` durable in the directory `path`.
+
+    Call `recover()` once at startup, before anything else touches the
+    repository; from then on every mutation is journaled, and a snapshot
+    is taken after every `snapshot_every` journal records.
+    """
+    def __init__(self, path, repository=None, snapshot_every=10000, **journal_options):
+        if repository is None:
+            repository = Book.get_repository()
+        self.path = path
+        self.repository = repository
+        self.snapshot_every = snapshot_every
+        self.journal_options = journal_options
+        self.journal = None
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_sequence = 0
+        self._snapshotter = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    # Recovery ---------------------------------------------------------
+
+    def recover(self):
+        """Load the latest snapshot and replay the journal after it, then
+        start journaling. Returns the number of records replayed."""
+        sequence = self._load_snapshot()
+        self._snapshot_sequence = sequence
+        replayed = 0
+        for name in ('journal.old', 'journal'):
+            valid = 0
+            for record, valid in read_journal(self._file(name)):
+                if record[0] <= sequence:
+                    continue
+                replay(self.repository, *record[1:])
+                sequence = record[0]
+                replayed += 1
+            if name == 'journal' and os.path.exists(self._file(name)):
+                # Drop a torn final record, so new ones aren't written after it.
+                with open(self._file(name), 'ab') as f:
+                    f.truncate(valid)
+        self.journal = Journal(self._file('journal'), sequence, **self.journal_options)
+        self.repository.subscribe(self._record)
+        if os.path.exists(self._file('journal.old')):
+            # A snapshot was interrupted; finish the job.
+            self.snapshot()
+        return replayed
+
+    def _load_snapshot(self):
+        path = self._file('snapshot')
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'rb') as f:
+            if f.read(1) != b'[':
+                f.seek(0)
+                format, sequence, states = marshal.load(f)
+                assert format == 1, 'Unknown snapshot format %r' % format
+            else:
+                f.seek(0)
+                format, sequence = json.loads(f.readline().decode('utf-8'))
+                assert format == SNAPSHOT_FORMAT, 'Unknown snapshot format %r' % format
+                states = (json.loads(line.decode('utf-8')) for line in f)
+            for state in states:
+                self.repository.store(book_from_state(state))
+        return sequence
+
+    # Journaling -------------------------------------------------------
+
+    def _record(self, action, isbn, book, user):
+        if action in ('store', 'update'):
+            # An update is journalled as the state it leaves, like a store.
+            action, payload = 'store', book_state(book)
+        else:
+            payload = user
+        sequence = self.journal.append(action, isbn, payload)
+        if sequence - self._snapshot_sequence >= self.snapshot_every:
+            self._snapshot_sequence = sequence
+            self._snapshotter = threading.Thread(target=self.snapshot, name='snapshot')
+            self._snapshotter.daemon = True
+            self._snapshotter.start()
+
+    def sync(self):
+        self.journal.sync()
+
+    # Snapshots --------------------------------------------------------
+
+    def snapshot(self):
+        """Write a snapshot of the whole repository, and drop the journal
+        records it makes redundant."""
+        with self._snapshot_lock:
+            repository = self.repository
+            repository.hydrate()
+            # Every book lock, then the repository's: nothing can change
+            # while the state is captured and the journal rotated.
+            for lock in BOOK_LOCKS:
+                lock.acquire()
+            try:
+                with repository._lock:
+                    states = [book_state(bk) for bk in repository.find()]
+                    sequence = self.journal.sequence if self.journal else 0
+                    if self.journal:
+                        self.journal.rotate(self._file('journal.old'))
+            finally:
+                for lock in BOOK_LOCKS:
+                    lock.release()
+
+            temporary = self._file('snapshot.tmp')
+            with open(temporary, 'wb') as f:
+                f.write(json.dumps([SNAPSHOT_FORMAT, sequence]).encode('utf-8') + b'\n')
+                encode = json.JSONEncoder(separators=(',', ':')).encode
+                for start in range(0, len(states), 1000):
+                    lines = [encode(state) for state in states[start:start + 1000]]
+                    f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+            replace(temporary, self._file('snapshot'))
+            fsync_directory(self.path)
+            if os.path.exists(self._file('journal.old')):
+                os.remove(self._file('journal.old'))
+            self._snapshot_sequence = sequence
+            return sequence
+
+    def close(self):
+        if self.journal:
+            self.repository.unsubscribe(self._record)
+            if self._snapshotter:
+                self._snapshotter.join()
+            self.journal.close()
+            self.journal = None
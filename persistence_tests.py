@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+from nose.tools import assert_equals, assert_is_none, assert_is_not_none
+import json
+import marshal
+import os
+import shutil
+import tempfile
+
+from models import Repository, Book
+from persistence import Persistence, read_journal, replay, book_state
+
+# ----------------------------------------------------------------------
+
+def setup():
+    global state_dir
+    state_dir = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(state_dir)
+
+def fresh_dir():
+    return tempfile.mkdtemp(dir=state_dir)
+
+def reopen(path, **options):
+    r = Repository()
+    p = Persistence(path, r, **options)
+    p.recover()
+    return r, p
+
+def make_changes(r):
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN1'))
+    r.store(Book('TITLE2', 'DESCRIPTION2', 'ISBN2'))
+    r.find_one('ISBN1').check_out('BORROWER')
+    r.find_one('ISBN1').reserve('RESERVER')
+    r.find_one('ISBN1').reserve('OTHER')
+    r.find_one('ISBN1').un_reserve('OTHER')
+    r.find_one('ISBN2').reserve('RESERVER')
+    r.find_one('ISBN2').check_out('RESERVER')
+    r.find_one('ISBN2').check_in('RESERVER')
+
+def check_changes(r):
+    assert_equals(2, len(r.find()))
+    bk = r.find_one('ISBN1')
+    assert_equals('BORROWER', bk.borrower)
+    assert_equals(['RESERVER'], list(bk.reservations))
+    assert_equals(Book.AVAILABLE, r.find_one('ISBN2').status())
+    assert_equals([bk], r.borrowed_by('BORROWER'))
+
+# ----------------------------------------------------------------------
+
+def test_recover_from_journal():
+    path = fresh_dir()
+    r, p = reopen(path)
+    make_changes(r)
+    p.close()
+
+    r, p = reopen(path)
+    check_changes(r)
+    p.close()
+
+def test_recover_from_snapshot_and_journal():
+    path = fresh_dir()
+    r, p = reopen(path)
+    make_changes(r)
+    p.snapshot()
+    r.find_one('ISBN1').check_in('BORROWER')
+    r.delete('ISBN2')
+    p.close()
+
+    assert_equals(2, len(list(read_journal(os.path.join(path, 'journal')))))
+    r, p = reopen(path)
+    assert_equals(1, len(r.find()))
+    assert_equals(Book.AVAILABLE, r.find_one('ISBN1').status())
+    assert_equals(['RESERVER'], list(r.find_one('ISBN1').reservations))
+    p.close()
+
+def test_snapshot_is_json_lines():
+    path = fresh_dir()
+    r, p = reopen(path)
+    make_changes(r)
+    p.snapshot()
+    p.close()
+    with open(os.path.join(path, 'snapshot'), 'rb') as f:
+        lines = [json.loads(line.decode('utf-8')) for line in f]
+    assert_equals([2, 9], lines[0])
+    assert_equals(['ISBN1', 'ISBN2'], [state[2] for state in lines[1:]])
+
+def test_recover_from_marshalled_snapshot():
+    path = fresh_dir()
+    states = [book_state(Book('TITLE', 'DESCRIPTION', 'ISBN1', 'BORROWER'))]
+    with open(os.path.join(path, 'snapshot'), 'wb') as f:
+        marshal.dump((1, 3, states), f)
+    r, p = reopen(path)
+    assert_equals('BORROWER', r.find_one('ISBN1').borrower)
+    p.close()
+
+def test_replay_skips_records_for_books_since_deleted():
+    r = Repository()
+    replay(r, 'check_out', 'GONE', 'BORROWER')
+    assert_equals(0, len(r.find()))
+
+def test_snapshots_taken_periodically():
+    path = fresh_dir()
+    r, p = reopen(path, snapshot_every=5)
+    make_changes(r)
+    p.close()
+    assert os.path.exists(os.path.join(path, 'snapshot'))
+
+    r, p = reopen(path)
+    check_changes(r)
+    p.close()
+
+def test_store_under_new_isbn_is_recovered():
+    path = fresh_dir()
+    r, p = reopen(path)
+    bk = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    r.store(bk)
+    bk.isbn = 'NEWISBN'
+    r.store(bk)
+    p.close()
+
+    r, p = reopen(path)
+    assert_is_none(r.find_one('ISBN'))
+    assert_is_not_none(r.find_one('NEWISBN'))
+    p.close()
+
+def test_torn_final_record_is_dropped():
+    path = fresh_dir()
+    r, p = reopen(path)
+    make_changes(r)
+    p.close()
+    with open(os.path.join(path, 'journal'), 'ab') as f:
+        f.write(b'[99,"check_in","ISB')
+
+    r, p = reopen(path)
+    check_changes(r)
+    r.find_one('ISBN1').check_in('BORROWER')
+    p.close()
+
+    r, p = reopen(path)
+    assert_equals(Book.AVAILABLE, r.find_one('ISBN1').status())
+    p.close()
+
+def test_sync_waits_for_fsync():
+    path = fresh_dir()
+    r, p = reopen(path, sync_interval=60)
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN'))
+    p.sync()
+    assert_equals(p.journal.sequence, p.journal.durable)
+    p.close()
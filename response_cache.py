@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""Whole responses, cached.
+
+`ResponseCache`, installed in a Bottle app, keeps the bodies and headers
+of the GET routes declared with a `cache` scope:
+
+    @get('/library/api/docs', cache='static')       # never changes
+    @get('/library/api/books', cache='catalogue')   # changes with the books
+
+Responses are keyed by path, query string, Accept header and what the
+URL prefix is built from (the Host and forwarding headers), so each host
+gets its own links. Catalogue responses are stamped with the catalogue's
+clock, which every change to the repository ticks (building a lazily
+stored book included); once it has moved on they are rendered afresh. The least recently used go once the bodies
+come to more than `max_bytes`.
+
+When several requests miss on the same key at once, one renders the
+response and the others wait for it. A streamed body is read into memory
+as it is rendered, so that the waiting requests needn't wait for the
+first client to take all of it; one that turns out bigger than
+`max_entry_bytes` is streamed on from there, and the waiting requests
+render their own. Conditional
+and HEAD requests bypass the cache, and responses other than 200 and
+bodies over `max_entry_bytes` aren't kept.
+
+Hits, misses, coalesced requests and bytes are reported with the rest
+of the metrics (metrics.Metrics.collect).
+"""
+import functools
+import threading
+from collections import OrderedDict
+from itertools import chain
+
+from bottle import request, response
+
+from metrics import METRICS
+from models import clock
+
+try:
+    text_type = unicode
+except NameError: # Python 3
+    text_type = str
+
+SCOPES = ('static', 'catalogue')
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_MAX_ENTRY_BYTES = 1024 * 1024
+COALESCE_TIMEOUT = 30   # seconds to wait for another request's rendering
+
+# What get_prefix builds the URL prefix from.
+PREFIX_ENVIRON = ('HTTP_X_FORWARDED_PROTO', 'wsgi.url_scheme', 'HTTP_X_FORWARDED_HOST',
+                  'HTTP_HOST', 'SERVER_NAME', 'SERVER_PORT')
+
+# ----------------------------------------------------------------------
+
+def closing(iterator, close):
+    """Yield from `iterator`, then (or when closed early) call `close`."""
+    try:
+        for item in iterator:
+            yield item
+    finally:
+        close()
+
+class Entry(object):
+    __slots__ = ('stamp', 'headers', 'body', 'size')
+
+    def __init__(self, stamp, headers, body):
+        self.stamp = stamp
+        self.headers = headers
+        self.body = body
+        self.size = len(body)
+
+class ResponseCache(object):
+    """A Bottle plugin caching the responses of routes with a `cache`
+    scope. Thread-safe."""
+    name = 'response_cache'
+    api = 2
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_entry_bytes=DEFAULT_MAX_ENTRY_BYTES,
+                 metrics=METRICS):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.json_dumps = None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> Entry, least recently used first
+        self._rendering = {}            # key -> threading.Event set once rendered
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.bytes_served = 0
+        if metrics is not None:
+            metrics.collect(self.render_metrics)
+
+    def setup(self, app):
+        # Inside Bottle's JSON plugin, like MetricsPlugin: dicts are turned
+        # into JSON here, to be cached as such.
+        for other in app.plugins:
+            if getattr(other, 'name', None) == 'json':
+                self.json_dumps = other.json_dumps
+
+    def apply(self, callback, route):
+        scope = route.config.get('cache')
+        if scope is None:
+            return callback
+        if scope not in SCOPES:
+            raise ValueError('Unknown cache scope %r for %s' % (scope, route.rule))
+        cache = self
+
+        @functools.wraps(callback)
+        def cached(*args, **kwargs):
+            environ = request.environ
+            if (environ['REQUEST_METHOD'] != 'GET' or 'HTTP_IF_NONE_MATCH' in environ
+                    or 'HTTP_IF_MODIFIED_SINCE' in environ):
+                return callback(*args, **kwargs)
+            key = (environ.get('PATH_INFO'), environ.get('QUERY_STRING'), environ.get('HTTP_ACCEPT'),
+                   tuple(environ.get(name) for name in PREFIX_ENVIRON))
+            stamp = clock.last if scope == 'catalogue' else None
+            entry, rendering = cache._find(key, stamp)
+            if entry is None and rendering is not None:
+                # Someone else is rendering it: wait for theirs.
+                rendering.wait(COALESCE_TIMEOUT)
+                entry, rendering = cache._find(key, stamp, coalesced=True)
+                if entry is None:
+                    return callback(*args, **kwargs)
+            if entry is not None:
+                for name, value in entry.headers:
+                    response.set_header(name, value)
+                return entry.body
+            return cache._render(key, stamp, callback, args, kwargs)
+        return cached
+
+    def _find(self, key, stamp, coalesced=False):
+        """(the current entry for `key`, None), or (None, the Event to
+        wait on if it is being rendered), or (None, None) having started
+        rendering it (or, if `coalesced`, if it wasn't cached after all)."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                if entry.stamp == stamp:
+                    if coalesced:
+                        self.coalesced += 1
+                    else:
+                        self.hits += 1
+                    self.bytes_served += entry.size
+                    return entry, None
+            rendering = None if coalesced else self._rendering.get(key)
+            if rendering is None:
+                self.misses += 1
+                if not coalesced:
+                    self._rendering[key] = threading.Event()
+            return None, rendering
+
+    def _render(self, key, stamp, callback, args, kwargs):
+        try:
+            body = callback(*args, **kwargs)
+            if isinstance(body, dict) and self.json_dumps:
+                response.content_type = 'application/json'
+                body = self.json_dumps(body)
+            if response.status_code != 200 or body is None or hasattr(body, 'read'):
+                return body
+            headers = list(response.headers.items())
+            if isinstance(body, (bytes, text_type)):
+                if len(body) <= self.max_entry_bytes:
+                    self._store(key, Entry(stamp, headers, body))
+                return body
+            return self._read(key, stamp, headers, body)
+        finally:
+            self._rendered(key)
+
+    def _read(self, key, stamp, headers, body):
+        """The chunks of the streamed `body`, cached if they all come to
+        no more than max_entry_bytes; else those read so far, followed by
+        the rest of `body`."""
+        chunks = []
+        size = 0
+        iterator = iter(body)
+        for chunk in iterator:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > self.max_entry_bytes:
+                rest = chain(chunks, iterator)
+                return closing(rest, body.close) if hasattr(body, 'close') else rest
+        if hasattr(body, 'close'):
+            body.close()
+        self._store(key, Entry(stamp, headers, chunks[0][:0].join(chunks) if chunks else ''))
+        return chunks
+
+    def _rendered(self, key):
+        with self._lock:
+            rendering = self._rendering.pop(key)
+        rendering.set()
+
+    def _store(self, key, entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old.size
+            self._entries[key] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes and self._entries:
+                evicted = self._entries.popitem(last=False)[1]
+                self.bytes -= evicted.size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(entries=len(self._entries), bytes=self.bytes, hits=self.hits,
+                        misses=self.misses, coalesced=self.coalesced,
+                        evictions=self.evictions, bytes_served=self.bytes_served)
+
+    def render_metrics(self):
+        stats = self.stats()
+        return [
+            '# HELP library_response_cache_requests_total Cacheable requests, by result.',
+            '# TYPE library_response_cache_requests_total counter',
+            'library_response_cache_requests_total{result="hit"} %d' % stats['hits'],
+            'library_response_cache_requests_total{result="coalesced"} %d' % stats['coalesced'],
+            'library_response_cache_requests_total{result="miss"} %d' % stats['misses'],
+            '# HELP library_response_cache_served_bytes_total Response bytes served from the cache.',
+            '# TYPE library_response_cache_served_bytes_total counter',
+            'library_response_cache_served_bytes_total %d' % stats['bytes_served'],
+            '# HELP library_response_cache_bytes Response bytes held in the cache.',
+            '# TYPE library_response_cache_bytes gauge',
+            'library_response_cache_bytes %d' % stats['bytes'],
+            '# HELP library_response_cache_entries Responses held in the cache.',
+            '# TYPE library_response_cache_entries gauge',
+            'library_response_cache_entries %d' % stats['entries'],
+            '# HELP library_response_cache_evictions_total Responses dropped to make room.',
+            '# TYPE library_response_cache_evictions_total counter',
+            'library_response_cache_evictions_total %d' % stats['evictions'],
+            ]
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+from nose.tools import raises, assert_equals, assert_in
+import threading
+import time
+
+import bottle
+from webtest import TestApp
+
+from metrics import Metrics
+from models import clock
+from response_cache import ResponseCache
+
+def cached_app(**options):
+    """An app with a route of each kind, counting the calls to each."""
+    app = bottle.Bottle()
+    metrics = Metrics()
+    cache = app.install(ResponseCache(metrics=metrics, **options))
+    calls = dict(static=0, catalogue=0, stream=0, slow=0)
+
+    @app.get('/static', cache='static')
+    def static():
+        calls['static'] += 1
+        return dict(host=bottle.request.get_header('Host'), query=bottle.request.query_string)
+
+    @app.get('/catalogue', cache='catalogue')
+    def catalogue():
+        calls['catalogue'] += 1
+        bottle.response.set_header('X-Version', str(clock.last))
+        return 'version %d' % clock.last
+
+    @app.get('/stream', cache='static')
+    def stream():
+        calls['stream'] += 1
+        bottle.response.set_header('Content-Type', 'text/plain')
+        return ('%04d\n' % i for i in range(int(bottle.request.query.get('lines', 10))))
+
+    @app.get('/slow', cache='static')
+    def slow():
+        calls['slow'] += 1
+        time.sleep(0.1)
+        return 'slow'
+
+    @app.get('/missing', cache='static')
+    def missing():
+        calls['missing'] = calls.get('missing', 0) + 1
+        bottle.abort(404, 'Not here.')
+
+    return TestApp(app), cache, calls, metrics
+
+# ----------------------------------------------------------------------
+
+def test_keyed_by_path_query_and_host():
+    app, cache, calls, metrics = cached_app()
+    first = app.get('/static')
+    assert_equals(first.json, app.get('/static').json)
+    assert_equals('application/json', app.get('/static').content_type)
+    assert_equals(1, calls['static'])
+    assert_equals('a=1', app.get('/static', dict(a=1)).json['query'])
+    assert_equals('other.example.com', app.get('/static', headers={'Host': 'other.example.com'}).json['host'])
+    assert_equals(3, calls['static'])
+    assert_equals(dict(entries=3, hits=2, misses=3, coalesced=0, evictions=0),
+                  dict((key, value) for key, value in cache.stats().items()
+                       if key not in ('bytes', 'bytes_served')))
+
+def test_catalogue_responses_follow_the_clock():
+    app, cache, calls, metrics = cached_app()
+    res = app.get('/catalogue')
+    assert_equals(res.text, app.get('/catalogue').text)
+    assert_equals(str(clock.last), app.get('/catalogue').headers['X-Version'])
+    clock.tick()
+    assert_equals('version %d' % clock.last, app.get('/catalogue').text)
+    assert_equals(2, calls['catalogue'])
+
+def test_streams_are_cached_once_complete():
+    app, cache, calls, metrics = cached_app(max_entry_bytes=100)
+    assert_equals(''.join('%04d\n' % i for i in range(10)), app.get('/stream').text)
+    assert_equals(app.get('/stream').text, app.get('/stream').text)
+    assert_equals(1, calls['stream'])
+    # Too big to keep, but all sent.
+    assert_equals(50 * 5, len(app.get('/stream', dict(lines=50)).body))
+    assert_equals(50 * 5, len(app.get('/stream', dict(lines=50)).body))
+    assert_equals(3, calls['stream'])
+
+def test_waiters_dont_wait_for_the_first_client_to_read_a_stream():
+    app, cache, calls, metrics = cached_app()
+    first = app.app(app.RequestClass.blank('/stream').environ, lambda *args: None) # not read yet
+    second = []
+    thread = threading.Thread(target=lambda: second.append(app.get('/stream').text))
+    thread.start()
+    thread.join(5)
+    assert_equals([''.join('%04d\n' % i for i in range(10))], second)
+    assert_equals(b''.join(first).decode('ascii'), second[0])
+    assert_equals(1, calls['stream'])
+
+def test_conditional_requests_and_errors_bypass_the_cache():
+    app, cache, calls, metrics = cached_app()
+    app.get('/static')
+    app.get('/static', headers={'If-None-Match': '"1"'})
+    app.get('/missing', status=404)
+    app.get('/missing', status=404)
+    assert_equals(dict(static=2, missing=2), dict(static=calls['static'], missing=calls['missing']))
+
+def test_least_recently_used_go_first():
+    app, cache, calls, metrics = cached_app(max_bytes=100) # two of them
+    for query in ('a=1', 'a=2', 'a=1', 'a=3'):
+        app.get('/static?' + query)
+    assert_equals(1, cache.stats()['evictions'])
+    app.get('/static?a=1')
+    assert_equals(3, calls['static'])
+    app.get('/static?a=2')
+    assert_equals(4, calls['static'])
+
+def test_concurrent_misses_render_once():
+    app, cache, calls, metrics = cached_app()
+    bodies = []
+    def get():
+        bodies.append(app.get('/slow').text)
+    threads = [threading.Thread(target=get) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equals(['slow'] * 5, bodies)
+    assert_equals(1, calls['slow'])
+    assert_equals(4, cache.stats()['coalesced'])
+    rendered = metrics.render()
+    assert_in('library_response_cache_requests_total{result="coalesced"} 4', rendered)
+    assert_in('library_response_cache_requests_total{result="miss"} 1', rendered)
+    assert_in('library_response_cache_served_bytes_total 16', rendered)
+
+@raises(ValueError)
+def test_unknown_scope():
+    app = bottle.Bottle()
+    app.install(ResponseCache(metrics=None))
+    @app.get('/', cache='forever')
+    def root():
+        return ''
+    app.routes[0].call
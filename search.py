@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""In-process full-text search over the books in a Repository."""
+import heapq
+import math
+import re
+from bisect import bisect_left
+from collections import OrderedDict
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+# How much a match in each field counts towards a book's score.
+FIELD_WEIGHTS = (('title', 3.0), ('author', 2.0), ('publisher', 1.0), ('description', 1.0))
+
+# A query term that is only a prefix of an indexed word scores this much
+# of an exact match.
+PREFIX_WEIGHT = 0.5
+
+# At most this many indexed words are considered for one prefix, and
+# shorter terms only match exactly.
+MAX_EXPANSIONS = 200
+MIN_PREFIX = 3
+
+# Results of this many recent queries are kept until the index changes.
+MAX_CACHED_QUERIES = 256
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+# ----------------------------------------------------------------------
+
+class SearchIndex(object):
+    """An inverted index from words to the ISBNs of the books using them.
+
+    Every query term must match (exactly, or as a prefix of an indexed
+    word); results are ranked by field-weighted term frequency times
+    inverse document frequency.
+
+    Ranked results for recent queries are cached; any add or remove
+    bumps `generation`, which invalidates them.
+    """
+    def __init__(self):
+        self._postings = {}     # word -> {isbn: weight}
+        self._documents = {}    # isbn -> words indexed for it
+        self._vocabulary = []   # every indexed word, sorted, for prefixes (see _sorted)
+        self._new_words = []    # words indexed since, not in _vocabulary yet
+        self._dropped = False   # whether _vocabulary has words no longer indexed
+        self._results = OrderedDict()  # (terms, limit) -> (generation, isbns)
+        self.generation = 0
+
+    def __len__(self):
+        return len(self._documents)
+
+    def add(self, book):
+        self.remove(book.isbn)
+        weights = {}
+        for field, weight in FIELD_WEIGHTS:
+            for token in tokenize(getattr(book, field)):
+                weights[token] = weights.get(token, 0.0) + weight
+        for token, weight in weights.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                self._new_words.append(token)
+            postings[book.isbn] = weight
+        self._documents[book.isbn] = list(weights)
+        self.generation += 1
+
+    def remove(self, isbn):
+        tokens = self._documents.pop(isbn, None)
+        if tokens is None:
+            return
+        self.generation += 1
+        for token in tokens:
+            postings = self._postings[token]
+            del postings[isbn]
+            if not postings:
+                del self._postings[token]
+                self._dropped = True
+
+    def expand(self, term):
+        """The indexed words starting with `term`, exact match first."""
+        if len(term) < MIN_PREFIX:
+            return [term] if term in self._postings else []
+        words = []
+        vocabulary = self._sorted()
+        i = bisect_left(vocabulary, term)
+        while i < len(vocabulary) and len(words) < MAX_EXPANSIONS:
+            word = vocabulary[i]
+            if not word.startswith(term):
+                break
+            words.append(word)
+            i += 1
+        return words
+
+    def _sorted(self):
+        """The vocabulary, bringing in the words added and dropping those
+        removed since it was last asked for: one sort per batch of changes,
+        rather than a list insertion per word."""
+        if self._new_words or self._dropped:
+            postings = self._postings
+            words = self._vocabulary
+            if self._dropped:
+                words = [word for word in words if word in postings]
+            words.extend(word for word in self._new_words if word in postings)
+            words.sort()
+            if self._dropped:
+                # A word dropped and added again can be there twice.
+                words = [word for i, word in enumerate(words) if not i or word != words[i - 1]]
+            self._vocabulary = words
+            self._new_words = []
+            self._dropped = False
+        return self._vocabulary
+
+    def term_scores(self, term):
+        """{isbn: score} for the books matching a single query term."""
+        scores = {}
+        total = float(len(self._documents))
+        for word in self.expand(term):
+            postings = self._postings[word]
+            idf = math.log(1.0 + total / len(postings))
+            if word != term:
+                idf *= PREFIX_WEIGHT
+            if not scores:
+                scores = dict((isbn, weight * idf) for isbn, weight in postings.items())
+                continue
+            for isbn, weight in postings.items():
+                scores[isbn] = scores.get(isbn, 0.0) + weight * idf
+        return scores
+
+    def search(self, query, limit=None):
+        """ISBNs matching every term of `query`, best match first; only the
+        best `limit` if given."""
+        terms = tuple(sorted(set(tokenize(query))))
+        if not terms:
+            return []
+        key = (terms, limit)
+        cached = self._results.pop(key, None)
+        if cached is None or cached[0] != self.generation:
+            cached = (self.generation, self._rank(terms, limit))
+        self._results[key] = cached
+        if len(self._results) > MAX_CACHED_QUERIES:
+            self._results.popitem(last=False)
+        return cached[1]
+
+    def _rank(self, terms, limit):
+        # Intersect starting from the term with the fewest matches.
+        per_term = sorted((self.term_scores(term) for term in terms), key=len)
+        scores = per_term[0]
+        for other in per_term[1:]:
+            scores = dict((isbn, score + other[isbn])
+                          for isbn, score in scores.items() if isbn in other)
+        rank = lambda item: (-item[1], item[0])
+        if limit is None:
+            ranked = sorted(scores.items(), key=rank)
+        else:
+            ranked = heapq.nsmallest(limit, scores.items(), key=rank)
+        return [isbn for isbn, score in ranked]
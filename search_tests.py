@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+from nose.tools import assert_equals
+
+from models import Repository, Book
+from search import SearchIndex, tokenize
+
+# ----------------------------------------------------------------------
+
+def make_index():
+    index = SearchIndex()
+    index.add(Book('Learning Python', 'An introduction to the language.', 'ISBN1', author='Mark Lutz'))
+    index.add(Book('Programming Perl', 'The camel book.', 'ISBN2', author='Larry Wall',
+                   publisher="O'Reilly Media, Inc."))
+    index.add(Book('Python Cookbook', 'Recipes for Python programmers.', 'ISBN3', author='David Beazley',
+                   publisher="O'Reilly Media, Inc."))
+    return index
+
+def test_tokenize():
+    assert_equals(['o', 'reilly', 'media', 'inc'], tokenize("O'Reilly Media, Inc."))
+    assert_equals([], tokenize(None))
+
+def test_search_single_term():
+    assert_equals(['ISBN3', 'ISBN1'], make_index().search('python'))
+
+def test_search_requires_every_term():
+    assert_equals(['ISBN3'], make_index().search('python reilly'))
+
+def test_search_matches_prefixes():
+    assert_equals(['ISBN2', 'ISBN3'], sorted(make_index().search('program')))
+
+def test_search_no_match():
+    assert_equals([], make_index().search('haskell'))
+    assert_equals([], make_index().search(''))
+
+def test_search_title_outranks_description():
+    index = SearchIndex()
+    index.add(Book('Other', 'All about gardening.', 'ISBN1'))
+    index.add(Book('Gardening', 'A book.', 'ISBN2'))
+    assert_equals(['ISBN2', 'ISBN1'], index.search('gardening'))
+
+def test_remove():
+    index = make_index()
+    index.remove('ISBN3')
+    assert_equals(['ISBN1'], index.search('python'))
+    assert_equals([], index.search('cookbook'))
+    assert_equals(2, len(index))
+
+def test_prefixes_follow_words_added_and_removed():
+    index = make_index()
+    assert_equals(['programmers', 'programming'], index.expand('program'))
+    index.remove('ISBN2')
+    index.add(Book('Programs', 'DESCRIPTION', 'ISBN4'))
+    index.add(Book('Programming Perl', 'The camel book.', 'ISBN2'))
+    assert_equals(['programmers', 'programming', 'programs'], index.expand('program'))
+    index.remove('ISBN2')
+    index.remove('ISBN4')
+    assert_equals(['programmers'], index.expand('program'))
+    assert_equals([], index.expand('camel'))
+
+# ----------------------------------------------------------------------
+
+def test_repository_search_follows_updates():
+    r = Repository()
+    bk = Book('Learning Python', 'DESCRIPTION', 'ISBN1')
+    r.store(bk)
+    bk.update(title='Learning Perl')
+    r.store(bk)
+    assert_equals([], r.search('python'))
+    assert_equals([bk], r.search('perl'))
+
+    r.delete('ISBN1')
+    assert_equals([], r.search('perl'))
+
+def test_repository_search_hydrates_lazy_books():
+    r = Repository()
+    r.store_lazy('ISBN1', lambda: Book('Learning Python', 'DESCRIPTION', 'ISBN1'))
+    assert_equals(['ISBN1'], [bk.isbn for bk in r.search('python')])
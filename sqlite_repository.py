@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+"""A Repository kept in an SQLite database.
+
+    Book.repository = SQLiteRepository('library.db')
+
+It answers to what the controllers ask of `models.Repository` (`find`,
+`find_one`, `page`, `page_at`, `store`, `delete`, `search`, `select`,
+`summary`, the user lookups and `apply_batch`), with the same listeners,
+but the catalogue lives on disk: the process starts without reading it,
+and every change is committed as it is made.
+
+Books and their reservations are separate tables, with the books in
+listing order and indexed by ISBN and borrower, and the reservations by
+user. Each thread gets its own connection (WAL mode lets readers carry
+on while a change is committed); the queries are module constants, so
+each connection's statement cache prepares each of them once.
+
+A book is built from its row when it is looked up and kept for as long
+as anything holds on to it, or while it is among the `keep` built most
+recently, so there is one Book per ISBN at a time, whose changes
+(reported through `book_changed`, like any stored book's) are written
+through to the database. Only one process should use a database at a
+time.
+
+`store_many` imports books in batches, one transaction per batch;
+`loader.load_library` uses it when given an SQLiteRepository.
+"""
+import sqlite3
+import threading
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice
+
+from facets import FACETS, facet_values, most_common, tally
+from models import BatchOperations, Book, NoMatchingBookError, clock
+from search import SearchIndex
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,  -- listing order
+    isbn TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL,
+    description TEXT NOT NULL,
+    author TEXT NOT NULL,
+    publisher TEXT NOT NULL,
+    small_thumbnail TEXT NOT NULL,
+    thumbnail TEXT NOT NULL,
+    published_date TEXT NOT NULL,
+    borrower TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    modified REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS books_borrower ON books (borrower);
+CREATE TABLE IF NOT EXISTS reservations (
+    book_id INTEGER NOT NULL REFERENCES books (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    deadline REAL,
+    PRIMARY KEY (book_id, position)
+);
+CREATE INDEX IF NOT EXISTS reservations_user ON reservations (user);
+'''
+
+COLUMNS = ('isbn, title, description, author, publisher, small_thumbnail, thumbnail, '
+           'published_date, borrower, version, modified')
+SELECT_BOOK = 'SELECT id, %s FROM books WHERE isbn = ?' % COLUMNS
+SELECT_PAGE = 'SELECT id, %s FROM books ORDER BY id LIMIT ? OFFSET ?' % COLUMNS
+SELECT_ROWS = 'SELECT id, %s FROM books WHERE id IN (%%s)' % COLUMNS
+SELECT_AFTER = 'SELECT id, %s FROM books WHERE id > ? ORDER BY id LIMIT ?' % COLUMNS
+SELECT_FROM = 'SELECT id, %s FROM books WHERE id >= ? ORDER BY id LIMIT ?' % COLUMNS
+SELECT_RESERVATIONS = ('SELECT book_id, user, deadline FROM reservations '
+                       'WHERE book_id IN (%s) ORDER BY book_id, position')
+SELECT_BOOK_RESERVATIONS = ('SELECT user, deadline FROM reservations '
+                            'WHERE book_id = ? ORDER BY position')
+SELECT_ID = 'SELECT id FROM books WHERE isbn = ?'
+UPDATE_BOOK = ('UPDATE books SET title = ?, description = ?, author = ?, publisher = ?, '
+               'small_thumbnail = ?, thumbnail = ?, published_date = ?, borrower = ?, '
+               'version = ?, modified = ? WHERE isbn = ?')
+INSERT_BOOK = 'INSERT INTO books (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)' % COLUMNS
+UPDATE_STATE = 'UPDATE books SET borrower = ?, version = ?, modified = ? WHERE id = ?'
+DELETE_BOOK = 'DELETE FROM books WHERE isbn = ?'
+DELETE_RESERVATIONS = 'DELETE FROM reservations WHERE book_id = ?'
+INSERT_RESERVATION = 'INSERT INTO reservations (book_id, position, user, deadline) VALUES (?, ?, ?, ?)'
+COUNT_BOOKS = 'SELECT COUNT(*) FROM books'
+MAX_VERSION = 'SELECT MAX(version) FROM books'
+SELECT_USERS = ("SELECT borrower FROM books WHERE borrower != '' "
+                'UNION SELECT user FROM reservations ORDER BY 1')
+SELECT_BORROWED = 'SELECT isbn FROM books WHERE borrower = ? ORDER BY isbn'
+SELECT_RESERVED = ('SELECT DISTINCT books.isbn FROM reservations JOIN books ON books.id = book_id '
+                   'WHERE user = ? ORDER BY books.isbn')
+SELECT_ALL_RESERVED = ('SELECT DISTINCT books.isbn FROM reservations '
+                       'JOIN books ON books.id = book_id')
+SELECT_SEARCHED = 'SELECT isbn, title, author, publisher, description FROM books'
+
+# The column counted for each ranking (see Repository.ranking).
+RANKED = {'publishers': 'publisher', 'authors': 'author'}
+
+# SQL for each facet's value (see facets.facet_values).
+FACET_SQL = {'status': "CASE WHEN borrower = '' THEN '%s' ELSE '%s' END" % (Book.AVAILABLE, Book.BORROWED),
+             'publisher': 'publisher',
+             'author': 'author',
+             'year': 'substr(published_date, 1, 4)'}
+
+# Rows fetched at a time while iterating over every book.
+CHUNK_SIZE = 500
+
+# How many of the books built from their rows (the last ones built) are
+# kept while nothing else holds on to them.
+KEEP_BOOKS = 10000
+
+# Books per transaction in store_many.
+IMPORT_BATCH = 1000
+
+# ----------------------------------------------------------------------
+
+class _Searched(object):
+    """The searched fields of a row, for SearchIndex.add."""
+    __slots__ = ('isbn', 'title', 'author', 'publisher', 'description')
+    def __init__(self, row):
+        self.isbn, self.title, self.author, self.publisher, self.description = row
+
+class SQLiteBookView(object):
+    """Live view of the books in an SQLiteRepository, in listing order,
+    read a chunk at a time."""
+    def __init__(self, repository):
+        self._repository = repository
+    def __len__(self):
+        return self._repository._count
+    def __iter__(self):
+        last = 0
+        while True:
+            rows = self._repository._query(SELECT_AFTER, (last, CHUNK_SIZE))
+            if not rows:
+                return
+            for bk in self._repository._books(rows):
+                yield bk
+            last = rows[-1][0]
+    def __contains__(self, book):
+        return self._repository._loaded.get(book.isbn) is book
+
+class SQLiteRepository(BatchOperations):
+    """Books in the SQLite database at `path` (see above)."""
+    def __init__(self, path, timeout=30, keep=KEEP_BOOKS):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = {}   # thread -> its connection
+        self._lock = threading.RLock()
+        self._loaded = weakref.WeakValueDictionary()  # isbn -> the Book built from its row
+        self._rows = weakref.WeakKeyDictionary()      # loaded book -> (ISBN stored under, row id)
+        self._recent = deque(maxlen=keep)             # the books built last, kept alive
+        self._listeners = []
+        self.search_index = None # built by the first search
+        self._unindexed = {}
+        db = self._db()
+        db.executescript(SCHEMA)
+        self._count = db.execute(COUNT_BOOKS).fetchone()[0]
+        clock.advance(db.execute(MAX_VERSION).fetchone()[0] or 0)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                             check_same_thread=False, cached_statements=256)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('PRAGMA foreign_keys=ON')
+        return db
+
+    def _db(self):
+        """This thread's connection."""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = self._connect()
+            with self._lock:
+                for thread in [t for t in self._connections if not t.is_alive()]:
+                    self._connections.pop(thread).close()
+                self._connections[threading.current_thread()] = db
+        return db
+
+    def _query(self, sql, parameters=()):
+        return self._db().execute(sql, parameters).fetchall()
+
+    @contextmanager
+    def _writing(self):
+        """A transaction, holding the repository's lock."""
+        with self._lock:
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                self._count = db.execute(COUNT_BOOKS).fetchone()[0]
+                raise
+            db.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            for db in self._connections.values():
+                db.close()
+            self._connections.clear()
+            self._local = threading.local()
+
+    # ------------------------------------------------------------------
+
+    def subscribe(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def _publish(self, action, isbn, book, user=None):
+        for listener in self._listeners:
+            listener(action, isbn, book, user)
+
+    def _books(self, rows):
+        """The Books for `rows` of (id, COLUMNS...), building the ones not
+        loaded yet."""
+        loaded = self._loaded
+        books = [loaded.get(row[1]) for row in rows]
+        if None not in books:
+            return books
+        with self._lock:
+            # Read the missing rows again, now that nothing can change them
+            # (changes hold the lock), and their reservations.
+            found = dict((bk.isbn, bk) for bk in books if bk is not None)
+            ids = [row[0] for row, bk in zip(rows, books) if bk is None]
+            for start in range(0, len(ids), CHUNK_SIZE):
+                chunk = ids[start:start + CHUNK_SIZE]
+                marks = ','.join('?' * len(chunk))
+                reservations = {}
+                for book_id, user, deadline in self._query(SELECT_RESERVATIONS % marks, chunk):
+                    reservations.setdefault(book_id, []).append((user, deadline))
+                for row in self._query(SELECT_ROWS % marks, chunk):
+                    book = loaded.get(row[1])
+                    if book is None:
+                        book = self._load(row, reservations.get(row[0], ()))
+                    found[row[1]] = book
+            return [found[row[1]] for row in rows if row[1] in found]
+
+    def _load(self, row, reservations):
+        (book_id, isbn, title, description, author, publisher, small_thumbnail, thumbnail,
+         published_date, borrower, version, modified) = row
+        book = Book(title, description, isbn, borrower, author=author, publisher=publisher,
+                    small_thumbnail=small_thumbnail, thumbnail=thumbnail,
+                    reservations=[user for user, deadline in reservations],
+                    published_date=published_date)
+        for user, deadline in reservations:
+            if deadline is not None:
+                book.reservations.set_deadline(user, deadline)
+        if Book.hold_window is not None and book.reservations and not borrower:
+            # Free and reserved: the first reserver's hold is running.
+            book.reservations.held = book.reservations[0]
+        book.version = version
+        self._adopt(book, book_id)
+        return book
+
+    def _adopt(self, book, book_id):
+        self._loaded[book.isbn] = book
+        self._rows[book] = (book.isbn, book_id)
+        self._recent.append(book)
+        book._owner = self
+
+    def _release(self, isbn):
+        book = self._loaded.pop(isbn, None)
+        if book is not None:
+            del self._rows[book]
+            book._owner = None
+
+    def find(self):
+        return SQLiteBookView(self)
+
+    def find_one(self, isbn):
+        if not isbn:
+            for bk in self.find():
+                return bk
+            return None
+        bk = self._loaded.get(isbn)
+        if bk is None:
+            with self._lock:
+                bk = self._loaded.get(isbn)
+                if bk is None:
+                    rows = self._query(SELECT_BOOK, (isbn,))
+                    if rows:
+                        bk = self._load(rows[0], self._query(SELECT_BOOK_RESERVATIONS, (rows[0][0],)))
+        return bk
+
+    def page(self, offset, limit):
+        """Up to `limit` books, starting at the `offset`th."""
+        return self._books(self._query(SELECT_PAGE, (limit, offset)))
+
+    def page_at(self, cursor, limit):
+        """(up to `limit` books from the listing position `cursor` on,
+        the cursor of the next page or None): row ids, here."""
+        rows = self._query(SELECT_FROM, (cursor, limit + 1))
+        return self._books(rows[:limit]), rows[limit][0] if len(rows) > limit else None
+
+    def hydrate(self):
+        pass # books are built as they are looked up
+
+    # ------------------------------------------------------------------
+
+    def _write(self, db, book):
+        """Insert or update `book`'s row and its reservations; returns its id."""
+        fields = (book.title, book.description, book.author, book.publisher,
+                  book.small_thumbnail, book.thumbnail, book.published_date, book.borrower,
+                  book.version, book.modified)
+        if db.execute(UPDATE_BOOK, fields + (book.isbn,)).rowcount:
+            stored = self._rows.get(book)
+            if stored is not None and stored[0] == book.isbn:
+                book_id = stored[1]
+            else:
+                book_id = db.execute(SELECT_ID, (book.isbn,)).fetchone()[0]
+            db.execute(DELETE_RESERVATIONS, (book_id,))
+        else:
+            book_id = db.execute(INSERT_BOOK, (book.isbn,) + fields).lastrowid
+            self._count += 1
+        self._write_reservations(db, book_id, book)
+        return book_id
+
+    def _write_reservations(self, db, book_id, book):
+        reservations = book.reservations
+        if reservations:
+            db.executemany(INSERT_RESERVATION,
+                           [(book_id, position, user, reservations.deadline(user))
+                            for position, user in enumerate(reservations)])
+
+    def _delete(self, db, isbn):
+        if db.execute(DELETE_BOOK, (isbn,)).rowcount:
+            self._count -= 1
+        self._release(isbn)
+        if self.search_index is not None and self._unindexed.pop(isbn, None) is None:
+            self.search_index.remove(isbn)
+
+    def store(self, book):
+        with self._writing() as db:
+            old_isbn = self._rows.get(book, (None,))[0]
+            if old_isbn is not None and old_isbn != book.isbn:
+                self._delete(db, old_isbn)
+                self._publish('delete', old_isbn, book)
+            if self._loaded.get(book.isbn) is not book:
+                self._release(book.isbn)
+            book_id = self._write(db, book)
+            self._adopt(book, book_id)
+            if self.search_index is not None:
+                self._unindexed[book.isbn] = book
+            clock.tick()
+            self._publish('store', book.isbn, book)
+
+    def store_many(self, books, batch=IMPORT_BATCH):
+        """Store `books`, `batch` to a transaction, without keeping them:
+        look a book up again to change it. Returns how many were stored."""
+        books = iter(books)
+        stored = 0
+        while True:
+            chunk = list(islice(books, batch))
+            if not chunk:
+                return stored
+            with self._writing() as db:
+                for book in chunk:
+                    self._release(book.isbn)
+                    self._write(db, book)
+                    if self.search_index is not None:
+                        self._unindexed[book.isbn] = _Searched((book.isbn, book.title, book.author,
+                                                                book.publisher, book.description))
+                    self._publish('store', book.isbn, book)
+                clock.tick()
+            stored += len(chunk)
+
+    def delete(self, isbn):
+        with self._writing() as db:
+            book = self.find_one(isbn)
+            if book is None:
+                raise NoMatchingBookError("No book with ISBN '%s'" % isbn)
+            self._delete(db, isbn)
+            clock.tick()
+            self._publish('delete', isbn, book)
+            return book
+
+    def book_changed(self, book, action, user):
+        """Called by a stored book after `user` performed `action` on it."""
+        with self._writing() as db:
+            if action == 'update':
+                self._write(db, book)
+                if self.search_index is not None:
+                    self.search_index.remove(book.isbn)
+                    self._unindexed[book.isbn] = book
+            else:
+                book_id = self._rows[book][1]
+                db.execute(UPDATE_STATE, (book.borrower, book.version, book.modified, book_id))
+                db.execute(DELETE_RESERVATIONS, (book_id,))
+                self._write_reservations(db, book_id, book)
+            self._publish(action, book.isbn, book, user)
+
+    # ------------------------------------------------------------------
+
+    def search(self, query):
+        """The books matching `query`, best match first."""
+        with self._lock:
+            if self.search_index is None:
+                self.search_index = SearchIndex()
+                for row in self._query(SELECT_SEARCHED):
+                    self.search_index.add(_Searched(row))
+            for book in self._unindexed.values():
+                self.search_index.add(book)
+            self._unindexed.clear()
+            isbns = self.search_index.search(query)
+        return [bk for bk in (self.find_one(isbn) for isbn in isbns) if bk is not None]
+
+    def _where(self, filters):
+        if not filters:
+            return '', []
+        return (' WHERE ' + ' AND '.join('%s = ?' % FACET_SQL[facet] for facet, value in filters),
+                [value for facet, value in filters])
+
+    def select(self, filters, query=''):
+        """(books, facet counts) for the books matching every (facet,
+        value) in `filters` and the search `query`, if any: best match
+        first with a query, otherwise in listing order."""
+        filters = tuple(filters)
+        if query:
+            books = self.search(query)
+            if filters:
+                where, parameters = self._where(filters)
+                allowed = set(row[0] for row in self._query('SELECT isbn FROM books' + where, parameters))
+                books = [bk for bk in books if bk.isbn in allowed]
+        else:
+            where, parameters = self._where(filters)
+            books = self._books(self._query('SELECT id, %s FROM books%s ORDER BY id' % (COLUMNS, where),
+                                            parameters))
+        return books, tally(facet_values(bk) for bk in books)
+
+    def facet_counts(self):
+        """Facet counts (see FacetIndex.counts) over the whole catalogue."""
+        totals = {}
+        for facet in FACETS:
+            totals[facet] = dict(self._query('SELECT %s, COUNT(*) FROM books GROUP BY 1' % FACET_SQL[facet]))
+        return most_common(totals)
+
+    def summary(self, top=10):
+        """The catalogue's totals (as Repository.summary gives them)."""
+        books, borrowed = self._query("SELECT COUNT(*), COUNT(NULLIF(borrower, '')) FROM books")[0]
+        reserved, reservations = self._query('SELECT COUNT(DISTINCT book_id), COUNT(*) FROM reservations')[0]
+        most_reserved = self._query(
+            'SELECT books.isbn, COUNT(*) FROM reservations JOIN books ON books.id = book_id '
+            'GROUP BY book_id ORDER BY 2 DESC, books.isbn LIMIT ?', (top,))
+        return dict(books=books,
+                    available=books - borrowed,
+                    borrowed=borrowed,
+                    reserved=reserved,
+                    reservations=reservations,
+                    pending=0,
+                    publishers=self.ranking('publishers', 0, top)[1],
+                    authors=self.ranking('authors', 0, top)[1],
+                    most_reserved=[(self.find_one(isbn), count) for isbn, count in most_reserved])
+
+    def ranking(self, field, offset, limit):
+        """(how many, [(name, books)]), as Repository.ranking gives them."""
+        column = RANKED[field]
+        total = self._query("SELECT COUNT(DISTINCT %s) FROM books WHERE %s != ''"
+                            % (column, column))[0][0]
+        rows = self._query("SELECT %s, COUNT(*) FROM books WHERE %s != '' GROUP BY 1 "
+                           "ORDER BY 2 DESC, 1 LIMIT ? OFFSET ?" % (column, column), (limit, offset))
+        return total, [tuple(row) for row in rows]
+
+    def users(self):
+        """Everyone currently borrowing or reserving a book."""
+        return [row[0] for row in self._query(SELECT_USERS)]
+
+    def borrowed_by(self, user):
+        return [self.find_one(row[0]) for row in self._query(SELECT_BORROWED, (user,))]
+
+    def reserved_by(self, user):
+        """(book, position in its reservation queue) pairs; 0 is next in line."""
+        ret = []
+        for row in self._query(SELECT_RESERVED, (user,)):
+            book = self.find_one(row[0])
+            try:
+                ret.append((book, book.reservations.index(user)))
+            except ValueError: # un_reserved since
+                pass
+        return ret
+
+    def expire_reservations(self, now=None):
+        """Drop the lapsed reservations of every book (see
+        Book.expire_reservations). Returns how many were dropped."""
+        dropped = 0
+        for row in self._query(SELECT_ALL_RESERVED):
+            book = self.find_one(row[0])
+            if book is not None:
+                dropped += len(book.expire_reservations(now))
+        return dropped
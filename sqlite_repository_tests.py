@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import threading
+
+from nose.tools import assert_equals
+
+from models import Book, Repository
+from loader import load_library
+from sqlite_repository import SQLiteRepository
+
+# ----------------------------------------------------------------------
+
+DATABASES = []
+
+def setup():
+    DATABASES.append(tempfile.mkdtemp())
+
+def teardown():
+    shutil.rmtree(DATABASES.pop())
+
+def database(name):
+    return os.path.join(DATABASES[-1], name)
+
+def isbns(books):
+    return [bk.isbn for bk in books]
+
+def test_state_survives_reopening():
+    Book.reservation_expiry = 60
+    try:
+        r = SQLiteRepository(database('reopen.db'))
+        r.store(Book('TITLE', 'DESCRIPTION', 'ISBN1', author='AUTHOR', published_date='2001-02-03'))
+        r.store(Book('TITLE2', 'DESCRIPTION2', 'ISBN2'))
+        r.find_one('ISBN1').check_out('BORROWER')
+        for user in ('FIRST', 'SECOND', 'THIRD'):
+            r.find_one('ISBN1').reserve(user)
+        r.find_one('ISBN1').un_reserve('SECOND')
+        version = r.find_one('ISBN1').version
+        deadline = r.find_one('ISBN1').reservations.deadline('THIRD')
+        r.close()
+    finally:
+        Book.reservation_expiry = None
+
+    r = SQLiteRepository(database('reopen.db'))
+    bk = r.find_one('ISBN1')
+    assert_equals(['ISBN1', 'ISBN2'], isbns(r.find()))
+    assert_equals(('BORROWER', ['FIRST', 'THIRD']), (bk.borrower, list(bk.reservations)))
+    assert_equals(('AUTHOR', '2001-02-03'), (bk.author, bk.published_date))
+    assert_equals(deadline, bk.reservations.deadline('THIRD'))
+    assert_equals(version, bk.version)
+    assert_equals([(bk, 1)], r.reserved_by('THIRD'))
+    assert bk is r.find_one('ISBN1')
+    r.close()
+
+def test_only_books_in_use_or_built_last_are_kept():
+    r = SQLiteRepository(database('kept.db'), keep=10)
+    r.store_many(Book('TITLE', 'DESCRIPTION', 'ISBN%d' % i) for i in range(500))
+    held = r.find_one('ISBN0')
+    held.check_out('BORROWER')
+    assert_equals(500, len(list(r.find())))
+    assert len(r._loaded) <= 11
+    assert held is r.find_one('ISBN0')
+    for bk in r.find():
+        bk.reserve('RESERVER') # written through, then let go
+    assert_equals(['RESERVER'], list(r.find_one('ISBN250').reservations))
+    assert_equals(500, len(r.reserved_by('RESERVER')))
+    r.close()
+
+def test_running_hold_survives_reloading():
+    Book.hold_window = 60
+    try:
+        r = SQLiteRepository(database('held.db'))
+        r.store(Book('TITLE', 'DESCRIPTION', 'ISBN1'))
+        r.find_one('ISBN1').reserve('FIRST')
+        deadline = r.find_one('ISBN1').reservations.deadline('FIRST')
+        r.close()
+        bk = SQLiteRepository(database('held.db')).find_one('ISBN1')
+        assert_equals('FIRST', bk.reservations.held)
+        bk.reserve('SECOND')
+        assert_equals(deadline, bk.reservations.deadline('FIRST'))
+    finally:
+        Book.hold_window = None
+
+def test_import_matches_the_memory_repository():
+    r = SQLiteRepository(database('import.db'))
+    memory = Repository()
+    assert_equals(load_library('library.json', memory).records,
+                  load_library('library.json', r).records)
+    assert_equals(isbns(memory.find()), isbns(r.find()))
+    assert_equals(isbns(memory.page(100, 20)), isbns(r.page(100, 20)))
+    for repository in (r, memory):
+        books = repository.page(0, 3)
+        books[0].check_out('BORROWER')
+        books[1].reserve('BORROWER')
+        books[2].reserve('RESERVER')
+        books[2].reserve('BORROWER')
+    for query, filters in (('', [('status', Book.BORROWED)]),
+                           ('', [('publisher', "O'Reilly Media"), ('year', '2008')]),
+                           ('java', [('year', '2008')]), ('python', [])):
+        books, counts = r.select(filters, query)
+        expected_books, expected_counts = memory.select(filters, query)
+        assert_equals(isbns(expected_books), isbns(books))
+        assert_equals(expected_counts, counts)
+    assert_equals(memory.facet_counts(), r.facet_counts())
+    summary, expected = r.summary(2), memory.summary(2)
+    assert_equals([(bk.isbn, count) for bk, count in expected.pop('most_reserved')],
+                  [(bk.isbn, count) for bk, count in summary.pop('most_reserved')])
+    assert_equals(expected, summary)
+    assert_equals(memory.users(), r.users())
+    r.close()
+
+def test_store_many_replaces_and_notifies():
+    r = SQLiteRepository(database('many.db'))
+    stored = []
+    r.subscribe(lambda action, isbn, book, user: stored.append((action, isbn)))
+    assert_equals(3, r.store_many([Book('TITLE', 'DESCRIPTION', 'ISBN%d' % i) for i in range(3)],
+                                  batch=2))
+    r.store_many([Book('NEWTITLE', 'DESCRIPTION', 'ISBN1')])
+    assert_equals(['ISBN0', 'ISBN1', 'ISBN2'], isbns(r.find()))
+    assert_equals('NEWTITLE', r.find_one('ISBN1').title)
+    assert_equals([('store', 'ISBN%d' % i) for i in (0, 1, 2, 1)], stored)
+    assert_equals(3, len(r.find()))
+    r.close()
+
+def test_connections_are_per_thread_and_in_wal_mode():
+    r = SQLiteRepository(database('threads.db'))
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN'))
+    connections = []
+    def lookup():
+        r.find_one('ISBN')
+        connections.append(r._db())
+    threads = [threading.Thread(target=lookup) for i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert_equals(3, len(set(id(db) for db in connections)))
+    assert r._db() not in connections
+    assert_equals('wal', r._db().execute('PRAGMA journal_mode').fetchone()[0])
+    r.close()
+
+def test_listing_through_the_controllers():
+    from webtest import TestApp
+    from app import app
+    r = SQLiteRepository(database('web.db'))
+    load_library('library.json', r)
+    saved = Book.repository
+    Book.repository = r
+    try:
+        web = TestApp(app)
+        res = web.get('/library/api/books', dict(offset=20, limit=5))
+        assert_equals(isbns(r.page(20, 5)), [bk['isbn'] for bk in res.json['books']])
+        assert_equals(len(r.find()), res.json['total'])
+        isbn = res.json['books'][0]['isbn']
+        res = web.post_json('/library/api/batch',
+                            dict(operations=[dict(op='check_out', isbn=isbn, user='alice')]))
+        assert res.json['results'][0]['ok']
+    finally:
+        Book.repository = saved
+    r.close()
+    assert_equals('alice', SQLiteRepository(database('web.db')).find_one(isbn).borrower)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""Running totals over the books in a Repository."""
+import heapq
+
+# ----------------------------------------------------------------------
+
+class CatalogueStats(object):
+    """Counts of books by status, publisher and author, and the most
+    reserved books, kept up to date as books are added, removed and
+    change state, so reading them costs the same however big the
+    catalogue is.
+
+    The Repository calls `add`, `remove` and `changed` with its lock
+    held; reads should hold it too.
+    """
+    def __init__(self):
+        self.books = 0
+        self.borrowed = 0
+        self.reserved = 0       # books with at least one reservation
+        self.reservations = 0   # reservations, over every book
+        self.publishers = Ranking()  # publisher -> number of books
+        self.authors = Ranking()     # author -> number of books
+        self._counted = {}      # isbn -> [publisher, author, borrowed, reservations] as counted
+        self._heap = []         # (-reservations, isbn), some of them out of date
+
+    def __len__(self):
+        return self.books
+
+    def add(self, book):
+        self.remove(book.isbn)
+        self._counted[book.isbn] = [book.publisher, book.author, False, 0]
+        self.books += 1
+        self.publishers.bump(book.publisher, 1)
+        self.authors.bump(book.author, 1)
+        self.changed(book)
+
+    def remove(self, isbn):
+        counted = self._counted.pop(isbn, None)
+        if counted is None:
+            return
+        publisher, author, borrowed, reservations = counted
+        self.books -= 1
+        self.publishers.bump(publisher, -1)
+        self.authors.bump(author, -1)
+        self.borrowed -= borrowed
+        self.reserved -= reservations > 0
+        self.reservations -= reservations
+
+    def changed(self, book):
+        counted = self._counted.get(book.isbn)
+        if counted is None:
+            return
+        borrowed = bool(book.borrower)
+        reservations = len(book.reservations)
+        self.borrowed += borrowed - counted[2]
+        self.reserved += (reservations > 0) - (counted[3] > 0)
+        self.reservations += reservations - counted[3]
+        if reservations != counted[3] and reservations:
+            heapq.heappush(self._heap, (-reservations, book.isbn))
+            if len(self._heap) > 2 * self.reserved + 64:
+                self._compact()
+        counted[2:] = [borrowed, reservations]
+
+    def _compact(self):
+        self._heap = [(-counted[3], isbn) for isbn, counted in self._counted.items() if counted[3]]
+        heapq.heapify(self._heap)
+
+    def most_reserved(self, limit=10):
+        """[(isbn, reservations)] for the `limit` books with the most
+        reservations, most first."""
+        heap = self._heap
+        found = []
+        seen = set()
+        while heap and len(found) < limit:
+            entry = heapq.heappop(heap)
+            reservations, isbn = -entry[0], entry[1]
+            counted = self._counted.get(isbn)
+            if isbn in seen or counted is None or counted[3] != reservations:
+                continue # out of date: drop it
+            seen.add(isbn)
+            found.append(entry)
+        for entry in found:
+            heapq.heappush(heap, entry)
+        return [(isbn, -reservations) for reservations, isbn in found]
+
+# ----------------------------------------------------------------------
+
+class Ranking(object):
+    """Counts by key, with the highest ones to hand: `top` reads them off
+    a heap (kept, like CatalogueStats' most reserved, with out of date
+    entries dropped as they surface) in O(n log k) for n of them; `page`
+    slices the whole ranking, sorted once per change."""
+    def __init__(self):
+        self.counts = {}     # key -> count, for the keys counted at all
+        self._heap = []      # (-count, key), some of them out of date
+        self._ranked = None  # every (key, count), most first, until a change
+
+    def __len__(self):
+        return len(self.counts)
+
+    def bump(self, key, delta):
+        if not key:
+            return # no publisher, say: not ranked, as facets don't count it
+        counts = self.counts
+        count = counts.get(key, 0) + delta
+        if count:
+            counts[key] = count
+            heapq.heappush(self._heap, (-count, key))
+            if len(self._heap) > 2 * len(counts) + 64:
+                self._heap = [(-count, key) for key, count in counts.items()]
+                heapq.heapify(self._heap)
+        else:
+            del counts[key]
+        self._ranked = None
+
+    def top(self, limit=10):
+        """[(key, count)] for the `limit` highest counts, most first."""
+        heap = self._heap
+        found = []
+        seen = set()
+        while heap and len(found) < limit:
+            entry = heapq.heappop(heap)
+            count, key = -entry[0], entry[1]
+            if key in seen or self.counts.get(key) != count:
+                continue # out of date: drop it
+            seen.add(key)
+            found.append(entry)
+        for entry in found:
+            heapq.heappush(heap, entry)
+        return [(key, -count) for count, key in found]
+
+    def page(self, offset, limit):
+        """[(key, count)] for the `offset`th highest count on, at most
+        `limit` of them."""
+        if self._ranked is None:
+            self._ranked = sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))
+        return self._ranked[offset:offset + limit]
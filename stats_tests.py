@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+from nose.tools import assert_equals
+
+from models import Repository, Book
+from stats import CatalogueStats, Ranking
+
+# ----------------------------------------------------------------------
+
+def make_repository():
+    r = Repository()
+    r.store(Book('Learning Python', 'DESCRIPTION', 'ISBN1', author='Mark Lutz'))
+    r.store(Book('Programming Perl', 'DESCRIPTION', 'ISBN2', author='Larry Wall',
+                 publisher="O'Reilly Media, Inc."))
+    r.store(Book('Python Cookbook', 'DESCRIPTION', 'ISBN3', author='David Beazley',
+                 publisher="O'Reilly Media, Inc."))
+    return r
+
+def test_counts_follow_state_changes():
+    r = make_repository()
+    r.find_one('ISBN1').check_out('BORROWER')
+    r.find_one('ISBN1').reserve('RESERVER')
+    r.find_one('ISBN2').reserve('RESERVER')
+    r.find_one('ISBN2').reserve('OTHER')
+    summary = r.summary()
+    assert_equals((3, 2, 1, 2, 3), (summary['books'], summary['available'], summary['borrowed'],
+                                    summary['reserved'], summary['reservations']))
+    assert_equals([("O'Reilly Media, Inc.", 2)], summary['publishers'])
+    assert_equals(1, dict(summary['authors'])['Larry Wall'])
+
+    r.find_one('ISBN1').check_in('BORROWER')
+    r.find_one('ISBN2').un_reserve('OTHER')
+    r.delete('ISBN3')
+    summary = r.summary()
+    assert_equals((2, 2, 0, 2, 2), (summary['books'], summary['available'], summary['borrowed'],
+                                    summary['reserved'], summary['reservations']))
+    assert_equals([("O'Reilly Media, Inc.", 1)], summary['publishers'])
+
+def test_replacing_a_book_recounts_it():
+    r = make_repository()
+    r.find_one('ISBN2').check_out('BORROWER')
+    r.store(Book('Programming Perl', 'DESCRIPTION', 'ISBN2', author='Larry Wall', publisher='Other'))
+    summary = r.summary()
+    assert_equals((3, 0), (summary['books'], summary['borrowed']))
+    assert_equals([("O'Reilly Media, Inc.", 1), ('Other', 1)], summary['publishers'])
+
+def test_most_reserved():
+    r = make_repository()
+    for isbn, users in (('ISBN1', 'AB'), ('ISBN2', 'ABC'), ('ISBN3', 'A')):
+        for user in users:
+            r.find_one(isbn).reserve(user)
+    assert_equals([('ISBN2', 3), ('ISBN1', 2)],
+                  [(bk.isbn, count) for bk, count in r.summary(top=2)['most_reserved']])
+    r.find_one('ISBN2').un_reserve('A')
+    r.find_one('ISBN2').un_reserve('B')
+    r.find_one('ISBN3').reserve('B')
+    r.find_one('ISBN3').reserve('C')
+    assert_equals([('ISBN3', 3), ('ISBN1', 2), ('ISBN2', 1)],
+                  [(bk.isbn, count) for bk, count in r.summary()['most_reserved']])
+
+def test_stale_heap_entries_are_compacted():
+    stats = CatalogueStats()
+    book = Book('TITLE', 'DESCRIPTION', 'ISBN')
+    stats.add(book)
+    for i in range(500):
+        book.reserve('USER%d' % i)
+        stats.changed(book)
+    assert len(stats._heap) < 100
+    assert_equals([('ISBN', 500)], stats.most_reserved())
+
+def test_ranking_top_and_pages():
+    ranking = Ranking()
+    for key, count in (('A', 3), ('B', 5), ('C', 1), ('D', 5)):
+        ranking.bump(key, count)
+    assert_equals([('B', 5), ('D', 5)], ranking.top(2))
+    ranking.bump('A', 4)
+    ranking.bump('B', -5)
+    assert_equals([('A', 7), ('D', 5), ('C', 1)], ranking.top(10))
+    assert_equals([('D', 5), ('C', 1)], ranking.page(1, 5))
+    for i in range(500):
+        ranking.bump('C', 1)
+        ranking.bump('C', -1)
+    assert len(ranking._heap) < 100
+    assert_equals(3, len(ranking))
+
+def test_summary_does_not_build_lazy_books():
+    r = Repository()
+    r.store(Book('TITLE', 'DESCRIPTION', 'ISBN1', publisher='P'))
+    r.store_lazy('ISBN2', lambda: Book('TITLE', 'DESCRIPTION', 'ISBN2', publisher='Q'))
+    summary = r.summary()
+    assert_equals((2, 2, 1), (summary['books'], summary['available'], summary['pending']))
+    assert_equals([('P', 1)], summary['publishers'])
+    r.hydrate()
+    assert_equals(0, r.summary()['pending'])
+    assert_equals((2, [('Q', 1)]), r.ranking('publishers', 1, 10))
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+"""Book cover thumbnails, kept on local disk.
+
+A `ThumbnailStore` keeps each image once, named by the SHA-256 of its
+bytes (objects/<2 hex digits>/<digest>.<type>), however many URLs it was
+fetched from: Google Books sends the same "no cover" image for many
+books. refs/ records which image each URL gave. Once the images come to
+more than `max_bytes`, the least recently used URLs are forgotten, and
+images no URL gives any more are deleted.
+
+A `Prefetcher` fills the store on background threads from an `origin`: a
+callable taking a thumbnail URL and returning the image's bytes. The
+default, `Origin()`, fetches the URL itself; `Origin(base)` asks `base`
+for the same path and query instead (a mirror, or a stub server), and
+tests pass a function.
+
+The app serves the stored copies from /library/api/books/<isbn>/thumbnail
+(see controllers.book_thumbnail), through `THUMBNAILS`.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+try:
+    from urllib.request import urlopen
+    from urllib.parse import urlsplit
+except ImportError: # Python 2
+    from urllib2 import urlopen
+    from urlparse import urlsplit
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+MAX_IMAGE_BYTES = 2 * 1024 * 1024
+RETRY_AFTER = 3600  # seconds before a URL that failed is fetched again
+WALK_BATCH = 500    # books queued at a time by Prefetcher.start
+
+IMAGE_TYPES = ((b'\xff\xd8\xff', 'jpg'), (b'\x89PNG\r\n\x1a\n', 'png'),
+               (b'GIF87a', 'gif'), (b'GIF89a', 'gif'))
+
+def image_type(data):
+    """'jpg', 'png', 'gif' or 'webp', going by `data`'s first bytes, or
+    None if it isn't one of those."""
+    for magic, extension in IMAGE_TYPES:
+        if data.startswith(magic):
+            return extension
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def url_key(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+def write_file(path, data):
+    """Replace `path` with `data` in one step (readers see the old file or
+    the new one)."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+# ----------------------------------------------------------------------
+
+class ThumbnailStore(object):
+    """Images by URL, on disk under `directory`, to at most `max_bytes`.
+    Thread-safe."""
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.objects = os.path.join(directory, 'objects')
+        self.refs = os.path.join(directory, 'refs')
+        self._lock = threading.Lock()
+        self._urls = OrderedDict()  # url -> image name, least recently used first
+        self._users = {}            # image name -> number of URLs giving it
+        self._sizes = {}            # image name -> bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        for path in (self.objects, self.refs):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self._recover()
+
+    def _recover(self):
+        """Reload the refs, oldest first, dropping those whose image is
+        missing and the images (and leftover temporary files) no ref
+        names."""
+        refs = []
+        for key in os.listdir(self.refs):
+            path = os.path.join(self.refs, key)
+            if key.startswith('.tmp-'):
+                os.remove(path)
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    name, url = f.read().decode('utf-8').split('\n', 1)
+                refs.append((os.path.getmtime(path), url, name))
+            except (IOError, OSError, ValueError):
+                os.remove(path)
+        for modified, url, name in sorted(refs):
+            if name not in self._sizes:
+                path = os.path.join(self.objects, name)
+                size = os.path.getsize(path) if os.path.isfile(path) else 0
+                if not size:
+                    os.remove(os.path.join(self.refs, url_key(url)))
+                    continue
+                self._sizes[name] = size
+                self.bytes += size
+            self._urls[url] = name
+            self._users[name] = self._users.get(name, 0) + 1
+        for prefix in os.listdir(self.objects):
+            for filename in os.listdir(os.path.join(self.objects, prefix)):
+                if prefix + '/' + filename not in self._sizes:
+                    os.remove(os.path.join(self.objects, prefix, filename))
+        self._evict()
+
+    def __len__(self):
+        return len(self._urls)
+
+    def __contains__(self, url):
+        with self._lock:
+            return url in self._urls
+
+    def get(self, url):
+        """The name of the image stored for `url` (a path under
+        `objects`), or None. Counts as a use of it."""
+        with self._lock:
+            name = self._urls.pop(url, None)
+            if name is None:
+                self.misses += 1
+                return None
+            self._urls[url] = name
+            self.hits += 1
+            return name
+
+    def put(self, url, data):
+        """Store `data` as the image at `url`, returning its name. Raises
+        ValueError if it isn't an image."""
+        extension = image_type(data)
+        if extension is None:
+            raise ValueError('Not an image: %s' % url)
+        digest = hashlib.sha256(data).hexdigest()
+        name = '%s/%s.%s' % (digest[:2], digest, extension)
+        # Thumbnails are small: writing them under the lock keeps an image
+        # from being evicted between being found on disk and being used.
+        with self._lock:
+            if name not in self._sizes:
+                write_file(os.path.join(self.objects, name), data)
+                self._sizes[name] = len(data)
+                self.bytes += len(data)
+            write_file(os.path.join(self.refs, url_key(url)), (name + '\n' + url).encode('utf-8'))
+            old = self._urls.pop(url, None)
+            self._urls[url] = name
+            self._users[name] = self._users.get(name, 0) + 1
+            if old is not None:
+                self._unuse(old)
+            self._evict()
+        return name
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and len(self._urls) > 1:
+            url, name = self._urls.popitem(last=False)
+            try:
+                os.remove(os.path.join(self.refs, url_key(url)))
+            except OSError:
+                pass
+            self._unuse(name)
+            self.evictions += 1
+
+    def _unuse(self, name):
+        users = self._users[name] - 1
+        if users:
+            self._users[name] = users
+            return
+        del self._users[name]
+        self.bytes -= self._sizes.pop(name)
+        try:
+            os.remove(os.path.join(self.objects, name)) # responses already sending it keep it open
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return dict(urls=len(self._urls), images=len(self._sizes), bytes=self.bytes,
+                        hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+# ----------------------------------------------------------------------
+
+class Origin(object):
+    """Fetches thumbnails over HTTP: from their own URLs or, given `base`
+    (e.g. 'http://localhost:9000'), from the same path and query under
+    `base`."""
+    def __init__(self, base=None, timeout=10):
+        self.base = base.rstrip('/') if base else None
+        self.timeout = timeout
+
+    def url_for(self, url):
+        if not self.base:
+            return url
+        parts = urlsplit(url)
+        return self.base + parts.path + ('?' + parts.query if parts.query else '')
+
+    def __call__(self, url):
+        response = urlopen(self.url_for(url), timeout=self.timeout)
+        try:
+            return response.read(MAX_IMAGE_BYTES + 1)
+        finally:
+            response.close()
+
+class Prefetcher(object):
+    """Fetches thumbnails from `origin` into `store`, on `threads`
+    background threads. URLs requested as `urgent` (a client is waiting
+    for them) go ahead of the rest; a URL that fails isn't tried again
+    for `retry_after` seconds.
+    """
+    def __init__(self, store, origin=None, threads=2, retry_after=RETRY_AFTER):
+        self.store = store
+        self.origin = origin if origin is not None else Origin()
+        self.threads = threads
+        self.retry_after = retry_after
+        self._condition = threading.Condition()
+        self._urgent = deque()
+        self._queue = deque()
+        self._queued = (set(), set())  # the URLs in _queue, _urgent
+        self._failed = {}       # url -> when it last failed
+        self._busy = 0
+        self._stopping = False
+        self._workers = []
+        self.fetched = 0
+        self.failed = 0
+
+    def request(self, url, urgent=False):
+        """Queue `url`, unless it's stored, queued or has just failed."""
+        if not url or url in self.store:
+            return
+        with self._condition:
+            failed = self._failed.get(url)
+            if failed is not None and time.time() - failed < self.retry_after:
+                return
+            queued = self._queued[urgent]
+            if url not in queued:
+                queued.add(url)
+                (self._urgent if urgent else self._queue).append(url)
+                self._condition.notify()
+
+    def prefetch(self, books):
+        """Queue the thumbnails of `books`."""
+        for bk in books:
+            self.request(bk.thumbnail)
+            self.request(bk.small_thumbnail)
+
+    def book_changed(self, action, isbn, book, user=None):
+        """A Repository listener: queues the thumbnails of books stored
+        or updated."""
+        if action in ('store', 'update'):
+            self.prefetch([book])
+
+    def start(self, repository=None):
+        """Start the workers and, on a thread of its own, queue the
+        thumbnails of every book in `repository`."""
+        for i in range(self.threads):
+            worker = threading.Thread(target=self._work, name='thumbnails-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        if repository is not None:
+            with self._condition:
+                self._busy += 1 # until the walk is done (see wait)
+            walker = threading.Thread(target=self._walk, args=(repository,), name='thumbnails-walk')
+            walker.daemon = True
+            walker.start()
+
+    def _walk(self, repository):
+        # A page at a time, by cursor: books stored or deleted meanwhile
+        # don't upset it (and the stored ones are queued by book_changed).
+        try:
+            cursor = 0
+            while cursor is not None:
+                books, cursor = repository.page_at(cursor, WALK_BATCH)
+                self.prefetch(books)
+        finally:
+            with self._condition:
+                self._busy -= 1
+                self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def wait(self, timeout=None):
+        """Wait until nothing is queued or being fetched; False if
+        `timeout` seconds pass first."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._urgent or self._queue or self._busy:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def _next(self):
+        with self._condition:
+            while not (self._urgent or self._queue or self._stopping):
+                self._condition.wait()
+            if self._stopping:
+                return None
+            urgent = bool(self._urgent)
+            url = (self._urgent if urgent else self._queue).popleft()
+            self._queued[urgent].discard(url)
+            self._busy += 1
+            return url
+
+    def _work(self):
+        while True:
+            url = self._next()
+            if url is None:
+                return
+            try:
+                self.fetch(url)
+            finally:
+                with self._condition:
+                    self._busy -= 1
+                    self._condition.notify_all()
+
+    def fetch(self, url):
+        """Fetch `url` into the store now; True if it's there afterwards."""
+        if url in self.store:
+            return True
+        try:
+            data = self.origin(url)
+            if len(data) > MAX_IMAGE_BYTES:
+                raise ValueError('Too big for a thumbnail: %s' % url)
+            self.store.put(url, data)
+        except Exception: # whatever the origin raises: timeouts, HTTP errors, not an image
+            with self._condition:
+                self._failed[url] = time.time()
+                self.failed += 1
+            return False
+        with self._condition:
+            self._failed.pop(url, None)
+            self.fetched += 1
+        return True
+
+# ----------------------------------------------------------------------
+
+class Thumbnails(object):
+    """Where the app finds thumbnails: a store and the prefetcher filling
+    it, both None until configured (and thumbnails are then only linked
+    to at their origin)."""
+    def __init__(self, store=None, prefetcher=None):
+        self.store = store
+        self.prefetcher = prefetcher
+
+    def find(self, url):
+        """The name of the image stored for `url`, or None, having asked
+        for it to be fetched ahead of the rest."""
+        if self.store is None:
+            return None
+        name = self.store.get(url)
+        if name is None and self.prefetcher is not None:
+            self.prefetcher.request(url, urgent=True)
+        return name
+
+THUMBNAILS = Thumbnails()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+from nose.tools import raises, assert_equals, assert_in, assert_not_in, assert_is_none
+import os
+import shutil
+import tempfile
+
+from models import Book, Repository
+from thumbnails import ThumbnailStore, Prefetcher, Origin, image_type
+
+JPEG = b'\xff\xd8\xff\xe0' + b'jpeg' * 100
+PNG = b'\x89PNG\r\n\x1a\n' + b'png!' * 100
+
+def setup():
+    global directory
+    directory = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(directory)
+
+def store_directory(name):
+    return os.path.join(directory, name)
+
+# ----------------------------------------------------------------------
+
+def test_image_type():
+    assert_equals('jpg', image_type(JPEG))
+    assert_equals('png', image_type(PNG))
+    assert_equals('webp', image_type(b'RIFF\0\0\0\0WEBPVP8 '))
+    assert_is_none(image_type(b'<html>Not found</html>'))
+
+def test_same_image_is_stored_once():
+    store = ThumbnailStore(store_directory('dedupe'))
+    first = store.put('http://a/1', JPEG)
+    assert_equals(first, store.put('http://a/2', JPEG))
+    assert first.endswith('.jpg')
+    assert_equals(first, store.get('http://a/1'))
+    assert_is_none(store.get('http://a/3'))
+    assert_equals(dict(urls=2, images=1, bytes=len(JPEG), hits=1, misses=1, evictions=0),
+                  store.stats())
+    assert os.path.isfile(os.path.join(store.objects, first))
+
+@raises(ValueError)
+def test_rejects_what_is_not_an_image():
+    ThumbnailStore(store_directory('html')).put('http://a/1', b'<html></html>')
+
+def test_least_recently_used_go_first():
+    store = ThumbnailStore(store_directory('lru'), max_bytes=len(JPEG) + len(PNG))
+    jpeg = store.put('http://a/jpeg', JPEG)
+    png = store.put('http://a/png', PNG)
+    store.get('http://a/jpeg')
+    store.put('http://a/gif', b'GIF89a' + b'gif' * 100)
+    assert_in('http://a/jpeg', store)
+    assert_not_in('http://a/png', store)
+    assert not os.path.exists(os.path.join(store.objects, png))
+    assert_equals(1, store.stats()['evictions'])
+
+def test_reopening_keeps_the_images():
+    path = store_directory('reopen')
+    store = ThumbnailStore(path)
+    name = store.put('http://a/1', JPEG)
+    store.put('http://a/2', PNG)
+    os.remove(os.path.join(store.objects, store.get('http://a/2')))
+    stray = os.path.join(store.objects, 'ff', 'ff.png')
+    os.makedirs(os.path.dirname(stray))
+    open(stray, 'wb').close()
+
+    store = ThumbnailStore(path)
+    assert_equals(name, store.get('http://a/1'))
+    assert_not_in('http://a/2', store)
+    assert not os.path.exists(stray)
+    assert_equals(len(JPEG), store.bytes)
+
+def test_origin_can_be_moved():
+    origin = Origin('http://localhost:9000/')
+    assert_equals('http://localhost:9000/books?id=x&zoom=1',
+                  origin.url_for('http://bks1.books.google.co.uk/books?id=x&zoom=1'))
+    assert_equals('http://a/b', Origin().url_for('http://a/b'))
+
+# ----------------------------------------------------------------------
+
+def test_prefetcher_fills_the_store():
+    images = {'http://a/1': JPEG, 'http://a/1s': PNG, 'http://a/bad': b'<html>'}
+    fetched = []
+    def origin(url):
+        fetched.append(url)
+        return images[url]
+    store = ThumbnailStore(store_directory('prefetch'))
+    prefetcher = Prefetcher(store, origin, threads=1)
+    books = [Book('TITLE', 'DESCRIPTION', 'ISBN-1', thumbnail='http://a/1', small_thumbnail='http://a/1s'),
+             Book('TITLE', 'DESCRIPTION', 'ISBN-2', thumbnail='http://a/bad'),
+             Book('TITLE', 'DESCRIPTION', 'ISBN-3', thumbnail='http://a/missing')]
+    repository = Repository()
+    for bk in books:
+        repository.store(bk)
+    prefetcher.start(repository)
+    try:
+        assert prefetcher.wait(5)
+        assert_in('http://a/1', store)
+        assert_in('http://a/1s', store)
+        assert_equals((2, 2), (prefetcher.fetched, prefetcher.failed))
+
+        # Failures aren't retried straight away, however urgent.
+        prefetcher.request('http://a/bad', urgent=True)
+        prefetcher.book_changed('store', 'ISBN-1', books[0])
+        assert prefetcher.wait(5)
+        assert_equals(4, len(fetched))
+    finally:
+        prefetcher.stop()
+
+def test_prefetcher_walks_the_catalogue_while_it_changes():
+    import threading
+    repository = Repository()
+    for i in range(2000):
+        repository.store(Book('TITLE', 'DESCRIPTION', 'ISBN-%d' % i, thumbnail='http://a/%d' % i))
+    fetched = set()
+    store = ThumbnailStore(store_directory('walk'))
+    prefetcher = Prefetcher(store, lambda url: fetched.add(url) or JPEG, threads=2)
+    def change():
+        for i in range(2000, 2500):
+            repository.store(Book('TITLE', 'DESCRIPTION', 'ISBN-%d' % i))
+            repository.delete('ISBN-%d' % (i - 1000))
+    changer = threading.Thread(target=change)
+    changer.start()
+    prefetcher.start(repository)
+    try:
+        changer.join()
+        assert prefetcher.wait(10)
+        kept = set('http://a/%d' % i for i in list(range(1000)) + list(range(1500, 2000)))
+        assert kept <= fetched
+    finally:
+        prefetcher.stop()
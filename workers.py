@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""Pre-fork worker mode: one listening socket, several processes.
+
+    python workers.py [workers] [port]
+
+The parent maps the catalogue (`LIBRARY_DATA`, default library.json)
+with a MappedCatalogue, stores every book lazily, and forks. The workers
+inherit the map, so the catalogue text lives once in the page cache
+however many workers there are; each worker only builds the books it
+actually serves.
+
+Mutations go through a SharedLog (`LIBRARY_LOG`, default library.log):
+an append-only file of journal records that every worker applies to its
+own repository. A request that may change something holds the log's
+file lock from start to finish, having first caught up with everything
+appended so far, so its checks see the latest state and two workers
+can't lend the same book twice. Other requests just catch up first.
+
+Versions (and so ETags) are stamped from the log's sequence numbers, so
+every worker tags the same state alike.
+
+POSIX only (fork and flock). The log isn't compacted; delete it to
+start again from the catalogue.
+"""
+import fcntl
+import gc
+import json
+import os
+import signal
+import sys
+import threading
+from contextlib import contextmanager
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+from models import Book, clock
+from loader import MappedCatalogue
+from persistence import book_state, read_journal, replay
+
+READ_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+# ----------------------------------------------------------------------
+
+class SharedLog(object):
+    """A journal shared by several processes, each applying the records
+    the others append to its own repository."""
+    def __init__(self, path, repository=None):
+        if repository is None:
+            repository = Book.get_repository()
+        self.path = path
+        self.repository = repository
+        self.base = clock.last   # record n is stamped version base + n
+        self.offset = 0          # how far into the file we have applied
+        self.sequence = 0        # the last record applied
+        self._lock = threading.RLock()
+        self._held = 0
+        self._applying = False
+        self._fd = None
+        self.reopen()
+        repository.subscribe(self._record)
+
+    def reopen(self):
+        """Open the log afresh. A forked process must do this before using
+        it: flock locks belong to the open file, which fork shares."""
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def _stamp(self, sequence, isbn):
+        version = self.base + sequence
+        book = self.repository._index.get(isbn)
+        if isinstance(book, Book):
+            book.version = version
+        clock.advance(version)
+
+    def catch_up(self):
+        """Apply whatever other processes have appended since the last
+        call. Returns the number of records applied."""
+        if os.fstat(self._fd).st_size == self.offset:
+            return 0
+        applied = 0
+        with self._lock:
+            self._applying = True
+            try:
+                for (sequence, action, isbn, payload), offset in read_journal(self.path, self.offset):
+                    replay(self.repository, action, isbn, payload)
+                    self._stamp(sequence, isbn)
+                    self.sequence, self.offset = sequence, offset
+                    applied += 1
+            finally:
+                self._applying = False
+        return applied
+
+    @contextmanager
+    def exclusive(self):
+        """Hold the log: no other process appends meanwhile, and everything
+        appended before is applied here."""
+        with self._lock:
+            first = not self._held
+            if first:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            self._held += 1
+            try:
+                if first:
+                    self.catch_up()
+                    if os.fstat(self._fd).st_size > self.offset:
+                        # A torn record from a process that died mid-write.
+                        os.ftruncate(self._fd, self.offset)
+                yield
+            finally:
+                self._held -= 1
+                if first:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _record(self, action, isbn, book, user):
+        if self._applying:
+            return
+        if action in ('store', 'update'):
+            # An update is logged as the state it leaves, like a store.
+            action, payload = 'store', book_state(book)
+        else:
+            payload = user
+        with self.exclusive():
+            sequence = self.sequence + 1
+            line = json.dumps([sequence, action, isbn, payload], separators=(',', ':'))
+            line = line.encode('utf-8') + b'\n'
+            os.write(self._fd, line)
+            self.sequence = sequence
+            self.offset += len(line)
+            self._stamp(sequence, isbn)
+
+    def middleware(self, app):
+        """Wrap the WSGI `app` so each request sees the shared state."""
+        def shared(environ, start_response):
+            if environ['REQUEST_METHOD'] in READ_METHODS:
+                self.catch_up()
+                return app(environ, start_response)
+            with self.exclusive():
+                return app(environ, start_response)
+        return shared
+
+    def close(self):
+        self.repository.unsubscribe(self._record)
+        os.close(self._fd)
+        self._fd = None
+
+# ----------------------------------------------------------------------
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def serve(app, host='0.0.0.0', port=8080, workers=None, data='library.json', log='library.log'):
+    """Load the catalogue, then fork `workers` processes (default: one per
+    CPU) to serve `app` on one socket. Returns when they have all exited."""
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    catalogue = MappedCatalogue(data)
+    print('Mapped %s: %r' % (data, catalogue.load_into()))
+    shared = SharedLog(log)
+    print('Caught up with %s: %d records' % (log, shared.catch_up()))
+    server = make_server(host, port, shared.middleware(app), handler_class=QuietHandler)
+    if hasattr(gc, 'freeze'):
+        gc.freeze() # keep the collector from touching (and copying) inherited pages
+
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                shared.reopen()
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    print('Serving on http://%s:%d/ with %d workers' % (host, server.server_port, workers))
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+# ----------------------------------------------------------------------
+
+if __name__ == '__main__':
+    from app import application
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    serve(application, port=port, workers=workers,
+          data=os.environ.get('LIBRARY_DATA', 'library.json'),
+          log=os.environ.get('LIBRARY_LOG', 'library.log'))
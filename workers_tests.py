@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+from nose.tools import raises, assert_equals
+import shutil
+import tempfile
+
+from models import Repository, Book, AlreadyOnLoanError
+from workers import SharedLog
+
+# ----------------------------------------------------------------------
+
+def setup():
+    global log_dir
+    log_dir = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(log_dir)
+
+def two_workers():
+    """Two repositories sharing one log, as two forked workers would."""
+    path = tempfile.mktemp(dir=log_dir)
+    a, b = Repository(), Repository()
+    return a, SharedLog(path, a), b, SharedLog(path, b)
+
+def test_changes_reach_the_other_worker():
+    a, log_a, b, log_b = two_workers()
+    a.store(Book('TITLE', 'DESCRIPTION', 'ISBN1'))
+    a.find_one('ISBN1').check_out('BORROWER')
+    a.find_one('ISBN1').reserve('RESERVER')
+    assert_equals(3, log_b.catch_up())
+    book = b.find_one('ISBN1')
+    assert_equals('BORROWER', book.borrower)
+    assert_equals(['RESERVER'], book.reservations)
+    assert_equals(a.find_one('ISBN1').version, book.version)
+    assert_equals(0, log_a.catch_up())
+
+@raises(AlreadyOnLoanError)
+def test_exclusive_checks_against_the_latest_state():
+    a, log_a, b, log_b = two_workers()
+    a.store(Book('TITLE', 'DESCRIPTION', 'ISBN1'))
+    log_b.catch_up()
+    a.find_one('ISBN1').check_out('FIRST')
+    with log_b.exclusive():
+        b.find_one('ISBN1').check_out('SECOND')
+
+def test_a_torn_record_is_dropped():
+    a, log_a, b, log_b = two_workers()
+    a.store(Book('TITLE', 'DESCRIPTION', 'ISBN1'))
+    with open(log_a.path, 'ab') as f:
+        f.write(b'[2,"check_out","ISBN1"')
+    b.store(Book('TITLE2', 'DESCRIPTION2', 'ISBN2'))
+    log_a.catch_up()
+    assert_equals(['ISBN1', 'ISBN2'], [bk.isbn for bk in a.find()])
+    assert_equals('', a.find_one('ISBN1').borrower)
+
+def test_middleware_catches_up_before_reads():
+    a, log_a, b, log_b = two_workers()
+    def app(environ, start_response):
+        return [str(len(b.find())).encode('ascii')]
+    app = log_b.middleware(app)
+    a.store(Book('TITLE', 'DESCRIPTION', 'ISBN1'))
+    assert_equals([b'1'], app({'REQUEST_METHOD': 'GET'}, None))
+    a.store(Book('TITLE2', 'DESCRIPTION2', 'ISBN2'))
+    assert_equals([b'2'], app({'REQUEST_METHOD': 'POST'}, None))